@@ -0,0 +1,103 @@
+### Benchmark of the import time of the comparison modules
+# Imports each module in a fresh interpreter (as a process-pool worker or a command line run does)
+# and reports the median import time and which of the heavy libraries it pulled in. With
+# --baseline, the same modules are also imported from another git revision of bin/, to show the
+# change in startup time.
+#
+# Examples:
+#   python benchmarks/bench_import_time.py
+#   python benchmarks/bench_import_time.py --baseline HEAD~1 --repeat 10
+import os,sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+MODULES = ['gravimetry_core', 'gravimetry_utils', 'gravimetry_ensemble', 'mascons', 'imbie_utils']
+
+# Libraries that dominate the startup time when imported
+HEAVY_LIBRARIES = ['cartopy', 'matplotlib', 'xarray', 'h5py', 'requests', 'scipy', 'netCDF4', 'pandas', 'geopandas']
+
+# Run in the fresh interpreter: time the import, then list the heavy libraries it loaded
+_IMPORT_SCRIPT = """
+import sys, time, json
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{'seconds': elapsed, 'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def time_import(module, bin_dir, repeat=5):
+    # Median import time of module from bin_dir over `repeat` fresh interpreters
+    path = os.pathsep.join(os.path.join(bin_dir, d) for d in ('Gravimetry', 'IMBIE', 'Common'))
+    env = dict(os.environ, PYTHONPATH=path, PYTHONDONTWRITEBYTECODE='1')
+    script = _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_LIBRARIES)
+
+    # One run first, so the bytecode and OS file caches are warm for every timed run
+    runs = []
+    for _ in range(repeat + 1):
+        output = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True)
+        if output.returncode != 0:
+            return {'error': output.stderr.strip().splitlines()[-1] if output.stderr.strip() else 'import failed'}
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    runs = runs[1:]
+    times = [run['seconds'] for run in runs]
+    return {'median_s': float(np.median(times)), 'min_s': min(times), 'loaded': runs[-1]['loaded']}
+
+
+def checkout_bin(revision, directory):
+    # Extract bin/ of a git revision into directory; returns the path of its bin/
+    archive = subprocess.run(['git', '-C', REPO_DIR, 'archive', revision, 'bin'], capture_output=True, check=True)
+    subprocess.run(['tar', '-x', '-C', directory], input=archive.stdout, check=True)
+    return os.path.join(directory, 'bin')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import time of the comparison modules.')
+    parser.add_argument('--modules', nargs='+', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=None, help='also time the modules of this git revision')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = {'current': {module: time_import(module, os.path.join(REPO_DIR, 'bin'), args.repeat) for module in args.modules}}
+    if args.baseline:
+        directory = tempfile.mkdtemp(prefix='import_baseline_')
+        try:
+            bin_dir = checkout_bin(args.baseline, directory)
+            results['baseline'] = {module: time_import(module, bin_dir, args.repeat) for module in args.modules}
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    for module in args.modules:
+        current = results['current'][module]
+        line = f'{module:<22s}'
+        if 'error' in current:
+            line += f' FAILED {current["error"]}'
+        else:
+            line += f" {current['median_s']:7.3f} s"
+            baseline = results.get('baseline', {}).get(module)
+            if baseline is not None:
+                if 'error' in baseline:
+                    line += '  (not in baseline)'
+                else:
+                    line += f"  baseline {baseline['median_s']:7.3f} s  ratio {current['median_s'] / baseline['median_s']:5.2f}"
+            line += f"  loads: {', '.join(current['loaded']) or '-'}"
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f'Results written to {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+### Benchmark of the mascon rendering in plotFigure
+# Renders one panel of synthetic mascons with the per-mascon ax.fill loop plotFigure used before,
+# and with the projected PolyCollection it uses now, to a headless (Agg) canvas.
+#
+# Example:
+#   python benchmarks/bench_plot_mascons.py --loc AIS --repeat 3
+import os,sys
+import time
+import argparse
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import cartopy.crs as ccrs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'Gravimetry'))
+from gravimetry_utils import set_projection, masconOutlines, _plotMasconPanel
+
+
+# Roughly equal-area 1 degree boxes covering the ice sheet, like the GSFC mascons
+def synthetic_mascons(loc, size=1.0):
+    lat_bands = np.arange(60, 84, size) if loc == 'GIS' else np.arange(-90, -60, size)
+    min_lats, max_lats, min_lons, max_lons = [], [], [], []
+    for lat in lat_bands:
+        width = size / max(np.cos(np.deg2rad(lat + size/2)), 0.05)
+        edges = np.arange(-180, 180, width) if loc == 'AIS' else np.arange(-75, -10, width)
+        min_lons.append(edges)
+        max_lons.append(edges + width)
+        min_lats.append(np.full(len(edges), lat))
+        max_lats.append(np.full(len(edges), lat + size))
+    return tuple(np.concatenate(a) for a in (min_lats, max_lats, min_lons, max_lons))
+
+
+def render_fill_loop(ax, min_lats, max_lats, min_lons, max_lons, values, vmin, vmax):
+    # The rendering plotFigure used before: one ax.fill per mascon, outlines rebuilt per panel
+    N_ints = 10
+    normal = plt.Normalize(vmin, vmax)
+    cmap = plt.cm.RdBu(normal(values))
+    for i in range(len(values)):
+        x = np.append(np.linspace(min_lons[i], max_lons[i], N_ints),
+                      np.linspace(max_lons[i], min_lons[i], N_ints))
+        y = np.append(min_lats[i]*np.ones(N_ints), max_lats[i]*np.ones(N_ints))
+        ax.fill(x, y, facecolor=cmap[i][:], edgecolor='none',
+                zorder=5, transform=ccrs.PlateCarree())
+
+
+def bench(loc, repeat):
+    polar_stereographic = set_projection(loc)
+    extent = [-65, -20, 57, 84] if loc == 'GIS' else [-135, 45, -52, -52]
+    min_lats, max_lats, min_lons, max_lons = synthetic_mascons(loc)
+    values = np.random.default_rng(0).normal(0, 5, len(min_lats))
+    vmin, vmax = -np.abs(values).max(), np.abs(values).max()
+    lon_centers, lat_centers = (min_lons + max_lons)/2, (min_lats + max_lats)/2
+
+    def legacy():
+        ax = plt.figure(figsize=(8, 8)).add_subplot(projection=polar_stereographic)
+        ax.set_extent(extent)
+        render_fill_loop(ax, min_lats, max_lats, min_lons, max_lons, values, vmin, vmax)
+        plt.gcf().canvas.draw()
+        plt.close('all')
+
+    def vectorized():
+        ax = plt.figure(figsize=(8, 8)).add_subplot(projection=polar_stereographic)
+        outlines = masconOutlines(min_lons, max_lons, min_lats, max_lats, polar_stereographic)
+        # No basins and no coastlines: the benchmark must not depend on Natural Earth downloads
+        ax.coastlines = lambda *args, **kwargs: None
+        _plotMasconPanel(ax, outlines, values, lon_centers, lat_centers, vmin, vmax,
+                         extent, '110m', [], 'benchmark')
+        plt.gcf().canvas.draw()
+        plt.close('all')
+
+    print(f'{loc}: {len(values)} mascons, best of {repeat}')
+    timings = {}
+    for name, run in [('ax.fill loop', legacy), ('PolyCollection', vectorized)]:
+        best = np.inf
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - t0)
+        timings[name] = best
+        print(f'  {name:<16s} {best:8.3f} s')
+    print(f"  speed-up         {timings['ax.fill loop'] / timings['PolyCollection']:8.1f} x")
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the mascon rendering of plotFigure.')
+    parser.add_argument('--loc', choices=['GIS', 'AIS'], nargs='+', default=['GIS', 'AIS'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+    for loc in args.loc:
+        bench(loc, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+### Check of the NumPy polar stereographic inverse against cartopy
+# Projects the standard GIS and AIS model grids (see synthetic.GRIDS) to lat/lon with
+# polar_stereo.inverse and with cartopy's Geodetic().transform_points on the CRS of set_projection,
+# and fails if any point differs by more than --tolerance metres (default 1 mm).
+#
+# float64 output is compared directly. float32 output cannot be closer to cartopy than the rounding
+# of its own lats and lons (about 0.4 m in latitude near the poles), so for float32 that rounding,
+# half a float32 step of each coordinate, is allowed on top of the tolerance.
+#
+# Examples:
+#   python benchmarks/check_polar_stereo.py
+#   python benchmarks/check_polar_stereo.py --resolutions 16 4 1 --locs AIS
+import os,sys
+import argparse
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'bin', 'Gravimetry'))
+
+import polar_stereo
+from synthetic import GRIDS
+from gravimetry_utils import set_projection
+
+# Mean Earth radius (m), to express lat/lon differences as distances
+EARTH_RADIUS = 6371008.8
+
+
+def grid_coords(loc, resolution_km):
+    grid = GRIDS[loc]
+    step = resolution_km * 1000
+    return (np.arange(grid['x'][0], grid['x'][1] + step, step, dtype=np.float64),
+            np.arange(grid['y'][0], grid['y'][1] + step, step, dtype=np.float64))
+
+
+def cartopy_inverse(x, y, loc):
+    # Flattened lats and lons in the x-major order of polar_stereo.inverse
+    import cartopy.crs as ccrs
+    yy, xx = np.meshgrid(y, x)
+    points = ccrs.Geodetic().transform_points(set_projection(loc), xx.ravel(), yy.ravel())
+    return points[:, 1], points[:, 0]
+
+
+def distances(lats, lons, ref_lats, ref_lons):
+    # Local distances (m) of (lats, lons) from (ref_lats, ref_lons)
+    d_lat = np.deg2rad(lats.astype(np.float64) - ref_lats)
+    d_lon = np.deg2rad((lons.astype(np.float64) - ref_lons + 180) % 360 - 180)
+    return EARTH_RADIUS * np.hypot(d_lat, np.cos(np.deg2rad(ref_lats)) * d_lon)
+
+
+def rounding_allowance(lats, lons, ref_lats):
+    # Distance (m) of half a step of the output dtype in each coordinate
+    d_lat = np.deg2rad(np.spacing(np.abs(lats)).astype(np.float64) / 2)
+    d_lon = np.deg2rad(np.spacing(np.abs(lons)).astype(np.float64) / 2)
+    return EARTH_RADIUS * np.hypot(d_lat, np.cos(np.deg2rad(ref_lats)) * d_lon)
+
+
+def check(loc, resolution_km, tolerance):
+    x, y = grid_coords(loc, resolution_km)
+    ref_lats, ref_lons = cartopy_inverse(x, y, loc)
+    ok = True
+    for dtype in (np.float64, np.float32):
+        lats, lons = polar_stereo.inverse(x, y, loc, dtype=dtype)
+        error = distances(lats, lons, ref_lats, ref_lons)
+        allowance = 0.0 if dtype == np.float64 else rounding_allowance(lats, lons, ref_lats)
+        excess = error - allowance
+        passed = lats.dtype == dtype and lons.dtype == dtype and bool(np.all(excess <= tolerance))
+        ok &= passed
+        print(f"{loc} {resolution_km:>2d} km {np.dtype(dtype).name:<7s} {len(error):>9d} points  "
+              f"max difference {error.max():.3e} m  max beyond rounding {max(excess.max(), 0.0):.3e} m  "
+              f"{'ok' if passed else 'FAILED'}")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check polar_stereo.inverse against cartopy.')
+    parser.add_argument('--locs', nargs='+', choices=['GIS', 'AIS'], default=['GIS', 'AIS'])
+    parser.add_argument('--resolutions', nargs='+', type=int, default=[16, 4], help='grid resolutions, km')
+    parser.add_argument('--tolerance', type=float, default=1e-3, help='largest allowed difference, m')
+    args = parser.parse_args(argv)
+
+    ok = True
+    for loc in args.locs:
+        for resolution_km in args.resolutions:
+            ok &= check(loc, resolution_km, args.tolerance)
+    if not ok:
+        print(f'Error: polar_stereo.inverse differs from cartopy by more than {args.tolerance} m.')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
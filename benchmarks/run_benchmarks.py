@@ -0,0 +1,349 @@
+### Benchmarks of the gravimetry and IMBIE comparisons
+# Times and memory-profiles the main steps of both tools separately and end to end, on synthetic
+# inputs (see synthetic.py), and writes the results as JSON that can be compared between runs.
+#
+# Examples:
+#   python benchmarks/run_benchmarks.py --output before.json
+#   python benchmarks/run_benchmarks.py --resolutions 16 4 1 --locs GIS --output after.json
+#   python benchmarks/run_benchmarks.py --compare before.json after.json
+#   python benchmarks/run_benchmarks.py --baseline HEAD~5
+#
+# Each benchmark runs --repeat times for the timings, then once more under tracemalloc for the
+# peak of Python and NumPy allocations (memory mapped files and library buffers not included).
+# The 1 km grids are large (the AIS one has 37 million cells); they are only generated and run
+# when asked for with --resolutions.
+#
+# With --baseline, the benchmarks also run on bin/ of another git revision (in a separate
+# interpreter, with --bin-dir), and the two runs are compared. Revisions from before the model
+# readers, the NumPy projection and the weight cache are run through their own entry points
+# (see the compatibility helpers below); benchmarks a revision cannot run are reported as not
+# comparable.
+import os,sys
+import io
+import json
+import time
+import shutil
+import inspect
+import argparse
+import tempfile
+import platform
+import datetime
+import subprocess
+import tracemalloc
+import contextlib
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+import synthetic
+
+# The modules benchmarked, imported from a bin/ directory by import_tools
+mascons = gravimetry_utils = imbie_utils = None
+
+
+# Comparison settings, as in the notebooks
+GRAVIMETRY_DATES = ('2006-01-01', '2014-12-31')
+IMBIE_DATES = ('2007-01-01', '2014-01-01')
+RHO_ICE = 918
+RHO_WATER = 1000
+MASS_BALANCE_COLUMN = 'Cumulative mass balance (Gt)'
+PROJECTIONS = {'GIS': 'EPSG:3413', 'AIS': 'EPSG:3031'}
+
+# Relative change reported as a regression or an improvement by --compare
+THRESHOLD = 0.10
+
+
+@contextlib.contextmanager
+def quiet():
+    # The tools report progress with print; keep it out of the benchmark output
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def measure(run, repeat=3):
+    # Wall time of run() for each repeat, then the tracemalloc peak of one more call
+    times = []
+    for _ in range(repeat):
+        with quiet():
+            t0 = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    try:
+        with quiet():
+            run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'times_s': times, 'min_s': min(times), 'median_s': float(np.median(times)), 'peak_mb': peak / 2**20}
+
+
+def import_tools(bin_dir=os.path.join(REPO_DIR, 'bin')):
+    global mascons, gravimetry_utils, imbie_utils
+    sys.path.insert(0, os.path.join(bin_dir, 'Gravimetry'))
+    sys.path.insert(0, os.path.join(bin_dir, 'IMBIE'))
+    import mascons
+    import gravimetry_utils
+    import imbie_utils
+
+
+def checkout_bin(revision, directory):
+    # Extract bin/ of a git revision into directory; returns the path of its bin/
+    archive = subprocess.run(['git', '-C', REPO_DIR, 'archive', revision, 'bin'], capture_output=True, check=True)
+    subprocess.run(['tar', '-x', '-C', directory], input=archive.stdout, check=True)
+    return os.path.join(directory, 'bin')
+
+
+### Compatibility helpers
+# The entry points of the current tools, or of older revisions that predate them.
+
+def load_model(filename):
+    # Model whose x and y are the grid coordinates, as a context manager
+    if hasattr(gravimetry_utils, 'loadModelReader'):
+        return gravimetry_utils.loadModelReader(filename)
+    return contextlib.closing(gravimetry_utils.loadGisModel(filename))
+
+
+def check_datarange(model, start_date, end_date):
+    if hasattr(model, 'check_datarange'):
+        model.check_datarange(start_date, end_date)
+    else:
+        gravimetry_utils.check_datarange(model['time'], start_date, end_date)
+
+
+def grid_to_geodetic(x, y, loc):
+    # Flattened lats and lons of the grid, x-major
+    x, y = np.asarray(x), np.asarray(y)
+    if hasattr(gravimetry_utils, 'gridToGeodetic'):
+        return gravimetry_utils.gridToGeodetic(x, y, loc)
+    import cartopy.crs as ccrs
+    yv, xv = np.meshgrid(y, x)
+    ll = ccrs.Geodetic(globe=ccrs.Globe('WGS84')).transform_points(gravimetry_utils.set_projection(loc), xv.ravel(), yv.ravel())
+    return ll[:, 1], ll[:, 0]
+
+
+def transform_to_geodetic(gsfc, model, polar_stereographic, I_, weights_cache_dir=None):
+    if 'I_' in inspect.signature(gravimetry_utils.transformToGeodetic).parameters:
+        return gravimetry_utils.transformToGeodetic(gsfc, model, *GRAVIMETRY_DATES, RHO_ICE, RHO_WATER, polar_stereographic,
+                                                    weights_cache_dir=weights_cache_dir, I_=I_)
+    if weights_cache_dir is not None:
+        raise ValueError('Error: transformToGeodetic of this revision has no weights cache.')
+    # Older revisions take I_ from the computeMasconMeans call before
+    return gravimetry_utils.transformToGeodetic(gsfc, model, *GRAVIMETRY_DATES, RHO_ICE, RHO_WATER, polar_stereographic)
+
+
+### Benchmarks
+# Each loads its inputs and returns the function to measure.
+
+def bench_points_to_mascons(inputs, loc, res):
+    gsfc = gravimetry_utils.loadGsfcMascons(inputs['gsfc'])
+    with load_model(inputs[loc]['models'][res]) as model:
+        x, y = np.asarray(model.x), np.asarray(model.y)
+    lats, lons = grid_to_geodetic(x, y, loc)
+    values = np.random.default_rng(0).normal(size=len(lats))
+    return lambda: mascons.points_to_mascons(gsfc, lats, lons, values)
+
+
+def bench_transform_to_geodetic(inputs, loc, res, weights_cache_dir=None):
+    gsfc = gravimetry_utils.loadGsfcMascons(inputs['gsfc'])
+    _, I_ = gravimetry_utils.computeMasconMeans(gsfc, *GRAVIMETRY_DATES, loc)
+    polar_stereographic = gravimetry_utils.set_projection(loc)
+    filename = inputs[loc]['models'][res]
+
+    def run():
+        with load_model(filename) as model:
+            transform_to_geodetic(gsfc, model, polar_stereographic, I_, weights_cache_dir)
+    if weights_cache_dir is not None:
+        # Build the cached weights before timing
+        with quiet():
+            run()
+    return run
+
+
+def bench_gravimetry_end_to_end(inputs, loc, res, output_dir):
+    polar_stereographic = gravimetry_utils.set_projection(loc)
+    netcdf_filename = os.path.join(output_dir, f'gravimetry_{loc}_{res}km.nc')
+
+    def run():
+        gsfc = gravimetry_utils.loadGsfcMascons(inputs['gsfc'])
+        mass_change_obs, I_ = gravimetry_utils.computeMasconMeans(gsfc, *GRAVIMETRY_DATES, loc)
+        with load_model(inputs[loc]['models'][res]) as model:
+            check_datarange(model, *GRAVIMETRY_DATES)
+            mass_change_mod_trim, _ = transform_to_geodetic(gsfc, model, polar_stereographic, I_)
+        gravimetry_utils.write_to_netcdf(mass_change_obs, mass_change_mod_trim - mass_change_obs, mass_change_mod_trim,
+                                         gsfc, I_, *GRAVIMETRY_DATES, netcdf_filename)
+    return run
+
+
+def bench_process_model_data(inputs, loc, res):
+    return lambda: imbie_utils.process_model_data(inputs[loc]['models'][res], *IMBIE_DATES, RHO_ICE, PROJECTIONS[loc],
+                                                  inputs[loc]['basins'], loc)
+
+
+def bench_sum_mass_balance(inputs, loc):
+    return lambda: imbie_utils.sum_MassBalance(inputs[loc]['imbie'], *IMBIE_DATES, MASS_BALANCE_COLUMN)
+
+
+def bench_imbie_end_to_end(inputs, loc, res, output_dir):
+    regions = inputs[loc].get('imbie_regions', {})
+    csv_filename = os.path.join(output_dir, f'imbie_{loc}_{res}km.csv')
+
+    def run():
+        basin_result = imbie_utils.process_model_data(inputs[loc]['models'][res], *IMBIE_DATES, RHO_ICE, PROJECTIONS[loc],
+                                                      inputs[loc]['basins'], loc)
+        results = imbie_utils.process_IMBIE(inputs[loc]['imbie'], *IMBIE_DATES, loc, basin_result, MASS_BALANCE_COLUMN,
+                                            regions.get('East'), regions.get('West'), regions.get('Peninsula'))
+        imbie_utils.write_mass_change_comparison(loc, basin_result, results, 'total', *IMBIE_DATES, csv_filename)
+    return run
+
+
+def benchmark_cases(inputs, locs, resolutions, output_dir):
+    # (name, parameters, factory) of every benchmark to run
+    cases = []
+    for loc in locs:
+        cases.append(('sum_MassBalance', {'loc': loc}, lambda loc=loc: bench_sum_mass_balance(inputs, loc)))
+        for res in resolutions:
+            params = {'loc': loc, 'resolution_km': res}
+            cases += [
+                ('points_to_mascons', params, lambda loc=loc, res=res: bench_points_to_mascons(inputs, loc, res)),
+                ('transformToGeodetic', params, lambda loc=loc, res=res: bench_transform_to_geodetic(inputs, loc, res)),
+                ('transformToGeodetic_cached_weights', params,
+                 lambda loc=loc, res=res: bench_transform_to_geodetic(inputs, loc, res, os.path.join(output_dir, 'weights'))),
+                ('gravimetry_end_to_end', params, lambda loc=loc, res=res: bench_gravimetry_end_to_end(inputs, loc, res, output_dir)),
+                ('process_model_data', params, lambda loc=loc, res=res: bench_process_model_data(inputs, loc, res)),
+                ('imbie_end_to_end', params, lambda loc=loc, res=res: bench_imbie_end_to_end(inputs, loc, res, output_dir)),
+            ]
+    return cases
+
+
+def git_revision(revision='HEAD'):
+    try:
+        return subprocess.run(['git', '-C', REPO_DIR, 'rev-parse', '--short', revision],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(data_dir, locs, resolutions, repeat=3, only=None, revision='HEAD'):
+    inputs = synthetic.ensure_inputs(data_dir, locs, resolutions)
+    output_dir = os.path.join(data_dir, 'output')
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = []
+    for name, params, factory in benchmark_cases(inputs, locs, resolutions, output_dir):
+        if only and name not in only:
+            continue
+        label = name + ''.join(f' {k}={v}' for k, v in params.items())
+        try:
+            with quiet():
+                run = factory()
+            result = measure(run, repeat)
+            print(f"{label:<60s} {result['median_s']:9.3f} s  {result['peak_mb']:9.1f} MB")
+        except Exception as error:
+            result = {'error': f'{type(error).__name__}: {error}'}
+            print(f'{label:<60s} FAILED {result["error"]}')
+        results.append({'name': name, 'params': params, **result})
+
+    return {'meta': {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                     'git_revision': git_revision(revision),
+                     'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'machine': platform.machine(),
+                     'processor': platform.processor(),
+                     'cpu_count': os.cpu_count(),
+                     'repeat': repeat},
+            'results': results}
+
+
+def _key(result):
+    return (result['name'],) + tuple(sorted(result['params'].items()))
+
+
+def compare(baseline_filename, current_filename, threshold=THRESHOLD):
+    # Print the change of median time and peak memory of every benchmark in both files;
+    # returns the number of benchmarks that got slower by more than threshold
+    with open(baseline_filename) as f:
+        baseline = {_key(r): r for r in json.load(f)['results']}
+    with open(current_filename) as f:
+        current = json.load(f)['results']
+
+    print(f"{'benchmark':<60s} {'time':>9s} {'before':>9s} {'ratio':>7s} {'memory':>9s} {'before':>9s} {'ratio':>7s}")
+    regressions = 0
+    for result in current:
+        label = result['name'] + ''.join(f' {k}={v}' for k, v in result['params'].items())
+        before = baseline.get(_key(result))
+        if before is None or 'error' in before or 'error' in result:
+            print(f'{label:<60s} (not comparable)')
+            continue
+        time_ratio = result['median_s'] / before['median_s']
+        memory_ratio = result['peak_mb'] / before['peak_mb'] if before['peak_mb'] else float('nan')
+        flag = ''
+        if time_ratio > 1 + threshold:
+            flag = '  SLOWER'
+            regressions += 1
+        elif time_ratio < 1 - threshold:
+            flag = '  faster'
+        print(f"{label:<60s} {result['median_s']:8.3f}s {before['median_s']:8.3f}s {time_ratio:7.2f} "
+              f"{result['peak_mb']:7.1f}MB {before['peak_mb']:7.1f}MB {memory_ratio:7.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the gravimetry and IMBIE comparisons on synthetic inputs.')
+    parser.add_argument('--data-dir', default=os.path.join(BENCHMARK_DIR, 'data'),
+                        help='directory for the synthetic inputs (generated on first use)')
+    parser.add_argument('--locs', nargs='+', choices=['GIS', 'AIS'], default=['GIS', 'AIS'])
+    parser.add_argument('--resolutions', nargs='+', type=int, choices=[16, 8, 4, 2, 1], default=[16, 4],
+                        help='model grid resolutions in km')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', default=None, help='run only these benchmarks')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), default=None,
+                        help='compare two result files instead of running')
+    parser.add_argument('--baseline', default=None, help='also run on bin/ of this git revision and compare')
+    parser.add_argument('--bin-dir', default=None, help='benchmark the modules of this bin/ directory (default: the repo\'s)')
+    parser.add_argument('--revision', default='HEAD', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(*args.compare) else 0
+
+    directory = None
+    if args.baseline:
+        directory = tempfile.mkdtemp(prefix='benchmark_baseline_')
+    try:
+        if args.baseline:
+            # The baseline modules have the same names, so they run in an interpreter of their own
+            print(f'Baseline {args.baseline}:')
+            baseline_filename = os.path.join(directory, 'baseline.json')
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--bin-dir', checkout_bin(args.baseline, directory),
+                            '--revision', args.baseline, '--data-dir', args.data_dir, '--locs', *args.locs,
+                            '--resolutions', *map(str, args.resolutions), '--repeat', str(args.repeat),
+                            '--output', baseline_filename] + (['--only', *args.only] if args.only else []), check=True)
+            print('Current:')
+
+        import_tools(args.bin_dir or os.path.join(REPO_DIR, 'bin'))
+        results = run_benchmarks(args.data_dir, args.locs, args.resolutions, args.repeat, args.only, args.revision)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=1)
+            print(f'Results written to {args.output}')
+
+        if args.baseline:
+            current_filename = os.path.join(directory, 'current.json')
+            with open(current_filename, 'w') as f:
+                json.dump(results, f)
+            print()
+            compare(baseline_filename, current_filename)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+### Synthetic inputs for the benchmarks
+# Offline stand-ins for the comparison inputs, with the layouts the tools read:
+#   - GSFC mascon solution (HDF5; /mascon/*, /solution/cmwe, /time/*) as read by mascons.GSFCmascons
+#   - ISMIP6-style lithk grids (NetCDF; time, y, x) in the standard GIS and AIS polar stereographic grids
+#   - IMBIE basin shapefiles with the SUBREGION1 (GIS) and Subregion/Regions (AIS) fields
+#   - IMBIE mass balance CSV files
+# Files are written once into a data directory and reused by later runs.
+import os
+import glob
+import numpy as np
+import h5py
+import pandas as pd
+from netCDF4 import Dataset
+from shapely import affinity
+from shapely.geometry import Point, Polygon
+import geopandas as gpd
+
+
+# ISMIP6 standard grid extents (m) and ice sheet outline (centre and semi-axes, m)
+GRIDS = {
+    'GIS': {'x': (-720000, 960000), 'y': (-3450000, -570000), 'epsg': 3413,
+            'centre': (-30000, -1950000), 'axes': (600000, 1250000)},
+    'AIS': {'x': (-3040000, 3040000), 'y': (-3040000, 3040000), 'epsg': 3031,
+            'centre': (0, 0), 'axes': (2500000, 2200000)},
+}
+
+# Basin names of the IMBIE shapefiles
+GIS_SUBREGIONS = ['NO', 'NE', 'CE', 'SE', 'SW', 'CW', 'NW']
+AIS_SUBREGIONS = [('A-Ap', 'East'), ('Ap-B', 'East'), ('B-C', 'East'), ('C-Cp', 'East'), ('Cp-D', 'East'),
+                  ('D-Dp', 'East'), ('Dp-E', 'East'), ('E-Ep', 'East'), ('Ep-F', 'West'), ('F-G', 'West'),
+                  ('G-H', 'West'), ('H-Hp', 'West'), ('Hp-I', 'Peninsula'), ('I-Ipp', 'Peninsula'),
+                  ('Ipp-J', 'Peninsula'), ('J-Jpp', 'West'), ('Jpp-K', 'East'), ('K-A', 'East')]
+
+# GSFC solution epochs: months from 04/2002 to 12/2023, in days since 2002-01-01
+GSFC_FIRST_DAY = 105.0
+GSFC_EPOCHS = 260
+
+# Model years, covering the GSFC and IMBIE records
+MODEL_YEARS = (2000, 2021)
+
+
+def gsfc_h5(filename, n_epochs=GSFC_EPOCHS, seed=0):
+    # Global 1 degree mascons, with roughly equal area lat/lon boxes as in the GSFC solution
+    lat_centers, lat_spans, lon_centers, lon_spans = [], [], [], []
+    for lat in np.arange(-89.5, 90, 1.0):
+        n = max(1, int(round(360 * np.cos(np.deg2rad(lat)))))
+        lat_centers.append(np.full(n, lat))
+        lat_spans.append(np.ones(n))
+        lon_centers.append((np.arange(n) + 0.5) * 360 / n)
+        lon_spans.append(np.full(n, 360 / n))
+    lat_centers, lat_spans, lon_centers, lon_spans = (np.concatenate(a) for a in (lat_centers, lat_spans, lon_centers, lon_spans))
+    n_mascons = len(lat_centers)
+
+    # Location codes: 1 Greenland, 3/4 Antarctica (East/West), 0 elsewhere
+    locations = np.zeros(n_mascons)
+    lons_pm180 = np.where(lon_centers > 180, lon_centers - 360, lon_centers)
+    locations[(lat_centers > 59) & (lat_centers < 84) & (lons_pm180 > -75) & (lons_pm180 < -10)] = 1
+    locations[(lat_centers < -60) & (lons_pm180 >= 0)] = 3
+    locations[(lat_centers < -60) & (lons_pm180 < 0)] = 4
+
+    rng = np.random.default_rng(seed)
+    days_middle = GSFC_FIRST_DAY + np.arange(n_epochs) * 365.25 / 12
+    trend = rng.normal(0, 2, n_mascons)[:, None]
+    cmwe = trend * (days_middle / 365.25) + rng.normal(0, 1, (n_mascons, n_epochs)).cumsum(axis=1)
+
+    with h5py.File(filename, 'w') as f:
+        for name, values in [('lat_center', lat_centers), ('lat_span', lat_spans), ('lon_center', lon_centers),
+                             ('lon_span', lon_spans), ('location', locations), ('basin', np.zeros(n_mascons)),
+                             ('area_km2', 12390.1 * np.cos(np.deg2rad(lat_centers)) * lon_spans)]:
+            f[f'/mascon/{name}'] = values[None, :]
+        f['/solution/cmwe'] = cmwe
+        f['/time/ref_days_first'] = (days_middle - 15)[None, :]
+        f['/time/ref_days_middle'] = days_middle[None, :]
+        f['/time/ref_days_last'] = (days_middle + 15)[None, :]
+
+
+def _ice_mask(loc, x, y):
+    # Elliptic ice sheet on the model grid, as (y, x) boolean and normalised radius
+    grid = GRIDS[loc]
+    (x_0, y_0), (a, b) = grid['centre'], grid['axes']
+    r = np.sqrt(((x[None, :] - x_0) / a)**2 + ((y[:, None] - y_0) / b)**2)
+    return r < 1, r
+
+
+def lithk_nc(filename, loc, resolution_km, years=MODEL_YEARS, calendar=None, seed=0):
+    # Yearly ice thickness on the ISMIP6 grid; written one time slice at a time, so that
+    # the 1 km grids do not have to fit in memory. Cells outside the ice sheet are missing.
+    grid = GRIDS[loc]
+    res = resolution_km * 1000
+    x = np.arange(grid['x'][0], grid['x'][1] + 1, res, dtype=np.float64)
+    y = np.arange(grid['y'][0], grid['y'][1] + 1, res, dtype=np.float64)
+    calendar = calendar or ('standard' if loc == 'GIS' else 'noleap')
+    days_per_year = 365.25 if calendar == 'standard' else {'noleap': 365, '360_day': 360}[calendar]
+    times = (np.arange(years[0], years[1] + 1) - 1950) * days_per_year
+
+    ice, r = _ice_mask(loc, x, y)
+    thickness = np.where(ice, 3000 * np.sqrt(np.clip(1 - r**2, 0, 1)), np.nan).astype(np.float32)
+    thinning = np.where(ice, -2.0 * r**4, 0).astype(np.float32)
+    rng = np.random.default_rng(seed)
+
+    with Dataset(filename, 'w', format='NETCDF4') as nc:
+        nc.createDimension('time', None)
+        nc.createDimension('y', len(y))
+        nc.createDimension('x', len(x))
+        time_var = nc.createVariable('time', 'f8', ('time',))
+        time_var.units = 'days since 1950-01-01'
+        time_var.calendar = calendar
+        nc.createVariable('x', 'f8', ('x',))[:] = x
+        nc.createVariable('y', 'f8', ('y',))[:] = y
+        lithk = nc.createVariable('lithk', 'f4', ('time', 'y', 'x'), fill_value=np.float32(9.96921e36))
+        lithk.units = 'm'
+        lithk.standard_name = 'land_ice_thickness'
+        for i, t in enumerate(times):
+            time_var[i] = t
+            noise = rng.normal(0, 0.5, thickness.shape).astype(np.float32)
+            lithk[i, :, :] = np.ma.masked_invalid(thickness + i * thinning + noise)
+
+
+def _sector(centre, radius, angle_0, angle_1):
+    angles = np.linspace(angle_0, angle_1, 32)
+    return Polygon([centre] + [(centre[0] + radius * np.cos(a), centre[1] + radius * np.sin(a)) for a in angles])
+
+
+def basins_shp(filename, loc):
+    # Basins as sectors of the elliptic ice sheet, in the model projection
+    grid = GRIDS[loc]
+    centre, (a, b) = grid['centre'], grid['axes']
+    sheet = affinity.scale(Point(centre).buffer(1.0, 128), a, b)
+    radius = 2 * max(a, b)
+
+    if loc == 'GIS':
+        edges = np.linspace(0, 2 * np.pi, len(GIS_SUBREGIONS) + 1) + np.pi / 2
+        records = [{'SUBREGION1': name, 'NAME': None, 'GL_TYPE': None,
+                    'geometry': sheet.intersection(_sector(centre, radius, edges[i], edges[i + 1]))}
+                   for i, name in enumerate(GIS_SUBREGIONS)]
+    else:
+        edges = np.linspace(0, 2 * np.pi, len(AIS_SUBREGIONS) + 1)
+        records = [{'Regions': region, 'Subregion': name,
+                    'geometry': sheet.intersection(_sector(centre, radius, edges[i], edges[i + 1]))}
+                   for i, (name, region) in enumerate(AIS_SUBREGIONS)]
+        # Islands off the coast, without a subregion
+        islands = [Point(centre[0] + 1.1 * a * np.cos(t), centre[1] + 1.1 * b * np.sin(t)).buffer(60000)
+                   for t in np.linspace(0, 2 * np.pi, 12, endpoint=False)]
+        records.insert(0, {'Regions': 'Islands', 'Subregion': None,
+                           'geometry': gpd.GeoSeries(islands).union_all()})
+
+    gpd.GeoDataFrame(records, crs=f"EPSG:{grid['epsg']}").to_file(filename)
+
+
+def imbie_csv(filename, rate=-100.0, seed=0):
+    # Monthly IMBIE mass balance record from 1992, in the layout of the 2021 IMBIE files
+    rng = np.random.default_rng(seed)
+    years = np.round(1992 + np.arange(29 * 12) / 12, 4)
+    mass_balance = rate + rng.normal(0, 30, len(years))
+    uncertainty = np.abs(rng.normal(100, 20, len(years)))
+    pd.DataFrame({'Year': years,
+                  'Mass balance (Gt/yr)': mass_balance,
+                  'Mass balance uncertainty (Gt/yr)': uncertainty,
+                  'Cumulative mass balance (Gt)': np.cumsum(mass_balance / 12),
+                  'Cumulative mass balance uncertainty (Gt)': np.sqrt(np.cumsum((uncertainty / 12)**2))}
+                 ).to_csv(filename, index=False)
+
+
+def ensure_inputs(data_dir, locs=('GIS', 'AIS'), resolutions_km=(16, 4)):
+    # Paths of the synthetic inputs in data_dir, generating whatever is missing
+    os.makedirs(data_dir, exist_ok=True)
+
+    def make(name, build, *args):
+        filename = os.path.join(data_dir, name)
+        if not os.path.exists(filename):
+            print(f'Generating {filename}')
+            # Build under a temporary name, so an interrupted run leaves no partial input
+            # (a shapefile is several files; its .shp is moved last)
+            tmp_filename = os.path.join(data_dir, 'tmp_' + name)
+            build(tmp_filename, *args)
+            for tmp in sorted(glob.glob(os.path.splitext(tmp_filename)[0] + '.*'), key=lambda f: f == tmp_filename):
+                os.replace(tmp, os.path.join(data_dir, os.path.basename(tmp)[len('tmp_'):]))
+        return filename
+
+    inputs = {'gsfc': make('gsfc_synthetic.h5', gsfc_h5)}
+    for loc in locs:
+        inputs[loc] = {'basins': make(f'basins_{loc}.shp', basins_shp, loc),
+                       'imbie': make(f'imbie_{loc}.csv', imbie_csv, -250.0 if loc == 'GIS' else -100.0),
+                       'models': {res: make(f'lithk_{loc}_{res}km.nc', lithk_nc, loc, res) for res in resolutions_km}}
+        if loc == 'AIS':
+            inputs[loc]['imbie_regions'] = {region: make(f'imbie_{loc}_{region.lower()}.csv', imbie_csv, rate, seed)
+                                            for seed, (region, rate) in enumerate([('East', 10.0), ('West', -80.0), ('Peninsula', -20.0)], 1)}
+    return inputs
@@ -0,0 +1,384 @@
+import os,sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import traceback
+import importlib
+import contextlib
+import collections
+import urllib.request
+import urllib.error
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+bin_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(bin_dir, 'Gravimetry'))
+sys.path.insert(0, os.path.join(bin_dir, 'IMBIE'))
+
+import gravimetry_ensemble
+import imbie_ensemble
+from gravimetry_core import loadGsfcMascons
+
+# Long-running local comparison service for the notebooks.
+# The GSFC mascons, IMBIE observations and basin masks are loaded once and kept, and the
+# comparisons run in worker pools that stay up between requests (with their mascon weights and
+# basin masks), so a notebook gets its result without paying the start-up costs each time.
+# The workers are those of the ensemble runners. There is one pool for each observation file and
+# ice sheet in use, started with what its workers keep (the GSFC mascons); the dates, densities and
+# observed changes of a request are sent with each of its tasks, so requests for other dates reuse
+# the warm pool. The least recently used pools are shut down beyond max_pools, once they are idle.
+#
+# Start the service:
+#   python comparison_service.py --gsfc gsfc.h5 --loc GIS AIS --weights-cache ~/.cache/cmct/weights \
+#       --mask-cache ~/.cache/cmct/masks --output-path out/
+#
+# From a notebook:
+#   from comparison_service import request_comparison
+#   response = request_comparison({'comparison': 'gravimetry', 'models': [nc_filename], 'icesheet': 'GIS',
+#                                  'start_date': '2006-01-01', 'end_date': '2010-01-01'})
+#   response['results'][0]['output']     # the comparison NetCDF file
+#
+# Requests are JSON objects POSTed to /compare:
+#   comparison     'gravimetry' or 'imbie'
+#   models         model NetCDF files or glob templates
+#   icesheet       'GIS' or 'AIS'
+#   start_date, end_date
+#   obs            GSFC HDF5 file (default: the service's --gsfc) or IMBIE CSV
+#   optional: rho_ice, rho_water, output_path (gravimetry); shapefile (required), obs_east, obs_west,
+#   obs_peninsula, mass_balance_column, projection (imbie)
+# All paths in a request (models, obs files, shapefile, output_path) must be absolute, as the service
+# runs in a directory of its own; request_comparison makes relative paths absolute against the
+# caller's working directory before sending the request.
+# The response has one result per model: gravimetry results have the 'output' file name, IMBIE
+# results the tidy table 'rows' (imbie_ensemble.TABLE_COLUMNS). GET /status describes the loaded
+# state, and POST /shutdown stops the service.
+
+DEFAULT_PORT = 8765
+DEFAULT_URL = f'http://127.0.0.1:{DEFAULT_PORT}'
+
+
+# Request fields holding paths
+PATH_FIELDS = ['models', 'obs', 'obs_east', 'obs_west', 'obs_peninsula', 'shapefile', 'output_path']
+
+# Observation states kept for repeated requests
+MAX_STATES = 16
+
+
+def _absolute_paths(request):
+    # The request with its paths made absolute against this process's working directory
+    request = dict(request)
+    for name in PATH_FIELDS:
+        value = request.get(name)
+        if isinstance(value, str):
+            request[name] = os.path.abspath(value)
+        elif isinstance(value, list):
+            request[name] = [os.path.abspath(v) for v in value]
+    return request
+
+
+def _check_absolute(request):
+    for name in PATH_FIELDS:
+        value = request.get(name)
+        for path in ([value] if isinstance(value, str) else value or []):
+            if not os.path.isabs(path):
+                raise ValueError(f"Error: The request's {name} path '{path}' is not absolute.")
+
+
+def _expand_models(templates):
+    if isinstance(templates, str):
+        templates = [templates]
+    filenames = sorted(f for template in templates for f in (glob.glob(template) or [template]))
+    if not filenames:
+        raise ValueError('Error: The request has no models.')
+    return filenames
+
+
+def _required(request, *names):
+    missing = [name for name in names if request.get(name) is None]
+    if missing:
+        raise ValueError(f"Error: The request is missing {', '.join(missing)}.")
+
+
+### Worker side
+# A pool's workers are initialised with the resident part of the state, and each task brings the
+# part of its request; the two are merged into the ensemble runner's state for the model.
+_worker_module = None
+_worker_state = None
+
+
+def _init_service_worker(module_name, resident_state):
+    global _worker_module, _worker_state
+    _worker_module = importlib.import_module(module_name)
+    _worker_state = resident_state
+    _worker_module._init_worker(resident_state)
+
+
+def _run_service_task(task):
+    request_state, nc_filename = task
+    _worker_module._state = {**_worker_state, **request_state}
+    return _worker_module._run_model(nc_filename)
+
+
+class ComparisonService:
+    def __init__(self, processes=None, output_path='.', weights_cache_dir=None, gsfc_cache_dir=None,
+                 mask_cache_dir=None, gsfc_filename=None, max_pools=2, staging_settings=None):
+        self.processes = processes
+        self.output_path = os.path.abspath(output_path)
+        self.weights_cache_dir = weights_cache_dir
+        self.gsfc_cache_dir = gsfc_cache_dir
+        self.gsfc_filename = None if gsfc_filename is None else os.path.abspath(gsfc_filename)
+        self.max_pools = max_pools
+        self.staging_settings = staging_settings
+
+        # Basin masks are shared through a directory; a temporary one lasts as long as the service
+        self.temporary_mask_dir = None
+        if mask_cache_dir is None:
+            mask_cache_dir = self.temporary_mask_dir = tempfile.mkdtemp(prefix='basin_masks_')
+        self.mask_cache_dir = mask_cache_dir
+
+        self._lock = threading.RLock()
+        self._gsfc = {}
+        self._states = collections.OrderedDict()
+        self._pools = collections.OrderedDict()
+        self.counts = {'requests': 0, 'models': 0, 'failed': 0}
+        self.started = time.time()
+
+    ### Resident state
+    def gsfc(self, obs_filename, loc):
+        # Mascons of one ice sheet, over the whole record, loaded once
+        key = (os.path.abspath(obs_filename), loc)
+        with self._lock:
+            if key not in self._gsfc:
+                print(f'Loading GSFC mascons of {loc} from {obs_filename}')
+                self._gsfc[key] = loadGsfcMascons(obs_filename, loc=loc, cache_dir=self.gsfc_cache_dir)
+            return self._gsfc[key]
+
+    def _state(self, key, load):
+        with self._lock:
+            if key not in self._states:
+                self._states[key] = load()
+                while len(self._states) > MAX_STATES:
+                    self._states.popitem(last=False)
+            self._states.move_to_end(key)
+            return self._states[key]
+
+    @contextlib.contextmanager
+    def _pool(self, key, module, resident_state):
+        # Worker pool of the ensemble runner module for key, held while a request uses it.
+        # Pools are kept between requests; a pool evicted while in use is shut down by its last user.
+        with self._lock:
+            entry = self._pools.get(key)
+            if entry is None:
+                # Workers are started afresh rather than forked from this multi-threaded process
+                pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=_init_service_worker, initargs=(module.__name__, resident_state))
+                entry = self._pools[key] = {'pool': pool, 'users': 0}
+            self._pools.move_to_end(key)
+            entry['users'] += 1
+            while len(self._pools) > self.max_pools:
+                _, old_entry = self._pools.popitem(last=False)
+                if old_entry['users'] == 0:
+                    old_entry['pool'].shutdown(wait=False)
+        try:
+            yield entry['pool']
+        finally:
+            with self._lock:
+                entry['users'] -= 1
+                if entry['users'] == 0 and self._pools.get(key) is not entry:
+                    entry['pool'].shutdown(wait=False)
+
+    ### Comparisons
+    def compare(self, request):
+        _check_absolute(request)
+        comparison = request.get('comparison')
+        t0 = time.perf_counter()
+        if comparison == 'gravimetry':
+            results = self._compare_gravimetry(request)
+        elif comparison == 'imbie':
+            results = self._compare_imbie(request)
+        else:
+            raise ValueError(f"Error: Unknown comparison '{comparison}'; expected 'gravimetry' or 'imbie'.")
+
+        with self._lock:
+            self.counts['requests'] += 1
+            self.counts['models'] += len(results)
+            self.counts['failed'] += sum(r['status'] != 'ok' for r in results)
+        return {'comparison': comparison, 'results': results, 'seconds': time.perf_counter() - t0}
+
+    def _compare_gravimetry(self, request):
+        _required(request, 'models', 'icesheet', 'start_date', 'end_date')
+        obs_filename = request.get('obs', self.gsfc_filename)
+        if obs_filename is None:
+            raise ValueError('Error: The request has no obs and the service has no default GSFC file.')
+        nc_filenames = _expand_models(request['models'])
+        loc, start_date, end_date = request['icesheet'], request['start_date'], request['end_date']
+        rho_ice, rho_water = request.get('rho_ice', 918), request.get('rho_water', 1000)
+        output_path = request.get('output_path', self.output_path)
+        os.makedirs(output_path, exist_ok=True)
+
+        gsfc = self.gsfc(obs_filename, loc)
+        key = ('gravimetry', obs_filename, loc, start_date, end_date, rho_ice, rho_water, output_path)
+        state = self._state(key, lambda: gravimetry_ensemble.load_observation_state(
+            obs_filename, start_date, end_date, loc, rho_ice, rho_water, output_path, self.weights_cache_dir,
+            self.gsfc_cache_dir, staging_settings=self.staging_settings, gsfc=gsfc))
+        # The workers keep the mascons; the rest of the state goes with each task
+        request_state = {name: value for name, value in state.items() if name != 'gsfc'}
+
+        results = []
+        with self._pool(('gravimetry', obs_filename, loc), gravimetry_ensemble,
+                        {'gsfc': gsfc, 'instrument': None, 'staging': self.staging_settings}) as pool:
+            for result in pool.map(_run_service_task, [(request_state, f) for f in nc_filenames]):
+                result.pop('stages', None)
+                results.append(result)
+        return results
+
+    def _compare_imbie(self, request):
+        _required(request, 'models', 'icesheet', 'start_date', 'end_date', 'obs', 'shapefile')
+        nc_filenames = _expand_models(request['models'])
+        icesheet, start_date, end_date = request['icesheet'], request['start_date'], request['end_date']
+        mass_balance_column = request.get('mass_balance_column', 'Cumulative mass balance (Gt)')
+        files = [request.get(name) for name in ('obs', 'obs_east', 'obs_west', 'obs_peninsula')]
+        shape_filename = request['shapefile']
+
+        key = ('imbie', *files, shape_filename, icesheet, start_date, end_date, mass_balance_column,
+               request.get('projection'), request.get('rho_ice', 918))
+        state = self._state(key, lambda: imbie_ensemble.load_observation_state(
+            files[0], start_date, end_date, icesheet, shape_filename, request.get('rho_ice', 918), mass_balance_column,
+            files[1], files[2], files[3], request.get('projection'), self.mask_cache_dir,
+            staging_settings=self.staging_settings))
+        # Masks of new grids are built here once, not by each worker
+        imbie_ensemble.prepare_basin_masks(nc_filenames, shape_filename, self.mask_cache_dir)
+
+        results = []
+        with self._pool(('imbie', files[0], icesheet), imbie_ensemble,
+                        {'instrument': None, 'staging': self.staging_settings}) as pool:
+            for result in pool.map(_run_service_task, [(state, f) for f in nc_filenames]):
+                result.pop('stages', None)
+                if result['status'] == 'ok':
+                    rows = imbie_ensemble.table_rows(imbie_ensemble.model_name(result['model']), state, *result['output'])
+                    result['rows'] = [dict(zip(imbie_ensemble.TABLE_COLUMNS, row)) for row in rows]
+                result['output'] = None
+                results.append(result)
+        return results
+
+    def status(self):
+        with self._lock:
+            return {'uptime_s': time.time() - self.started, **self.counts,
+                    'gsfc': [f'{loc} {filename}' for filename, loc in self._gsfc],
+                    'pools': [' '.join(str(k) for k in key) + f" ({entry['users']} in use)"
+                              for key, entry in self._pools.items()],
+                    'mask_cache_dir': self.mask_cache_dir}
+
+    def close(self):
+        with self._lock:
+            for entry in self._pools.values():
+                entry['pool'].shutdown(wait=True)
+            self._pools.clear()
+        if self.temporary_mask_dir is not None:
+            shutil.rmtree(self.temporary_mask_dir, ignore_errors=True)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # The ComparisonService is set on the server as .service
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, self.server.service.status())
+        else:
+            self._reply(404, {'error': f'Error: Unknown path {self.path}.'})
+
+    def do_POST(self):
+        if self.path == '/shutdown':
+            self._reply(200, {'status': 'shutting down'})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        if self.path != '/compare':
+            self._reply(404, {'error': f'Error: Unknown path {self.path}.'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self._reply(200, self.server.service.compare(request))
+        except ValueError as error:
+            self._reply(400, {'error': str(error)})
+        except Exception as error:
+            self._reply(500, {'error': f'{type(error).__name__}: {error}', 'traceback': traceback.format_exc()})
+
+    def log_message(self, format, *args):
+        print(f'{self.address_string()} {format % args}')
+
+
+def serve(service, host='127.0.0.1', port=DEFAULT_PORT):
+    # Serve requests until POST /shutdown or Ctrl-C
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.service = service
+    print(f'Comparison service listening on http://{host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def _call(url, body, timeout):
+    data = None if body is None else json.dumps(body).encode()
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'},
+                                     method='GET' if body is None else 'POST')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        raise ValueError(json.loads(error.read()).get('error', str(error)))
+
+
+def request_comparison(request, url=DEFAULT_URL, timeout=None):
+    # Run a comparison on the service at url; returns the response (see the request format above).
+    # Relative paths in the request are taken relative to the caller's working directory.
+    return _call(url + '/compare', _absolute_paths(request), timeout)
+
+
+def service_status(url=DEFAULT_URL, timeout=10):
+    return _call(url + '/status', None, timeout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local comparison service with resident observations.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--gsfc', default=None, help='default GSFC mascon solution (HDF5)')
+    parser.add_argument('--loc', nargs='*', default=[], choices=['GIS', 'AIS'], help='load the --gsfc mascons of these ice sheets at start')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes per pool (default: all cores)')
+    parser.add_argument('--max-pools', type=int, default=2, help='worker pools kept at once')
+    parser.add_argument('--output-path', default='.', help='default directory of the gravimetry comparison files')
+    parser.add_argument('--weights-cache', default=None, help='directory for cached grid -> mascon weights')
+    parser.add_argument('--gsfc-cache', default=None, help='directory for the memory-mapped GSFC cache')
+    parser.add_argument('--mask-cache', default=None, help='directory for cached basin masks')
+    parser.add_argument('--staging-dir', default=None, help='local scratch directory to stage the model files in')
+    args = parser.parse_args(argv)
+
+    if args.loc and args.gsfc is None:
+        parser.error('--loc needs --gsfc')
+    staging_settings = None if args.staging_dir is None else {'stage_dir': args.staging_dir}
+    service = ComparisonService(args.processes, args.output_path, args.weights_cache, args.gsfc_cache,
+                                args.mask_cache, args.gsfc, args.max_pools, staging_settings)
+    for loc in args.loc:
+        service.gsfc(args.gsfc, loc)
+    serve(service, args.host, args.port)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+import os,sys
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Gravimetry'))
+from gravimetry_core import loadGsfcMascons, selectMascons, read_comparison_netcdf, read_ensemble_store
+
+# Skill statistics of a whole model ensemble against the observations.
+# The results of all models are stacked into (model x unit) arrays, the units being mascons for
+# the gravimetry comparison and IMBIE regions (or the ice sheet total) for the IMBIE comparison,
+# and every statistic is computed for all models at once:
+#
+#   bias         mean of model - observed
+#   rmse         root mean square of model - observed
+#   area_rmse    the same, weighted by the mascon areas (gravimetry, with the GSFC file)
+#   correlation  Pearson correlation of model and observed over the units
+#   rank         1 for the model with the smallest area_rmse (or rmse), ties sharing a rank
+#
+# Units where either value is missing are left out of that model's statistics.
+#
+# Examples:
+#   python ensemble_stats.py gravimetry --store ensemble_GIS.nc --obs gsfc.h5 --loc GIS --output skill_GIS.csv
+#   python ensemble_stats.py gravimetry --comparisons 'out/*_mascon_comp.nc' --obs gsfc.h5 --loc AIS --output skill_AIS.csv
+#   python ensemble_stats.py imbie --table imbie_AIS.csv --output imbie_skill_AIS.csv
+
+SKILL_COLUMNS = ['model', 'n_units', 'bias', 'rmse', 'area_rmse', 'correlation', 'rank']
+
+
+def skill_statistics(mod, obs, weights=None):
+    # Statistics of each row of mod (model x unit) against obs (unit,) or (model x unit), as arrays by model
+    mod = np.asarray(mod, dtype=np.float64)
+    obs = np.broadcast_to(np.asarray(obs, dtype=np.float64), mod.shape)
+    valid = np.isfinite(mod) & np.isfinite(obs)
+    n = valid.sum(axis=1)
+    delta = np.where(valid, mod - obs, 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bias = delta.sum(axis=1) / n
+        rmse = np.sqrt((delta**2).sum(axis=1) / n)
+
+        area_rmse = np.full(len(mod), np.nan)
+        if weights is not None:
+            w = np.where(valid, np.broadcast_to(np.asarray(weights, dtype=np.float64), mod.shape), 0)
+            area_rmse = np.sqrt((w * delta**2).sum(axis=1) / w.sum(axis=1))
+
+        # Correlation over the valid units of each model
+        mod_0 = np.where(valid, mod, 0)
+        obs_0 = np.where(valid, obs, 0)
+        mod_a = np.where(valid, mod - (mod_0.sum(axis=1) / n)[:, None], 0)
+        obs_a = np.where(valid, obs - (obs_0.sum(axis=1) / n)[:, None], 0)
+        correlation = (mod_a * obs_a).sum(axis=1) / np.sqrt((mod_a**2).sum(axis=1) * (obs_a**2).sum(axis=1))
+
+    score = area_rmse if weights is not None else rmse
+    rank = pd.Series(score).rank(method='min', na_option='keep').to_numpy()
+    return {'n_units': n, 'bias': bias, 'rmse': rmse, 'area_rmse': area_rmse, 'correlation': correlation, 'rank': rank}
+
+
+def skill_table(models, statistics):
+    # Summary table of skill_statistics, best model first
+    table = pd.DataFrame({'model': list(models), **statistics}, columns=SKILL_COLUMNS)
+    return table.sort_values(['rank', 'model'], na_position='last').reset_index(drop=True)
+
+
+### Gravimetry
+def mascon_areas(obs_filename, loc, latitude, longitude, gsfc_cache_dir=None):
+    # Areas (km^2) of the compared mascons, checked against the comparison coordinates
+    gsfc = loadGsfcMascons(obs_filename, loc=loc, cache_dir=gsfc_cache_dir)
+    I_ = selectMascons(gsfc, loc)
+    if (int(np.sum(I_)) != len(latitude) or not np.allclose(gsfc.lat_centers[I_], latitude, atol=1e-4)
+            or not np.allclose(gsfc.lon_centers[I_], longitude, atol=1e-4)):
+        raise ValueError(f'Error: The mascons of the comparisons do not match the {loc} mascons of {obs_filename}.')
+    return np.asarray(gsfc.areas[I_], dtype=np.float64)
+
+
+def stack_comparisons(comp_filenames):
+    # The per-model comparison files of write_to_netcdf as one store-like dict of (model x mascon) arrays
+    comparisons = [read_comparison_netcdf(filename) for filename in comp_filenames]
+    if not comparisons:
+        raise ValueError('Error: No comparison files to stack.')
+    first = comparisons[0]
+    for filename, comparison in zip(comp_filenames, comparisons):
+        if (len(comparison['latitude_obs']) != len(first['latitude_obs'])
+                or not np.allclose(comparison['latitude_obs'], first['latitude_obs'], atol=1e-4)
+                or (comparison['start_date'], comparison['end_date']) != (first['start_date'], first['end_date'])):
+            raise ValueError(f'Error: {filename} does not compare the same mascons and dates as {comp_filenames[0]}.')
+    return {'model': [os.path.basename(f)[:-len('_mascon_comp.nc')] if f.endswith('_mascon_comp.nc')
+                      else os.path.splitext(os.path.basename(f))[0] for f in comp_filenames],
+            'latitude': first['latitude_obs'], 'longitude': first['longitude_obs'],
+            'mass_change_obs': first['mass_change_obs'],
+            'mass_change_mod': np.stack([c['mass_change_mod'] for c in comparisons]),
+            'mass_change_delta': np.stack([c['mass_change_delta'] for c in comparisons]),
+            'start_date': first['start_date'], 'end_date': first['end_date']}
+
+
+def gravimetry_skill(store, areas=None):
+    # Skill table of an ensemble store (read_ensemble_store or stack_comparisons)
+    return skill_table(store['model'], skill_statistics(store['mass_change_mod'], store['mass_change_obs'], areas))
+
+
+### IMBIE
+def imbie_skill(table, level=None):
+    # Skill table of an IMBIE ensemble table (imbie_ensemble.TABLE_COLUMNS). The units are the
+    # regions where the table has them (AIS), otherwise the ice sheet total.
+    if level is None:
+        level = 'region' if ((table['level'] == 'region') & (table['quantity'] == 'imbie_mass_change')).any() else 'total'
+    rows = table[table['level'] == level]
+    mod = rows[rows['quantity'] == 'model_mass_change'].pivot_table(index='model', columns='area', values='value_gt', aggfunc='first')
+    obs = rows[rows['quantity'] == 'imbie_mass_change'].pivot_table(index='model', columns='area', values='value_gt', aggfunc='first')
+    if obs.empty:
+        raise ValueError(f"Error: The table has no IMBIE values at the '{level}' level.")
+    mod, obs = mod.align(obs, join='inner')
+    return skill_table(mod.index, skill_statistics(mod.to_numpy(), obs.to_numpy()))
+
+
+def write_skill_table(table, csv_filename):
+    print(f"Writing skill statistics to CSV file: {csv_filename}")
+    table.to_csv(csv_filename, index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Skill statistics and ranking of a model ensemble.')
+    subparsers = parser.add_subparsers(dest='comparison', required=True)
+
+    gravimetry = subparsers.add_parser('gravimetry', help='gravimetry comparisons')
+    source = gravimetry.add_mutually_exclusive_group(required=True)
+    source.add_argument('--store', help='ensemble store of gravimetry_ensemble.py --store')
+    source.add_argument('--comparisons', nargs='+', help='per-model *_mascon_comp.nc files or glob templates')
+    gravimetry.add_argument('--obs', default=None, help='GSFC mascon solution (HDF5), for the area-weighted RMSE')
+    gravimetry.add_argument('--loc', default=None, choices=['GIS', 'AIS'])
+    gravimetry.add_argument('--gsfc-cache', default=None, help='directory for the memory-mapped GSFC cache')
+
+    imbie = subparsers.add_parser('imbie', help='IMBIE ensemble table')
+    imbie.add_argument('--table', required=True, help='CSV or Parquet table of imbie_ensemble.py')
+    imbie.add_argument('--level', default=None, choices=['region', 'total'])
+
+    for subparser in (gravimetry, imbie):
+        subparser.add_argument('--output', default=None, help='CSV file for the skill table')
+    args = parser.parse_args(argv)
+
+    if args.comparison == 'gravimetry':
+        if args.obs is not None and args.loc is None:
+            parser.error('--obs needs --loc')
+        if args.store is not None:
+            store = read_ensemble_store(args.store)
+        else:
+            comp_filenames = sorted(f for template in args.comparisons for f in glob.glob(template))
+            if not comp_filenames:
+                raise FileNotFoundError(f"No comparison files match: {' '.join(args.comparisons)}")
+            store = stack_comparisons(comp_filenames)
+        areas = None
+        if args.obs is not None:
+            areas = mascon_areas(args.obs, args.loc, store['latitude'], store['longitude'], args.gsfc_cache)
+        table = gravimetry_skill(store, areas)
+    else:
+        if args.table.endswith('.parquet'):
+            table = imbie_skill(pd.read_parquet(args.table), args.level)
+        else:
+            table = imbie_skill(pd.read_csv(args.table), args.level)
+
+    print(table.to_string(index=False))
+    if args.output is not None:
+        write_skill_table(table, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
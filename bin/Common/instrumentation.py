@@ -0,0 +1,184 @@
+import os,sys
+import csv
+import json
+import time
+import functools
+import contextlib
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Optional per-stage timing and memory instrumentation of the comparison pipelines.
+# The pipelines mark their stages with
+#
+#   with stage('projection'):
+#       ...
+#
+# or decorate whole functions with @instrumented('load_gsfc'). Stages are measured only inside a
+# recording, and recordings only after enable(); otherwise a stage costs one global lookup.
+# A runner collects the stages of each model with
+#
+#   enable()
+#   with recording(model=nc_filename) as record:
+#       compare_model(...)
+#   write_records([record], 'stages.json')
+#
+# Each stage records wall time, CPU time (of this process) and memory: with memory='rss' the
+# resident set size at the end of the stage and the peak of the process so far (Linux/macOS),
+# with memory='tracemalloc' the peak of Python and NumPy allocations within the stage, which
+# slows the run down noticeably but does not depend on the platform.
+
+# Columns of the CSV output
+RECORD_COLUMNS = ['model', 'stage', 'depth', 'wall_s', 'cpu_s', 'rss_mb', 'max_rss_mb', 'peak_traced_mb', 'error']
+
+# Settings of this process; None while disabled
+_settings = None
+
+# Stages of the current recording (None outside a recording), and the open stages (outermost first)
+_stages = None
+_open = []
+
+
+def enable(memory='rss'):
+    # memory: 'rss', 'tracemalloc' or None (timings only)
+    global _settings
+    if memory not in ('rss', 'tracemalloc', None):
+        raise ValueError(f"Error: memory must be 'rss', 'tracemalloc' or None, not '{memory}'.")
+    if memory == 'tracemalloc' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _settings = {'memory': memory}
+
+
+def disable():
+    global _settings
+    if _settings is not None and _settings['memory'] == 'tracemalloc' and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _settings = None
+
+
+def enabled():
+    return _settings is not None
+
+
+def _rss_mb():
+    # Current and peak resident set size of this process, MB (None where not available)
+    rss = max_rss = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        # ru_maxrss is in kB on Linux and in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    return rss, max_rss
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.depth = len(_open)
+        _open.append(self)
+        # Entries are listed in the order the stages start
+        self.entry = {'stage': '/'.join(s.name for s in _open), 'depth': self.depth}
+        _stages.append(self.entry)
+        if _settings['memory'] == 'tracemalloc':
+            # Peak of the enclosing stage so far, before the peak is reset for this one
+            self.child_peak = 0
+            if self.depth:
+                _open[-2].child_peak = max(_open[-2].child_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.wall_0 = time.perf_counter()
+        self.cpu_0 = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        entry = self.entry
+        entry.update(wall_s=time.perf_counter() - self.wall_0, cpu_s=time.process_time() - self.cpu_0)
+        if _settings['memory'] == 'rss':
+            entry['rss_mb'], entry['max_rss_mb'] = _rss_mb()
+        elif _settings['memory'] == 'tracemalloc':
+            peak = max(self.child_peak, tracemalloc.get_traced_memory()[1])
+            entry['peak_traced_mb'] = peak / 2**20
+            if self.depth:
+                _open[-2].child_peak = max(_open[-2].child_peak, peak)
+        if exc_type is not None:
+            entry['error'] = exc_type.__name__
+        _open.pop()
+        return False
+
+
+def stage(name):
+    # Context manager timing the enclosed block as the stage `name` (nested stages are named parent/child).
+    # Stages are only measured inside a recording.
+    if _stages is None:
+        return contextlib.nullcontext()
+    return _Stage(name)
+
+
+def instrumented(name=None):
+    # Decorator recording every call of a function as a stage (named after the function by default)
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _stages is None:
+                return function(*args, **kwargs)
+            with _Stage(stage_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def recording(**info):
+    # Collect the stages run in the block into a record: the info (e.g. model=...) and its 'stages'.
+    # The record is filled in even when the block raises.
+    global _stages
+    record = dict(info, stages=[])
+    if _settings is None:
+        yield record
+        return
+    previous, _stages = _stages, record['stages']
+    previous_open = _open[:]
+    del _open[:]
+    try:
+        with _Stage('total'):
+            yield record
+    finally:
+        _stages = previous
+        _open[:] = previous_open
+
+
+def write_records(records, filename):
+    # Records as JSON (one object per record), or as CSV (one row per stage) for a .csv filename
+    if os.path.splitext(filename)[1].lower() == '.csv':
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=RECORD_COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+            for record in records:
+                for entry in record['stages']:
+                    writer.writerow({'model': record.get('model'), **entry})
+    else:
+        with open(filename, 'w') as f:
+            json.dump(records, f, indent=1)
+    print(f'Stage timings written to {filename}')
+
+
+def print_record(record):
+    # Stage timings of one record as an indented table
+    print(f"Stages of {record.get('model', 'run')}:")
+    for entry in record['stages']:
+        memory = ''
+        if entry.get('max_rss_mb') is not None:
+            memory = f"  peak RSS {entry['max_rss_mb']:8.1f} MB"
+        elif 'peak_traced_mb' in entry:
+            memory = f"  peak {entry['peak_traced_mb']:8.1f} MB"
+        label = '  ' * entry['depth'] + entry['stage'].split('/')[-1]
+        print(f"  {label:<36s} {entry['wall_s']:9.3f} s wall {entry['cpu_s']:9.3f} s CPU{memory}")
@@ -0,0 +1,281 @@
+import os,sys
+import glob
+import json
+import time
+import fnmatch
+import sqlite3
+import hashlib
+import argparse
+import numpy as np
+import cftime
+from netCDF4 import Dataset
+
+from model_reader import to_model_time
+
+# Local metadata index of a model collection, so ensemble runs can choose their models without
+# opening every file on the (network-mounted) model directory.
+# Each file is opened once, and its grid (a fingerprint of the x/y coordinates, the shape, the
+# spacing and the coordinates themselves), calendar, time range and variables are kept in an
+# SQLite database, with the file's size and modification time. Later scans only stat the files
+# and re-read those that changed.
+#
+#   index = ModelIndex('~/.cache/cmct/models.sqlite')
+#   index.scan(['/home/jovyan/shared-public/CmCt/models/ISMIP6/lithk_AIS_*.nc'])
+#   selected, skipped = index.select(nc_filenames, 'lithk', '2007-01-01', '2014-01-01')
+#   for grid, filenames in index.grid_groups(selected).items():
+#       x, y = index.grid_coords(grid)
+#
+# Command line:
+#   python model_index.py models.sqlite --scan '/home/jovyan/shared-public/CmCt/models/ISMIP6/*.nc' --list
+
+MODEL_INDEX_VERSION = 1
+
+_COLUMNS = ['path', 'size', 'mtime_ns', 'indexed_at', 'error', 'variables', 'grid', 'nx', 'ny', 'dx', 'dy',
+            'x', 'y', 'calendar', 'time_units', 'n_times', 'time_min', 'time_max', 'first_date', 'last_date']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS models (
+    path TEXT PRIMARY KEY,
+    size INTEGER, mtime_ns INTEGER, indexed_at REAL,
+    error TEXT,
+    variables TEXT,
+    grid TEXT, nx INTEGER, ny INTEGER, dx REAL, dy REAL, x BLOB, y BLOB,
+    calendar TEXT, time_units TEXT, n_times INTEGER, time_min REAL, time_max REAL, first_date TEXT, last_date TEXT
+);
+CREATE INDEX IF NOT EXISTS models_grid ON models (grid);
+'''
+
+
+def coords_fingerprint(x, y):
+    # Identify a model grid by its x and y coordinates
+    h = hashlib.sha1()
+    for coords in (x, y):
+        h.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def _spacing(coords):
+    return float(np.median(np.diff(coords))) if len(coords) > 1 else None
+
+
+def read_model_metadata(nc_filename):
+    # Metadata of one model file; only the coordinate and time variables are read
+    metadata = {'error': None, 'variables': [], 'grid': None, 'nx': None, 'ny': None, 'dx': None, 'dy': None,
+                'x': None, 'y': None, 'calendar': None, 'time_units': None, 'n_times': None,
+                'time_min': None, 'time_max': None, 'first_date': None, 'last_date': None}
+    try:
+        with Dataset(nc_filename, 'r') as dataset:
+            metadata['variables'] = sorted(dataset.variables)
+            if 'x' in dataset.variables and 'y' in dataset.variables:
+                x = np.asarray(dataset['x'][:], dtype=np.float64)
+                y = np.asarray(dataset['y'][:], dtype=np.float64)
+                metadata.update(grid=coords_fingerprint(x, y), nx=len(x), ny=len(y), dx=_spacing(x), dy=_spacing(y),
+                                x=x.tobytes(), y=y.tobytes())
+            if 'time' in dataset.variables:
+                time_var = dataset['time']
+                times = np.asarray(time_var[:], dtype=np.float64)
+                calendar = getattr(time_var, 'calendar', 'standard')
+                metadata.update(calendar=calendar, time_units=getattr(time_var, 'units', None), n_times=len(times))
+                if len(times) and metadata['time_units'] is not None:
+                    first, last = cftime.num2date([times.min(), times.max()], metadata['time_units'], calendar=calendar)
+                    metadata.update(time_min=float(times.min()), time_max=float(times.max()),
+                                    first_date=str(first), last_date=str(last))
+    except Exception as error:
+        metadata['error'] = f'{type(error).__name__}: {error}'
+    metadata['variables'] = json.dumps(metadata['variables'])
+    return metadata
+
+
+class ModelIndex:
+    def __init__(self, db_filename):
+        self.db_filename = os.path.expanduser(db_filename)
+        directory = os.path.dirname(os.path.abspath(self.db_filename))
+        os.makedirs(directory, exist_ok=True)
+        # Several runs may share an index; writers wait for each other rather than fail
+        self.connection = sqlite3.connect(self.db_filename, timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        self._check_version()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _check_version(self):
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value TEXT)')
+            row = self.connection.execute("SELECT value FROM info WHERE name = 'version'").fetchone()
+            if row is None or int(row['value']) != MODEL_INDEX_VERSION:
+                # An index of another version is rebuilt from the files
+                self.connection.execute('DROP TABLE IF EXISTS models')
+                self.connection.execute("INSERT OR REPLACE INTO info VALUES ('version', ?)", (str(MODEL_INDEX_VERSION),))
+            self.connection.executescript(_SCHEMA)
+
+    ### Updates
+    def update(self, filenames):
+        # Index the files that are new or changed since they were last indexed, and forget those
+        # that no longer exist. Returns the number of files in each case.
+        counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'removed': 0, 'unreadable': 0}
+        for filename in filenames:
+            path = os.path.abspath(filename)
+            row = self.connection.execute('SELECT size, mtime_ns FROM models WHERE path = ?', (path,)).fetchone()
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                if row is not None:
+                    self.remove([path])
+                    counts['removed'] += 1
+                continue
+            if row is not None and (row['size'], row['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+                counts['unchanged'] += 1
+                continue
+
+            metadata = read_model_metadata(path)
+            counts['changed' if row is not None else 'new'] += 1
+            if metadata['error'] is not None:
+                counts['unreadable'] += 1
+            entry = dict(metadata, path=path, size=stat.st_size, mtime_ns=stat.st_mtime_ns, indexed_at=time.time())
+            with self.connection:
+                self.connection.execute(f"INSERT OR REPLACE INTO models ({', '.join(_COLUMNS)}) "
+                                        f"VALUES ({', '.join('?' * len(_COLUMNS))})", [entry[c] for c in _COLUMNS])
+        return counts
+
+    def scan(self, templates):
+        # Index every file matching the glob templates; entries of files that matched a template
+        # before but are gone now are removed. Returns the matching files, sorted.
+        templates = [os.path.abspath(os.path.expanduser(t)) for t in templates]
+        filenames = sorted({f for template in templates for f in glob.glob(template)})
+        counts = self.update(filenames)
+        current = set(filenames)
+        stale = [path for path in self.paths() if path not in current and any(fnmatch.fnmatch(path, t) for t in templates)]
+        self.remove(stale)
+        counts['removed'] += len(stale)
+        print(f"Indexed {len(filenames)} model files: {counts['new']} new, {counts['changed']} changed, "
+              f"{counts['unchanged']} unchanged, {counts['removed']} removed, {counts['unreadable']} unreadable.")
+        return filenames
+
+    def remove(self, paths):
+        with self.connection:
+            self.connection.executemany('DELETE FROM models WHERE path = ?', [(os.path.abspath(p),) for p in paths])
+
+    ### Queries
+    def paths(self):
+        return [row['path'] for row in self.connection.execute('SELECT path FROM models ORDER BY path')]
+
+    def get(self, filename):
+        # Metadata of an indexed file as a dict (variables as a list, without the coordinates), or None
+        row = self.connection.execute('SELECT * FROM models WHERE path = ?', (os.path.abspath(filename),)).fetchone()
+        if row is None:
+            return None
+        entry = {c: row[c] for c in _COLUMNS if c not in ('x', 'y')}
+        entry['variables'] = json.loads(entry['variables'])
+        return entry
+
+    def eligibility(self, filename, var_name='lithk', start_date=None, end_date=None):
+        # None if the file can be compared, as far as its metadata shows, otherwise the reason why not
+        entry = self.get(filename)
+        if entry is None:
+            return 'not indexed'
+        if entry['error'] is not None:
+            return f"unreadable ({entry['error']})"
+        if var_name is not None and var_name not in entry['variables']:
+            return f'no {var_name} variable'
+        if entry['grid'] is None:
+            return 'no x/y coordinates'
+        dates = [d for d in (start_date, end_date) if d is not None]
+        if dates:
+            if entry['time_min'] is None:
+                return 'no time axis'
+            # The same calendar conversion as ModelReader.check_datarange
+            t = to_model_time(dates, entry['time_units'], entry['calendar'])
+            if not ((t >= entry['time_min']) & (t <= entry['time_max'])).all():
+                return f"dates out of range; model data time range is from {entry['first_date']} to {entry['last_date']}"
+        return None
+
+    def select(self, filenames, var_name='lithk', start_date=None, end_date=None):
+        # (selected, skipped) files: those that can be compared, grouped by grid, and (filename, reason) of the others
+        selected, skipped = [], []
+        for filename in filenames:
+            reason = self.eligibility(filename, var_name, start_date, end_date)
+            if reason is None:
+                selected.append(filename)
+            else:
+                skipped.append((filename, reason))
+        grid_order = {f: i for i, filenames in enumerate(self.grid_groups(selected).values()) for f in filenames}
+        selected.sort(key=lambda f: grid_order[f])
+        return selected, skipped
+
+    def grid_groups(self, filenames):
+        # {grid fingerprint: filenames} of the indexed files, in order of first appearance
+        groups = {}
+        for filename in filenames:
+            entry = self.get(filename)
+            grid = None if entry is None else entry['grid']
+            groups.setdefault(grid, []).append(filename)
+        return groups
+
+    def grid_coords(self, grid):
+        # x and y coordinates of a grid, from any file indexed on it
+        row = self.connection.execute('SELECT x, y FROM models WHERE grid = ? LIMIT 1', (grid,)).fetchone()
+        if row is None:
+            raise KeyError(f'Error: No indexed model file is on the grid {grid}.')
+        return np.frombuffer(row['x'], dtype=np.float64), np.frombuffer(row['y'], dtype=np.float64)
+
+
+def select_models(index_filename, nc_filenames, var_name='lithk', start_date=None, end_date=None):
+    # Bring the index up to date for nc_filenames, then keep the files that can be compared,
+    # grouped by grid. Skipped files are reported here.
+    with ModelIndex(index_filename) as index:
+        index.update(nc_filenames)
+        selected, skipped = index.select(nc_filenames, var_name, start_date, end_date)
+    for filename, reason in skipped:
+        print(f'Skipped: {filename} ({reason})')
+    return selected
+
+
+def print_index(index, filenames=None):
+    # One line per grid, then its files with their time range
+    filenames = index.paths() if filenames is None else filenames
+    for grid, group in index.grid_groups(filenames).items():
+        entry = index.get(group[0])
+        if grid is None:
+            print(f'No grid ({len(group)} files):')
+        else:
+            print(f"Grid {grid[:12]}: {entry['nx']} x {entry['ny']}, spacing {entry['dx']} x {entry['dy']} ({len(group)} files)")
+        for filename in group:
+            entry = index.get(filename)
+            if entry is None:
+                print(f'  {filename}: not indexed')
+            elif entry['error'] is not None:
+                print(f"  {filename}: {entry['error']}")
+            else:
+                print(f"  {filename}: {entry['calendar']} {entry['first_date']} to {entry['last_date']}, "
+                      f"{entry['n_times']} times, {', '.join(entry['variables'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Metadata index of a model collection.')
+    parser.add_argument('index', help='SQLite index file')
+    parser.add_argument('--scan', nargs='+', default=None, help='model NetCDF glob templates to (re)index')
+    parser.add_argument('--list', action='store_true', help='list the indexed files by grid')
+    parser.add_argument('--var', default='lithk', help='variable the models must have')
+    parser.add_argument('--start', default=None, help='list only models covering this date, YYYY-MM-DD')
+    parser.add_argument('--end', default=None, help='list only models covering this date, YYYY-MM-DD')
+    args = parser.parse_args(argv)
+
+    with ModelIndex(args.index) as index:
+        filenames = index.scan(args.scan) if args.scan else index.paths()
+        if args.start is not None or args.end is not None:
+            filenames, skipped = index.select(filenames, args.var, args.start, args.end)
+            print(f'{len(filenames)} models cover the dates, {len(skipped)} do not.')
+        if args.list:
+            print_index(index, filenames)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
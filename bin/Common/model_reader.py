@@ -0,0 +1,173 @@
+import datetime
+import contextlib
+import numpy as np
+import cftime
+from netCDF4 import Dataset
+
+import staging
+
+# Reader for ice sheet model output (e.g. ISMIP6 lithk files) used by the gravimetry and IMBIE comparisons.
+# The time axis and calendar are read once; a field at a requested date is linearly
+# interpolated from the two bracketing time slices, which are the only data read from disk.
+# Files are opened through staging.local_path, so they are read from a local copy when staging is configured.
+
+
+# Parse the date types used by the comparisons into (year, month, day, hour, minute, second)
+def _date_fields(date):
+    if isinstance(date, str):
+        date = datetime.datetime.strptime(date, '%Y-%m-%d')
+    elif isinstance(date, np.datetime64):
+        date = date.astype('datetime64[s]').item()
+    return (date.year, date.month, date.day, getattr(date, 'hour', 0), getattr(date, 'minute', 0), getattr(date, 'second', 0))
+
+
+# Numeric times of dates (strings 'YYYY-MM-DD', datetimes or np.datetime64) in a model's time units and calendar
+def to_model_time(dates, time_units, calendar):
+    model_dates = []
+    for date in np.atleast_1d(np.asarray(dates, dtype=object)):
+        year, month, day, hour, minute, second = _date_fields(date)
+        if calendar == '360_day' and day > 30:
+            # In a 360-day calendar, each month has only 30 days.
+            day = 30
+        model_dates.append(cftime.datetime(year, month, day, hour, minute, second, calendar=calendar))
+    return np.asarray(cftime.date2num(model_dates, time_units, calendar=calendar), dtype=np.float64)
+
+
+class ModelReader:
+    def __init__(self, nc_filename, var_name='lithk', slice_cache=4, io_lock=None):
+        # io_lock: a lock held around every read, for a reader shared with other threads doing netCDF I/O
+        self.nc_filename = nc_filename
+        self.var_name = var_name
+        self._io_lock = contextlib.nullcontext() if io_lock is None else io_lock
+        self.dataset = Dataset(staging.local_path(nc_filename, var_name), 'r')
+
+        try:
+            self.var = self.dataset[var_name]
+        except IndexError:
+            self.dataset.close()
+            raise KeyError(f'Error: {var_name} variable expected but not found in model.')
+
+        # Resolve the calendar once; requested dates are converted to the file's numeric time
+        time_var = self.dataset['time']
+        self.time_units = time_var.units
+        self.calendar = getattr(time_var, 'calendar', 'standard')
+        self.times = np.asarray(time_var[:], dtype=np.float64)
+
+        self.x = np.asarray(self.dataset['x'][:], dtype=np.float64)
+        self.y = np.asarray(self.dataset['y'][:], dtype=np.float64)
+
+        self.time_axis = self.var.dimensions.index('time')
+        self._tune_chunk_cache()
+
+        # Most recently read slices, so start and end dates sharing a slice read it once
+        self._slice_cache = {}
+        self._slice_cache_size = slice_cache
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._io_lock:
+            self.dataset.close()
+
+    def _tune_chunk_cache(self):
+        # Let the HDF5 chunk cache hold every chunk of two consecutive time slabs,
+        # so reading the second slice of a bracket never decompresses a chunk twice.
+        chunking = self.var.chunking()
+        if chunking == 'contiguous' or chunking is None:
+            return
+        shape = self.var.shape
+        chunks_per_slab = 1
+        for axis, (n, c) in enumerate(zip(shape, chunking)):
+            if axis != self.time_axis:
+                chunks_per_slab *= -(-n // c)
+        chunk_bytes = int(np.prod(chunking)) * self.var.dtype.itemsize
+        size, nelems, preemption = self.var.get_var_chunk_cache()
+        self.var.set_var_chunk_cache(size=max(size, 2 * chunks_per_slab * chunk_bytes),
+                                     nelems=max(nelems, 2 * chunks_per_slab + 1),
+                                     preemption=preemption)
+
+    def to_model_time(self, dates):
+        return to_model_time(dates, self.time_units, self.calendar)
+
+    def time_range(self):
+        return (cftime.num2date(self.times.min(), self.time_units, calendar=self.calendar),
+                cftime.num2date(self.times.max(), self.time_units, calendar=self.calendar))
+
+    def in_range(self, dates):
+        t = self.to_model_time(dates)
+        return (t >= self.times.min()) & (t <= self.times.max())
+
+    ### Check the selected dates are within the range of model data
+    def check_datarange(self, start_date, end_date):
+        if self.in_range([start_date, end_date]).all():
+            print(f"The selected dates {start_date} and {end_date} are within the range of the model data.")
+        else:
+            min_time, max_time = self.time_range()
+            raise ValueError(f"Error: The selected dates {start_date} or {end_date} are out of range. Model data time range is from {min_time} to {max_time}.")
+
+    def bracket(self, dates):
+        # Indices of the time slices before and after each date, and the weight of the later one
+        t = self.to_model_time(dates)
+        if not ((t >= self.times[0]) & (t <= self.times[-1])).all():
+            min_time, max_time = self.time_range()
+            raise ValueError(f"Error: The selected dates are out of range. Model data time range is from {min_time} to {max_time}.")
+
+        if len(self.times) == 1:
+            zeros = np.zeros(len(t), dtype=int)
+            return zeros, zeros, np.zeros(len(t))
+
+        i_0 = np.clip(np.searchsorted(self.times, t, side='right') - 1, 0, len(self.times) - 2)
+        i_1 = i_0 + 1
+        weight = (t - self.times[i_0]) / (self.times[i_1] - self.times[i_0])
+        return i_0, i_1, weight
+
+    def read_slices(self, start, stop):
+        # Time slices start..stop-1 as a (time, ...) array, missing values as NaN.
+        # Floating point data keeps its precision; anything else is read as float32.
+        index = [slice(None)] * self.var.ndim
+        index[self.time_axis] = slice(start, stop)
+        with self._io_lock:
+            data = np.ma.asarray(self.var[tuple(index)])
+        dtype = data.dtype if data.dtype.kind == 'f' else np.float32
+        data = np.ma.filled(data.astype(dtype), np.nan)
+        return np.moveaxis(data, self.time_axis, 0)
+
+    def read_slice(self, i):
+        i = int(i)
+        if i not in self._slice_cache:
+            if len(self._slice_cache) >= self._slice_cache_size:
+                self._slice_cache.pop(next(iter(self._slice_cache)))
+            self._slice_cache[i] = self.read_slices(i, i + 1)[0]
+        return self._slice_cache[i]
+
+    def prefetch(self, dates):
+        # Read the slices interp() needs for dates into the slice cache (e.g. on a prefetch thread);
+        # dates out of range are left for check_datarange to report
+        if not self.in_range(dates).all():
+            return
+        i_0, i_1, weight = self.bracket(dates)
+        needed = set(i_0[weight < 1]) | set(i_1[weight > 0])
+        self._slice_cache_size = max(self._slice_cache_size, len(needed))
+        for i in sorted(needed):
+            self.read_slice(i)
+
+    def interp(self, date, dtype=np.float32):
+        # Field at date, linearly interpolated in time between the bracketing slices
+        i_0, i_1, weight = self.bracket([date])
+        i_0, i_1, weight = i_0[0], i_1[0], weight[0]
+        if weight == 0:
+            return self.read_slice(i_0).astype(dtype)
+        if weight == 1:
+            return self.read_slice(i_1).astype(dtype)
+        field_0 = self.read_slice(i_0).astype(np.float64)
+        return (field_0 + weight * (self.read_slice(i_1) - field_0)).astype(dtype, copy=False)
+
+    def lithk_delta(self, start_date, end_date):
+        # Change of the variable between two dates as float32; reads at most four 2-D slices.
+        # The interpolation and difference are done in float64 before the change is rounded.
+        delta = self.interp(end_date, np.float64) - self.interp(start_date, np.float64)
+        return delta.astype(np.float32)
@@ -0,0 +1,157 @@
+import queue
+import threading
+import traceback
+
+from model_reader import ModelReader
+
+# Pipelined ensemble loop: while one model is computed, a prefetch thread opens the next models
+# and reads the time slices they need, and a writer thread writes the results of the previous ones,
+# so reading, computing and writing overlap instead of taking turns.
+#
+#   for result in run_pipeline(nc_filenames, open_model, compute, write, depth=2):
+#       print(result['model'], result['status'])
+#
+# open_model(item) runs on the prefetch thread, compute(item, loaded) on the calling thread and
+# write(item, output) on the writer thread; close(loaded) releases what open_model returned.
+# At most `depth` models are loaded ahead and `write_depth` results wait to be written, so the
+# memory used is bounded (with ModelReaders, by the bracketing slices of depth + 1 models).
+#
+# The netCDF and HDF5 libraries are not thread-safe, so every call into them from the pipeline
+# threads is made holding netcdf_lock. netCDF4 releases the GIL during its I/O, so the
+# computation still runs while a file is read or written.
+
+netcdf_lock = threading.RLock()
+
+# Marks the end of a queue
+_DONE = object()
+
+
+def prefetch_model(nc_filename, dates, var_name='lithk'):
+    # Open a model and read the slices bracketing dates (opener for run_pipeline). The reader holds
+    # netcdf_lock for any further reads and for closing, so it can be used on the other threads.
+    with netcdf_lock:
+        model = ModelReader(nc_filename, var_name, io_lock=netcdf_lock)
+    try:
+        model.prefetch(dates)
+    except Exception:
+        model.close()
+        raise
+    return model
+
+
+def close_model(model):
+    model.close()
+
+
+def _failed(item, error):
+    return {'model': item, 'status': 'failed', 'output': None,
+            'error': f'{type(error).__name__}: {error}', 'traceback': traceback.format_exc()}
+
+
+def run_pipeline(items, open_model, compute, write=None, close=None, depth=2, write_depth=2):
+    """
+    Run open_model, compute and write for every item, overlapped (see above). Yields one result dict
+    per item, in input order, once it is written: 'model' (the item), 'status' ('ok' or 'failed'),
+    'output' (the return value of write, or of compute without write) or the 'error' message.
+    A failure in any step fails only its own item.
+    """
+    if depth < 1 or write_depth < 1:
+        raise ValueError('Error: The pipeline depths must be at least 1.')
+    loaded_queue = queue.Queue(maxsize=depth)
+    write_queue = queue.Queue(maxsize=write_depth)
+    done_queue = queue.Queue()
+    stop = threading.Event()
+
+    def put(q, entry):
+        # Blocks while the queue is full (the backpressure), until the pipeline is stopped
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def prefetcher():
+        for item in items:
+            try:
+                entry = (item, open_model(item), None)
+            except Exception as error:
+                entry = (item, None, _failed(item, error))
+            if not put(loaded_queue, entry):
+                if entry[1] is not None and close is not None:
+                    close(entry[1])
+                return
+        put(loaded_queue, _DONE)
+
+    def writer():
+        while True:
+            entry = write_queue.get()
+            if entry is _DONE:
+                break
+            item, output, result = entry
+            if result is None:
+                try:
+                    result = {'model': item, 'status': 'ok', 'output': write(item, output) if write is not None else output,
+                              'error': None}
+                except Exception as error:
+                    result = _failed(item, error)
+            done_queue.put(result)
+        done_queue.put(_DONE)
+
+    threads = [threading.Thread(target=prefetcher, name='pipeline-prefetch', daemon=True),
+               threading.Thread(target=writer, name='pipeline-writer', daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    def drain():
+        # Results already written, without waiting
+        while True:
+            try:
+                result = done_queue.get_nowait()
+            except queue.Empty:
+                return
+            yield result
+
+    finished = False
+    try:
+        while True:
+            entry = loaded_queue.get()
+            if entry is _DONE:
+                break
+            item, loaded, result = entry
+            output = None
+            if result is None:
+                try:
+                    output = compute(item, loaded)
+                except Exception as error:
+                    result = _failed(item, error)
+                finally:
+                    if close is not None:
+                        close(loaded)
+            write_queue.put((item, output, result))
+            for result in drain():
+                yield result
+
+        write_queue.put(_DONE)
+        while True:
+            result = done_queue.get()
+            if result is _DONE:
+                break
+            yield result
+        finished = True
+    finally:
+        if not finished:
+            # Stopped early: let the threads finish what they hold, and release the loaded models
+            stop.set()
+            threads[0].join()
+            while True:
+                try:
+                    entry = loaded_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is not _DONE and entry[1] is not None and close is not None:
+                    close(entry[1])
+            write_queue.put(_DONE)
+        for thread in threads:
+            thread.join()
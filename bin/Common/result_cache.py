@@ -0,0 +1,271 @@
+import os,sys
+import json
+import time
+import pickle
+import hashlib
+import argparse
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# On-disk cache of comparison results, shared by the gravimetry and IMBIE comparisons.
+# Results are stored by a key made from content hashes of the input files and the parameters of
+# the call, so re-running a comparison with the same inputs returns the stored result at once,
+# whatever the file is called or wherever it is, and a file that changes is never served stale.
+# The cache has a size limit; the least recently used results are removed first.
+#
+#   cache = ResultCache('~/.cache/cmct/results', max_bytes=20 * 2**30)
+#   basin_result = process_model_data(..., result_cache=cache)
+#   cache.print_stats()
+#
+# Hashing a file reads all of it once; the digest is then remembered (in digests.json) for as
+# long as the file keeps its path, size and modification time.
+
+RESULT_CACHE_VERSION = 1
+
+# Default size limit of a cache, bytes
+DEFAULT_MAX_BYTES = 10 * 2**30
+
+# Block size for hashing files
+HASH_BLOCK_SIZE = 2**22
+
+
+def _hash_value(h, value):
+    # Feed a parameter value into a hash, unambiguously for the types the comparisons use
+    if isinstance(value, np.ndarray):
+        h.update(f'ndarray{value.dtype.str}{value.shape}'.encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        h.update(b'dict')
+        for k in sorted(value, key=str):
+            _hash_value(h, str(k))
+            _hash_value(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            _hash_value(h, item)
+    elif isinstance(value, (np.generic, float, int, bool, str, bytes, type(None))):
+        h.update(f'{type(value).__name__}:{value!r}'.encode())
+    else:
+        raise ValueError(f'Error: Cannot use a {type(value).__name__} in a result cache key.')
+    h.update(b';')
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(self.cache_dir, 'results'), exist_ok=True)
+        self._digests = None
+
+        # Statistics of this process; stats() adds those of all processes using the cache
+        self.session = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'saved_seconds': 0.0}
+
+    ### Keys
+    def file_digest(self, filename):
+        # sha256 of the contents of a file, remembered by path, size and modification time
+        path = os.path.abspath(os.path.expanduser(filename))
+        stat = os.stat(path)
+        identity = [stat.st_size, stat.st_mtime_ns]
+        digests = self._load_digests()
+        if digests.get(path, {}).get('identity') == identity:
+            return digests[path]['sha256']
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                h.update(block)
+        digest = h.hexdigest()
+
+        with self._locked():
+            digests = self._load_digests(reload=True)
+            digests[path] = {'identity': identity, 'sha256': digest}
+            self._write_json('digests.json', digests)
+        return digest
+
+    def key(self, name, files=(), params=None):
+        # Key of a call of the function `name` on the input files with the given parameters
+        h = hashlib.sha256()
+        _hash_value(h, [RESULT_CACHE_VERSION, name])
+        _hash_value(h, [self.file_digest(filename) for filename in files])
+        _hash_value(h, params or {})
+        return h.hexdigest()
+
+    ### Results
+    def _result_path(self, key):
+        return os.path.join(self.cache_dir, 'results', key[:2], key + '.pkl')
+
+    def get(self, key):
+        # (True, result) for a stored result, (False, None) otherwise
+        path = self._result_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self._count(misses=1)
+            return False, None
+
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._count(hits=1, saved_seconds=entry['seconds'])
+        return True, entry['result']
+
+    def put(self, key, result, seconds=0.0):
+        # Store a result, with the time it took to compute, then evict down to the size limit
+        path = self._result_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write under a temporary name first so concurrent runs never read a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'result': result, 'seconds': seconds}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self._count(stores=1)
+        self.evict()
+
+    def call(self, name, files, params, function, *args, **kwargs):
+        # function(*args, **kwargs), or its stored result for the same files and parameters
+        key = self.key(name, files, params)
+        found, result = self.get(key)
+        if found:
+            return result
+        t0 = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.put(key, result, time.perf_counter() - t0)
+        return result
+
+    def entries(self):
+        # (last use, size, path) of every stored result, least recently used first
+        entries = []
+        for root, _, filenames in os.walk(os.path.join(self.cache_dir, 'results')):
+            for filename in filenames:
+                if filename.endswith('.pkl'):
+                    path = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self, max_bytes=None):
+        # Remove the least recently used results until the cache fits in max_bytes
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                evicted += 1
+            except OSError:
+                pass
+            total -= size
+        if evicted:
+            self._count(evictions=evicted)
+        return evicted
+
+    def clear(self):
+        return self.evict(0)
+
+    ### Statistics
+    def _count(self, **counts):
+        for name, value in counts.items():
+            self.session[name] += value
+        with self._locked():
+            stats = self._read_json('stats.json')
+            for name, value in counts.items():
+                stats[name] = stats.get(name, 0) + value
+            self._write_json('stats.json', stats)
+
+    def stats(self):
+        # Totals over all uses of the cache directory, and the current contents
+        totals = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'saved_seconds': 0.0}
+        totals.update(self._read_json('stats.json'))
+        entries = self.entries()
+        lookups = totals['hits'] + totals['misses']
+        return {**totals,
+                'hit_rate': totals['hits'] / lookups if lookups else 0.0,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes,
+                'session': dict(self.session)}
+
+    def print_stats(self):
+        stats = self.stats()
+        print(f"Result cache {self.cache_dir}: {stats['entries']} results, "
+              f"{stats['bytes'] / 2**20:.1f} of {stats['max_bytes'] / 2**20:.0f} MB")
+        print(f"  {stats['hits']} hits, {stats['misses']} misses (hit rate {stats['hit_rate']:.0%}), "
+              f"{stats['evictions']} evicted, {stats['saved_seconds']:.1f} s of computation saved")
+        session = stats['session']
+        print(f"  this session: {session['hits']} hits, {session['misses']} misses, "
+              f"{session['saved_seconds']:.1f} s saved")
+
+    ### Bookkeeping files
+    def _read_json(self, name):
+        try:
+            with open(os.path.join(self.cache_dir, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_json(self, name, data):
+        path = os.path.join(self.cache_dir, name)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _load_digests(self, reload=False):
+        if self._digests is None or reload:
+            self._digests = self._read_json('digests.json')
+        return self._digests
+
+    def _locked(self):
+        # Serialise updates of the bookkeeping files between processes, where the platform allows
+        return _FileLock(os.path.join(self.cache_dir, '.lock'))
+
+
+class _FileLock:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.filename, 'a')
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show the statistics of a comparison result cache.')
+    parser.add_argument('cache_dir')
+    parser.add_argument('--max-gb', type=float, default=DEFAULT_MAX_BYTES / 2**30, help='size limit, GB')
+    parser.add_argument('--evict', action='store_true', help='evict down to the size limit')
+    parser.add_argument('--clear', action='store_true', help='remove all stored results')
+    args = parser.parse_args(argv)
+
+    cache = ResultCache(args.cache_dir, int(args.max_gb * 2**30))
+    if args.clear:
+        print(f'Removed {cache.clear()} results.')
+    elif args.evict:
+        print(f'Removed {cache.evict()} results.')
+    cache.print_stats()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
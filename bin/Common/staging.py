@@ -0,0 +1,234 @@
+import os,sys
+import json
+import shutil
+import hashlib
+import argparse
+from netCDF4 import Dataset
+
+# Local staging of model files from the shared (network-mounted) model directory.
+# A model file is copied to a local scratch directory the first time it is read, so later
+# reads in this run and in later or concurrent runs hit the local disk. With extract=True only
+# the compared variable and the time/x/y coordinates are staged, which for multi-variable files is
+# much less to copy and to keep. A staged copy is used only while the source keeps the size and
+# modification time it had when it was copied. The scratch directory has a size limit; the least
+# recently used copies are removed first.
+#
+# ModelReader opens every model file through local_path(), so the gravimetry and IMBIE
+# comparisons use the staged copies once staging is configured in the process:
+#
+#   staging.configure('/scratch/cmct_models', max_bytes=200 * 2**30)
+#   with ModelReader(nc_filename) as model:      # reads the local copy
+#       ...
+#
+# Each staged file has a .json sidecar with its source path, size and modification time.
+
+STAGING_VERSION = 1
+
+# Default size limit of a staging directory, bytes
+DEFAULT_MAX_BYTES = 100 * 2**30
+
+# Coordinates staged with the compared variable when extracting
+EXTRACT_COORDINATES = ['time', 'x', 'y']
+
+
+def extract_variables(src_filename, dst_filename, variables):
+    # Copy the variables (with their attributes, dimensions, chunking and compression) and the
+    # global attributes of a NetCDF file to a new file, one time slice at a time
+    with Dataset(src_filename, 'r') as src, Dataset(dst_filename, 'w', format='NETCDF4') as dst:
+        dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+        names = [name for name in variables if name in src.variables]
+        dimensions = {dim for name in names for dim in src[name].dimensions}
+        for dim in src.dimensions.values():
+            if dim.name in dimensions:
+                dst.createDimension(dim.name, None if dim.isunlimited() else len(dim))
+
+        for name in names:
+            var = src[name]
+            var.set_auto_maskandscale(False)
+            filters = var.filters() or {}
+            chunking = var.chunking()
+            attributes = {a: var.getncattr(a) for a in var.ncattrs() if a != '_FillValue'}
+            out = dst.createVariable(name, var.datatype, var.dimensions,
+                                     zlib=bool(filters.get('zlib')), complevel=filters.get('complevel', 4),
+                                     shuffle=bool(filters.get('shuffle')),
+                                     chunksizes=None if chunking in ('contiguous', None) else chunking,
+                                     fill_value=getattr(var, '_FillValue', None))
+            out.set_auto_maskandscale(False)
+            out.setncatts(attributes)
+            if var.ndim == 0:
+                out.assignValue(var.getValue())
+            elif var.ndim == 1 or var.shape[0] == 0:
+                out[:] = var[:]
+            else:
+                for i in range(var.shape[0]):
+                    out[i] = var[i]
+
+
+class ModelStage:
+    def __init__(self, stage_dir, max_bytes=DEFAULT_MAX_BYTES, extract=False):
+        self.stage_dir = os.path.expanduser(stage_dir)
+        self.max_bytes = max_bytes
+        self.extract = extract
+        os.makedirs(self.stage_dir, exist_ok=True)
+
+        # Statistics of this process
+        self.session = {'hits': 0, 'misses': 0, 'bytes_staged': 0, 'evictions': 0}
+
+    def _staged_filename(self, source, variables):
+        # Copies of the same file with different variables are kept apart
+        h = hashlib.sha1(json.dumps([STAGING_VERSION, source, variables]).encode()).hexdigest()[:16]
+        return os.path.join(self.stage_dir, f'{h}_{os.path.basename(source)}')
+
+    def _is_current(self, staged_filename, source_stat):
+        # The staged copy is complete and its source is unchanged since it was made
+        try:
+            with open(staged_filename + '.json') as f:
+                sidecar = json.load(f)
+            staged_size = os.path.getsize(staged_filename)
+        except (OSError, ValueError):
+            return False
+        return (sidecar.get('size'), sidecar.get('mtime_ns'), sidecar.get('staged_size')) == \
+               (source_stat.st_size, source_stat.st_mtime_ns, staged_size)
+
+    def local_path(self, nc_filename, var_name='lithk'):
+        # Local copy of nc_filename, staged now if there is no current one.
+        # Falls back to the source file if it cannot be staged.
+        source = os.path.abspath(nc_filename)
+        source_stat = os.stat(source)
+        variables = [var_name] + EXTRACT_COORDINATES if self.extract else None
+        staged_filename = self._staged_filename(source, variables)
+
+        if self._is_current(staged_filename, source_stat):
+            # Mark as recently used
+            try:
+                os.utime(staged_filename)
+            except OSError:
+                pass
+            self.session['hits'] += 1
+            return staged_filename
+
+        self.session['misses'] += 1
+        if not self.extract and source_stat.st_size > self.max_bytes:
+            return source
+        try:
+            self._stage(source, source_stat, staged_filename, variables)
+        except Exception as error:
+            print(f'Error: Staging {nc_filename} failed, reading it from its source. {type(error).__name__}: {error}')
+            return source
+        self.evict(keep=staged_filename)
+        return staged_filename
+
+    def _stage(self, source, source_stat, staged_filename, variables):
+        # Copy under temporary names first, so concurrent runs never read a partial file
+        tmp_filename = f'{staged_filename}.{os.getpid()}.tmp'
+        try:
+            if variables is None:
+                shutil.copyfile(source, tmp_filename)
+            else:
+                extract_variables(source, tmp_filename, variables)
+            staged_size = os.path.getsize(tmp_filename)
+            with open(tmp_filename + '.json', 'w') as f:
+                json.dump({'source': source, 'size': source_stat.st_size, 'mtime_ns': source_stat.st_mtime_ns,
+                           'staged_size': staged_size, 'variables': variables}, f)
+            os.replace(tmp_filename, staged_filename)
+            os.replace(tmp_filename + '.json', staged_filename + '.json')
+        finally:
+            for filename in (tmp_filename, tmp_filename + '.json'):
+                if os.path.exists(filename):
+                    os.remove(filename)
+        self.session['bytes_staged'] += staged_size
+
+    def entries(self):
+        # (last use, size, path) of every staged file, least recently used first
+        entries = []
+        for filename in os.listdir(self.stage_dir):
+            if filename.endswith('.json') or filename.endswith('.tmp'):
+                continue
+            path = os.path.join(self.stage_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self, max_bytes=None, keep=None):
+        # Remove the least recently used copies (but not keep) until the directory fits in max_bytes.
+        # A copy another process has open stays readable by it until closed.
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            if path == keep:
+                continue
+            for filename in (path + '.json', path):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            evicted += 1
+            total -= size
+        self.session['evictions'] += evicted
+        return evicted
+
+    def clear(self):
+        return self.evict(0)
+
+    def print_stats(self):
+        entries = self.entries()
+        print(f"Model staging {self.stage_dir}: {len(entries)} files, "
+              f"{sum(size for _, size, _ in entries) / 2**30:.2f} of {self.max_bytes / 2**30:.2f} GB")
+        session = self.session
+        print(f"  this session: {session['hits']} hits, {session['misses']} misses, "
+              f"{session['bytes_staged'] / 2**20:.1f} MB staged, {session['evictions']} evicted")
+
+
+# Staging of this process; None reads the model files from their source
+_stage = None
+
+
+def configure(stage_dir=None, max_bytes=DEFAULT_MAX_BYTES, extract=False):
+    # Stage the model files this process reads in stage_dir; stage_dir=None turns staging off
+    global _stage
+    _stage = None if stage_dir is None else ModelStage(stage_dir, max_bytes, extract)
+    return _stage
+
+
+def current():
+    return _stage
+
+
+def local_path(nc_filename, var_name='lithk'):
+    # The file to open for nc_filename: its staged copy when staging is configured
+    if _stage is None:
+        return nc_filename
+    return _stage.local_path(nc_filename, var_name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stage model files locally, or show or clear a staging directory.')
+    parser.add_argument('stage_dir')
+    parser.add_argument('--models', nargs='+', default=None, help='model NetCDF files to stage now')
+    parser.add_argument('--max-gb', type=float, default=DEFAULT_MAX_BYTES / 2**30, help='size limit, GB')
+    parser.add_argument('--extract', action='store_true', help='stage only the variable and its coordinates')
+    parser.add_argument('--var', default='lithk')
+    parser.add_argument('--evict', action='store_true', help='evict down to the size limit')
+    parser.add_argument('--clear', action='store_true', help='remove all staged files')
+    args = parser.parse_args(argv)
+
+    stage = ModelStage(args.stage_dir, int(args.max_gb * 2**30), args.extract)
+    if args.clear:
+        print(f'Removed {stage.clear()} staged files.')
+    elif args.evict:
+        print(f'Removed {stage.evict()} staged files.')
+    for nc_filename in args.models or []:
+        print(f'{nc_filename} -> {stage.local_path(nc_filename, args.var)}')
+    stage.print_stats()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
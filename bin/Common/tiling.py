@@ -0,0 +1,35 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Spatial tiling of one model grid, so a single large model can use all cores.
+# Model fields are flattened in x-major order (cell = ix * ny + iy), so a tile of whole x columns
+# is a contiguous range of cells: tiles are strips of about tile_cells cells, and the per-cell
+# arrays of a tile are plain slices. Each tile is processed on a thread pool (NumPy, the projection
+# and shapely release the GIL in their array operations), and the callers merge the per-tile
+# sums and counts by adding them, so temporary memory depends on the tile size and not on the grid.
+
+# Default number of cells per tile
+DEFAULT_TILE_CELLS = 2**20
+
+
+def strip_tiles(nx, ny, tile_cells=DEFAULT_TILE_CELLS):
+    # (x_start, x_stop) column ranges of the strips covering an nx x ny grid
+    columns = max(1, int(tile_cells) // max(1, ny))
+    return [(x_start, min(x_start + columns, nx)) for x_start in range(0, nx, columns)]
+
+
+def cell_tiles(nx, ny, tile_cells=DEFAULT_TILE_CELLS):
+    # (cell_start, cell_stop) ranges of the flattened cells of the strips of strip_tiles
+    return [(x_start * ny, x_stop * ny) for x_start, x_stop in strip_tiles(nx, ny, tile_cells)]
+
+
+def map_tiles(function, tiles, workers=None):
+    # [function(*tile) for tile in tiles], on `workers` threads (default: one per core).
+    # The default is set here: ThreadPoolExecutor's own is min(32, cores + 4), sized for I/O.
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(tiles))
+    if workers <= 1:
+        return [function(*tile) for tile in tiles]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda tile: function(*tile), tiles))
@@ -0,0 +1,615 @@
+### Numerical core of the gravimetry comparison
+# Loading the GSFC solution and the model, putting the model into mascon space, and reading and
+# writing the comparison files. Only NumPy, netCDF4 and cftime are imported with this module;
+# h5py, SciPy and xarray are imported where they are first needed, and nothing here needs
+# cartopy or matplotlib, so process-pool workers and command line tools start quickly.
+# The plotting and projection helpers are in gravimetry_utils, which also re-exports all of this.
+import os,sys
+import re
+import hashlib
+import datetime
+import numpy as np
+
+import mascons
+import polar_stereo
+from mascons import calc_mascon_delta_cmwe
+
+# Helpers shared with the IMBIE comparison
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Common'))
+from model_reader import ModelReader
+from result_cache import ResultCache
+from instrumentation import stage, instrumented
+import tiling
+from netCDF4 import Dataset
+
+
+# GSFC mascon location codes for each ice sheet
+MASCON_LOCATIONS = {'GIS': [1], 'AIS': [3, 4]}
+
+# Version of the cached grid -> mascon weights, part of their file names
+MASCON_WEIGHTS_VERSION = 2
+
+
+@instrumented('load_gsfc')
+def loadGsfcMascons(Mascon_data_path, loc=None, windows=None, cache_dir=None):
+    # Optionally load only the mascons of one ice sheet (loc), only the epochs needed
+    # for a list of (start_date, end_date) windows, or from a memory-mapped cache in cache_dir.
+    locations = None if loc is None else MASCON_LOCATIONS[loc]
+           
+    # Load GSFC mascons
+    try:
+        gsfc = mascons.load_gsfc_solution( Mascon_data_path, lon_wrap='pm180', locations=locations,
+                                          windows=windows, cache_dir=cache_dir)
+    except Exception as error:
+        print('Error: Failed to load GSFC mascons.')
+        print(error)
+    return gsfc
+
+
+def loadGisModel(nc_filename):
+    import xarray as xr
+
+    # Load GIS model into an Xarray
+    try:
+        gis_ds = xr.open_dataset(nc_filename, autoclose=True, engine='netcdf4')
+    except:
+        print('Error: Failed to open model data; unexpected format found. Terminating calculation.')
+
+    # check for the lithk variable
+    try:
+        lithk = gis_ds['lithk']
+    except Exception as error:
+        print('Error: lithk variable expected but not found in model. Terminating calculation.')
+        print(error)
+
+    return gis_ds
+
+
+# Open a model for reading only the time slices a comparison needs
+def loadModelReader(nc_filename):
+    try:
+        return ModelReader(nc_filename, 'lithk')
+    except KeyError as error:
+        print('Error: lithk variable expected but not found in model. Terminating calculation.')
+        raise
+    except Exception as error:
+        print('Error: Failed to open model data; unexpected format found. Terminating calculation.')
+        raise
+
+
+# Model grid coordinates and lithk change between two dates, flattened in x-major order.
+# gis_ds is an xarray Dataset from loadGisModel or a ModelReader from loadModelReader.
+def modelLithkDelta(gis_ds, start_date, end_date):
+    if isinstance(gis_ds, ModelReader):
+        lithk_delta = gis_ds.lithk_delta(start_date, end_date).transpose().flatten()
+        return gis_ds.x, gis_ds.y, lithk_delta
+
+    # fetch the lithk variable from the model data structure
+    lithk = gis_ds['lithk']
+
+    # # Calc difference between end_date and start_date:
+    lithk_start = lithk.interp(time=start_date).data.transpose().flatten()
+    lithk_end = lithk.interp(time=end_date).data.transpose().flatten()
+
+    lithk_delta = lithk_end - lithk_start
+    return gis_ds.x.data, gis_ds.y.data, lithk_delta
+
+
+# Identify a model grid by its coordinates, projection and the mascon geometry it is binned into
+def grid_fingerprint(gsfc, x, y, polar_stereographic):
+    h = hashlib.sha1()
+    h.update(str(MASCON_WEIGHTS_VERSION).encode())
+    for coords in (x, y):
+        h.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+    h.update(repr(sorted(polar_stereo.projection_params(polar_stereographic).items())).encode())
+    for edges in (gsfc.lat_centers, gsfc.lat_spans, gsfc.lon_centers, gsfc.lon_spans):
+        h.update(np.ascontiguousarray(edges, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+# Project the model grid to lat/lon, in the x-major order used for the flattened lithk fields.
+# polar_stereographic is the CRS from set_projection, or just 'GIS'/'AIS' where cartopy is not available.
+def gridToGeodetic(x, y, polar_stereographic, dtype=np.float64):
+    return polar_stereo.inverse(x, y, polar_stereographic, dtype=dtype)
+
+
+# (cell, mascon) memberships of the cells of a grid (x-major), projecting and looking up the grid tile by tile
+def gridMasconMemberships(gsfc, x, y, polar_stereographic, tile_cells=tiling.DEFAULT_TILE_CELLS, workers=None):
+    ny = len(y)
+    def tile_memberships(x_start, x_stop):
+        points, labels = gsfc.points_to_memberships(*gridToGeodetic(x[x_start:x_stop], y, polar_stereographic))
+        return points + x_start * ny, labels
+    tiles = tiling.strip_tiles(len(x), ny, tile_cells)
+    gsfc.spatial_index  # built here, before the threads share it
+    memberships = tiling.map_tiles(tile_memberships, tiles, workers)
+    return np.concatenate([points for points, _ in memberships]), np.concatenate([labels for _, labels in memberships])
+
+
+# Mascon means of flattened (x-major) grid values, tile by tile: each tile is projected, binned into
+# the mascons and summed on its own, and the per-tile sums and counts are added up, so memory
+# depends on tile_cells and not on the grid size. The same means as points_to_mascons on the whole
+# grid, up to the rounding of the sums.
+def tiledMasconMeans(gsfc, x, y, polar_stereographic, values, tile_cells=tiling.DEFAULT_TILE_CELLS, workers=None):
+    ny = len(y)
+    def tile_sums(x_start, x_stop):
+        lats, lons = gridToGeodetic(x[x_start:x_stop], y, polar_stereographic)
+        return mascons.points_to_mascon_sums(gsfc, lats, lons, values[x_start * ny:x_stop * ny])
+
+    gsfc.spatial_index  # built here, before the threads share it
+    sums = np.zeros(gsfc.N_mascons)
+    counts = np.zeros(gsfc.N_mascons, dtype=np.int64)
+    for tile_sum, tile_count in tiling.map_tiles(tile_sums, tiling.strip_tiles(len(x), ny, tile_cells), workers):
+        sums += tile_sum
+        counts += tile_count
+    return mascons.sums_to_mascons(sums, counts)
+
+
+# Load the grid cell -> mascon weights for a model grid, building and caching them on first use
+# (with tile_cells, the grid is projected and labelled in tiles on `workers` threads)
+@instrumented('mascon_weights')
+def loadMasconWeights(gsfc, x, y, polar_stereographic, cache_dir, tile_cells=None, workers=None):
+    from scipy import sparse
+
+    os.makedirs(cache_dir, exist_ok=True)
+    weights_filename = os.path.join(cache_dir, 'mascon_weights_' + grid_fingerprint(gsfc, x, y, polar_stereographic) + '.npz')
+
+    if os.path.exists(weights_filename):
+        return sparse.load_npz(weights_filename)
+
+    if tile_cells is not None:
+        weights = mascons.memberships_to_mascon_weights(gsfc.N_mascons, len(x) * len(y),
+                                                        *gridMasconMemberships(gsfc, x, y, polar_stereographic, tile_cells, workers))
+    else:
+        lats, lons = gridToGeodetic(x, y, polar_stereographic)
+        weights = mascons.points_to_mascon_weights(gsfc, lats, lons)
+
+    # Write under a temporary name first so concurrent runs never read a partial file
+    tmp_filename = weights_filename[:-len('.npz')] + f'.{os.getpid()}.tmp.npz'
+    sparse.save_npz(tmp_filename, weights)
+    os.replace(tmp_filename, weights_filename)
+    return weights
+
+
+# Select the mascons of one ice sheet
+def selectMascons(gsfc, loc):
+    return np.isin(gsfc.locations, MASCON_LOCATIONS[loc])
+
+
+
+# Inputs identifying a GSFC solution in result cache keys: its file, and which mascons and epochs were loaded
+def gsfcCacheInputs(gsfc):
+    params = {'lat_centers': np.asarray(gsfc.lat_centers), 'lon_centers': np.asarray(gsfc.lon_centers),
+              'locations': np.asarray(gsfc.locations), 'epochs': np.asarray(gsfc.epochs),
+              'days_middle': np.asarray(gsfc.days_middle)}
+    if gsfc.source is None:
+        # Not loaded from a file: the solution itself goes into the key
+        params['cmwe'] = np.asarray(gsfc.cmwe)
+        return [], params
+    return [gsfc.source], params
+
+
+# Compute mascon means
+@instrumented('mascon_means')
+def computeMasconMeans(gsfc, start_date, end_date, loc, result_cache=None):
+    # result_cache: a result_cache.ResultCache; the result is reused for the same solution, dates and loc
+    if result_cache is not None:
+        files, params = gsfcCacheInputs(gsfc)
+        params.update(start_date=str(start_date), end_date=str(end_date), loc=loc)
+        return result_cache.call('computeMasconMeans', files, params, computeMasconMeans, gsfc, start_date, end_date, loc)
+
+    try:
+        mass_change_obs = mascons.calc_mascon_delta_cmwe(gsfc, start_date, end_date)
+    except Exception as error:
+        print('Error: Failed to calculate mascon delta. Terminating calculation.')
+        print(error)
+
+    # Select only desired mascons
+    I_ = selectMascons(gsfc, loc)
+    
+    mass_change_obs = mass_change_obs[I_]
+
+    return mass_change_obs,I_
+
+
+    
+@instrumented('transformToGeodetic')
+def transformToGeodetic(gsfc, gis_ds, start_date, end_date, rho_ice,rho_water, polar_stereographic, weights_cache_dir=None, I_=None, result_cache=None,
+                        tile_cells=None, workers=None):
+    # Put model into mascon space:
+
+    # To compare with GRACE mascons, we need to compute lat/lon coordinates
+    # for the grid locations and average them into the GSFC mascon boundaries.
+
+    # First, we must transform from the original polar stereographic projection
+    # into a geodetic lat/lon coordinate system. We plot the result of
+    # this transformation to verify that the transformation was successful.
+
+    # Then, we spatially average the data into mascon space and once more plot our result.
+
+    # If weights_cache_dir is set, the grid -> mascon assignment is cached there per grid,
+    # so models sharing a grid skip the projection and binning entirely.
+
+    # I_ is the mascon selection returned by computeMasconMeans; if not given, the
+    # mascons of the ice sheet of the projection's hemisphere are selected.
+
+    # gis_ds may be a ModelReader, which reads only the time slices bracketing the two dates.
+
+    # result_cache: a result_cache.ResultCache; the result is reused for the same model file,
+    # solution, dates, densities, projection and mascon selection.
+
+    # tile_cells: split the grid into tiles of about this many cells, projected, binned and summed
+    # on `workers` threads (default: one per core), so a single large grid uses all cores.
+    if result_cache is not None:
+        model_filename = gis_ds.nc_filename if isinstance(gis_ds, ModelReader) else gis_ds.encoding.get('source')
+        if model_filename is None:
+            raise ValueError('Error: The result cache needs a model opened from a file.')
+        files, params = gsfcCacheInputs(gsfc)
+        params.update(start_date=str(start_date), end_date=str(end_date), rho_ice=float(rho_ice), rho_water=float(rho_water),
+                      projection=polar_stereo.projection_params(polar_stereographic), I_=None if I_ is None else np.asarray(I_))
+        return result_cache.call('transformToGeodetic', [model_filename] + files, params, transformToGeodetic,
+                                 gsfc, gis_ds, start_date, end_date, rho_ice, rho_water, polar_stereographic,
+                                 weights_cache_dir=weights_cache_dir, I_=I_, tile_cells=tile_cells, workers=workers)
+
+    # TODO: evaluate whether this transform has failed and return appropriate error
+
+    with stage('interp'):
+        x, y, lithk_delta = modelLithkDelta(gis_ds, start_date, end_date)
+
+    # Mascon-average lithk from GIS
+    lithk_delta[np.isnan(lithk_delta)] = 0
+    if weights_cache_dir is not None:
+        weights = loadMasconWeights(gsfc, x, y, polar_stereographic, weights_cache_dir, tile_cells, workers)
+        with stage('mascon_binning'):
+            lithk_mascons = mascons.weights_to_mascons(weights, lithk_delta)
+    elif tile_cells is not None:
+        with stage('mascon_binning'):
+            lithk_mascons = tiledMasconMeans(gsfc, x, y, polar_stereographic, lithk_delta, tile_cells, workers)
+    else:
+        # Transform projection to lat/lon
+        with stage('projection'):
+            lats, lons = gridToGeodetic(x, y, polar_stereographic)
+        with stage('mascon_binning'):
+            lithk_mascons = mascons.points_to_mascons(gsfc, lats, lons, lithk_delta)
+
+    # Ice thickness (m) to cm water equivalent:   
+    mass_change_mod = lithk_mascons * rho_ice / rho_water * 100
+
+    # these variables depend only on the mascons here, which are fixed.
+    if I_ is None:
+        north = polar_stereo.projection_params(polar_stereographic)['central_latitude'] > 0
+        I_ = selectMascons(gsfc, 'GIS' if north else 'AIS')
+    mass_change_mod_trim = mass_change_mod[I_]
+
+    return mass_change_mod_trim, mass_change_mod
+
+
+# Mass change for many (start_date, end_date) windows in one pass
+@instrumented('computeMassChangeWindows')
+def computeMassChangeWindows(gsfc, gis_ds, windows, I_, rho_ice, rho_water, polar_stereographic, weights_cache_dir=None):
+    # Each distinct date is interpolated from the model once, and the lithk changes of all
+    # windows are put into mascon space with a single sparse matrix product.
+    # Returns (window x mascon) arrays of observed, modelled and residual mass change (cm w.e.)
+    # for the mascons selected by I_.
+    windows = [(str(start_date), str(end_date)) for start_date, end_date in windows]
+
+    mass_change_obs = np.stack([mascons.calc_mascon_delta_cmwe(gsfc, start_date, end_date)[I_]
+                                for start_date, end_date in windows])
+
+    # Interpolate every distinct date once, as flattened (x-major) fields
+    dates = sorted(set(date for window in windows for date in window))
+    if isinstance(gis_ds, ModelReader):
+        x, y = gis_ds.x, gis_ds.y
+        lithk_dates = np.stack([gis_ds.interp(date, np.float64).transpose().flatten() for date in dates], axis=1)
+    else:
+        x, y = gis_ds.x.data, gis_ds.y.data
+        lithk = gis_ds['lithk']
+        lithk_dates = np.stack([lithk.interp(time=date).data.transpose().flatten() for date in dates], axis=1)
+
+    # (point x window) changes, with missing values set to zero as in transformToGeodetic
+    date_index = {date: i for i, date in enumerate(dates)}
+    i_start = [date_index[start_date] for start_date, _ in windows]
+    i_end = [date_index[end_date] for _, end_date in windows]
+    lithk_delta = lithk_dates[:, i_end] - lithk_dates[:, i_start]
+    del lithk_dates
+    lithk_delta[np.isnan(lithk_delta)] = 0
+
+    if weights_cache_dir is not None:
+        weights = loadMasconWeights(gsfc, x, y, polar_stereographic, weights_cache_dir)
+    else:
+        lats, lons = gridToGeodetic(x, y, polar_stereographic)
+        weights = mascons.points_to_mascon_weights(gsfc, lats, lons)
+    lithk_mascons = mascons.weights_to_mascons(weights, lithk_delta)
+
+    # Ice thickness (m) to cm water equivalent
+    mass_change_mod = (lithk_mascons * rho_ice / rho_water * 100)[I_].T
+
+    return {'windows': windows,
+            'mass_change_obs': mass_change_obs,
+            'mass_change_mod': mass_change_mod,
+            'mass_change_delta': mass_change_mod - mass_change_obs}
+
+
+# GSFC epochs whose middle time lies inside the model's time range (and optionally in [start_date, end_date])
+def seriesEpochs(gsfc, model, start_date=None, end_date=None):
+    epochs = np.asarray(gsfc.epochs)
+    times = gsfc.times_middle[epochs]
+    keep = model.in_range(times)
+    if start_date is not None:
+        keep &= times >= np.datetime64(start_date)
+    if end_date is not None:
+        keep &= times <= np.datetime64(end_date)
+    return epochs[keep]
+
+
+# Mass change at every GSFC epoch relative to the first one, for observations and model
+@instrumented('computeMassChangeSeries')
+def computeMassChangeSeries(gsfc, gis_ds, I_, rho_ice, rho_water, polar_stereographic, weights_cache_dir=None,
+                            start_date=None, end_date=None, chunk_size=12):
+    # gis_ds is a ModelReader (loadModelReader). The model is read at the GSFC middle times of
+    # chunk_size epochs at a time: only the time slices bracketing those epochs are read, and the
+    # lithk changes of the whole chunk go into mascon space with one sparse matrix product,
+    # so memory depends on chunk_size and not on the length of the run.
+    # Returns (mascon x epoch) arrays of observed, modelled and residual mass change (cm w.e.)
+    # for the mascons selected by I_, with the epochs and their middle times.
+    if not isinstance(gis_ds, ModelReader):
+        raise ValueError('Error: The time-series comparison needs a model opened with loadModelReader.')
+
+    epochs = seriesEpochs(gsfc, gis_ds, start_date, end_date)
+    if len(epochs) < 2:
+        raise ValueError('Error: Fewer than two GSFC epochs fall inside the model time range.')
+    times = gsfc.times_middle[epochs]
+
+    cmwe_0 = gsfc.epoch_cmwe(epochs[0])[I_]
+    mass_change_obs = np.stack([gsfc.epoch_cmwe(i)[I_] - cmwe_0 for i in epochs], axis=1)
+
+    if weights_cache_dir is not None:
+        weights = loadMasconWeights(gsfc, gis_ds.x, gis_ds.y, polar_stereographic, weights_cache_dir)
+    else:
+        lats, lons = gridToGeodetic(gis_ds.x, gis_ds.y, polar_stereographic)
+        weights = mascons.points_to_mascon_weights(gsfc, lats, lons)
+    weights = weights[np.flatnonzero(I_)]
+
+    # Flattened (x-major) model field at the first epoch
+    lithk_0 = gis_ds.interp(times[0], np.float64).transpose().flatten()
+
+    i_0, i_1, w = gis_ds.bracket(times)
+    lithk_mascons = np.empty((weights.shape[0], len(epochs)))
+    for c in range(0, len(epochs), chunk_size):
+        chunk = slice(c, c + chunk_size)
+        # Read the bracketing slices of the chunk once each, as contiguous runs
+        needed = np.unique(np.concatenate([i_0[chunk], i_1[chunk]]))
+        runs = np.split(needed, np.flatnonzero(np.diff(needed) > 1) + 1)
+        slices = {}
+        for run in runs:
+            for i, field in zip(run, gis_ds.read_slices(run[0], run[-1] + 1)):
+                slices[i] = field
+
+        # (point x epoch) changes, with missing values set to zero as in transformToGeodetic
+        lithk_delta = np.empty((len(lithk_0), len(i_0[chunk])))
+        for k, (j_0, j_1, w_k) in enumerate(zip(i_0[chunk], i_1[chunk], w[chunk])):
+            field_0 = slices[j_0].astype(np.float64)
+            field = field_0 + w_k * (slices[j_1] - field_0) if w_k else field_0
+            lithk_delta[:, k] = field.transpose().flatten() - lithk_0
+        del slices
+        lithk_delta[np.isnan(lithk_delta)] = 0
+
+        lithk_mascons[:, chunk] = mascons.weights_to_mascons(weights, lithk_delta)
+
+    # Ice thickness (m) to cm water equivalent
+    mass_change_mod = lithk_mascons * rho_ice / rho_water * 100
+
+    return {'epochs': epochs,
+            'times': times,
+            'mass_change_obs': mass_change_obs,
+            'mass_change_mod': mass_change_mod,
+            'mass_change_delta': mass_change_mod - mass_change_obs}
+
+
+@instrumented('write_netcdf')
+def write_to_netcdf(mass_change_obs, mass_change_delta, mass_change_mod_trim,gsfc,I_, start_date, end_date, netcdf_filename):
+    # Get today's date
+    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    lat_centers = gsfc.lat_centers[I_]
+    lon_centers = gsfc.lon_centers[I_]
+    
+
+    # --- Save Data to NetCDF ---
+    with Dataset(netcdf_filename, "w", format="NETCDF4") as ncfile:
+        # Create dimensions
+        # Number of points for the data variables
+        point_dim = ncfile.createDimension('data_points', len(lat_centers))
+    
+        # Create variables for latitude and longitude 
+        lats_obs = ncfile.createVariable('latitude_obs', 'f4', ('data_points',))
+        lons_obs = ncfile.createVariable('longitude_obs', 'f4', ('data_points',))
+        
+        lats_mod = ncfile.createVariable('latitude_mod', 'f4', ('data_points',))
+        lons_mod = ncfile.createVariable('longitude_mod', 'f4', ('data_points',))
+    
+        # Create variables for mass balance data
+        observed_mass = ncfile.createVariable('mass_change_obs', 'f4', ('data_points',))
+        modeled_mass = ncfile.createVariable('mass_change_mod', 'f4', ('data_points',))
+        residual_mass = ncfile.createVariable('mass_change_delta', 'f4', ('data_points',))
+    
+        
+        # Write data to variables
+        lats_obs[:] = lat_centers  # For mass_change_obs and mass_change_delta
+        lons_obs[:] = lon_centers
+        lats_mod[:] = gsfc.lat_centers[I_] # For mass_change_mod_trim
+        lons_mod[:] = gsfc.lon_centers[I_]
+    
+        observed_mass[:] = mass_change_obs 
+        modeled_mass[:] = mass_change_mod_trim  
+        residual_mass[:] = mass_change_delta 
+    
+        # Add global attributes
+        ncfile.description = 'Gravimetry Comparison Data including lithk_mascons_cmwe subset'
+        ncfile.history = f'Created on {today}. Data from {start_date} to {end_date}.'
+        ncfile.start_date = str(start_date)
+        ncfile.end_date = str(end_date)
+
+    
+    print(f'Data successfully written to {netcdf_filename}')
+
+
+
+
+# Read a comparison written by write_to_netcdf
+def read_comparison_netcdf(netcdf_filename):
+    with Dataset(netcdf_filename, 'r') as ncfile:
+        comparison = {name: np.asarray(ncfile[name][:], dtype=np.float64) for name in
+                      ('latitude_obs', 'longitude_obs', 'mass_change_obs', 'mass_change_mod', 'mass_change_delta')}
+        if 'start_date' in ncfile.ncattrs():
+            comparison['start_date'], comparison['end_date'] = ncfile.start_date, ncfile.end_date
+        else:
+            # Files written before the dates were stored as attributes
+            dates = re.search(r'Data from (\S+) to (\S+?)\.?$', getattr(ncfile, 'history', ''))
+            if dates is None:
+                raise ValueError(f'Error: No comparison dates found in {netcdf_filename}.')
+            comparison['start_date'], comparison['end_date'] = dates.groups()
+    return comparison
+
+
+# One file for the comparisons of a whole ensemble: the mascon coordinates and observed mass
+# change are stored once, and each model's results are a row along an unlimited 'model' dimension.
+# Variables are zlib compressed, in (model x mascon) chunks of a few models and a block of mascons.
+ENSEMBLE_STORE_CHUNKS = (16, 512)
+
+@instrumented('write_store')
+def write_to_ensemble_store(model_name, mass_change_obs, mass_change_delta, mass_change_mod_trim, gsfc, I_,
+                            start_date, end_date, store_filename):
+    # Creates the store on first use; a model that is already in the store is overwritten
+    lat_centers = gsfc.lat_centers[I_]
+    lon_centers = gsfc.lon_centers[I_]
+
+    if not os.path.exists(store_filename):
+        today = datetime.datetime.now().strftime('%Y-%m-%d')
+        n_points = len(lat_centers)
+        chunks = (ENSEMBLE_STORE_CHUNKS[0], min(ENSEMBLE_STORE_CHUNKS[1], n_points))
+        with Dataset(store_filename, "w", format="NETCDF4") as ncfile:
+            ncfile.createDimension('model', None)
+            ncfile.createDimension('data_points', n_points)
+
+            ncfile.createVariable('model', str, ('model',))
+            ncfile.createVariable('latitude', 'f4', ('data_points',), zlib=True)[:] = lat_centers
+            ncfile.createVariable('longitude', 'f4', ('data_points',), zlib=True)[:] = lon_centers
+            ncfile.createVariable('mass_change_obs', 'f4', ('data_points',), zlib=True)[:] = mass_change_obs
+            for name in ('mass_change_mod', 'mass_change_delta'):
+                ncfile.createVariable(name, 'f4', ('model', 'data_points'), zlib=True, chunksizes=chunks,
+                                      fill_value=np.float32(np.nan))
+
+            ncfile.description = 'Gravimetry Comparison Data for a model ensemble'
+            ncfile.history = f'Created on {today}. Data from {start_date} to {end_date}.'
+            ncfile.start_date = str(start_date)
+            ncfile.end_date = str(end_date)
+
+    with Dataset(store_filename, "a") as ncfile:
+        if ncfile.start_date != str(start_date) or ncfile.end_date != str(end_date):
+            raise ValueError(f'Error: {store_filename} holds comparisons from {ncfile.start_date} to {ncfile.end_date}, not {start_date} to {end_date}.')
+        if (len(ncfile['latitude']) != len(lat_centers)
+                or not np.allclose(ncfile['latitude'][:], lat_centers, atol=1e-4)
+                or not np.allclose(ncfile['longitude'][:], lon_centers, atol=1e-4)):
+            raise ValueError(f'Error: The mascons in {store_filename} do not match the selected GSFC mascons.')
+
+        models = list(ncfile['model'][:]) if len(ncfile.dimensions['model']) else []
+        row = models.index(model_name) if model_name in models else len(models)
+        ncfile['model'][row] = model_name
+        ncfile['mass_change_mod'][row, :] = mass_change_mod_trim
+        ncfile['mass_change_delta'][row, :] = mass_change_delta
+
+    print(f'Data successfully written to {store_filename} ({model_name})')
+
+
+def read_ensemble_store(store_filename, models=None):
+    # (model x mascon) arrays of the store, optionally only for the named models.
+    # Each variable is read in one request; compressed chunks cannot be memory-mapped,
+    # so this is the cheapest way to get the whole ensemble into memory.
+    with Dataset(store_filename, 'r') as ncfile:
+        model_names = np.array(ncfile['model'][:], dtype=object) if len(ncfile.dimensions['model']) else np.array([], dtype=object)
+        rows = slice(None)
+        if models is not None:
+            index = {name: i for i, name in enumerate(model_names)}
+            missing = [name for name in models if name not in index]
+            if missing:
+                raise ValueError(f"Error: Models not found in {store_filename}: {', '.join(missing)}")
+            rows = np.array([index[name] for name in models], dtype=int)
+            model_names = model_names[rows]
+
+        store = {'model': list(model_names),
+                 'latitude': ncfile['latitude'][:].filled(np.nan),
+                 'longitude': ncfile['longitude'][:].filled(np.nan),
+                 'mass_change_obs': ncfile['mass_change_obs'][:].filled(np.nan),
+                 'start_date': ncfile.start_date,
+                 'end_date': ncfile.end_date}
+        for name in ('mass_change_mod', 'mass_change_delta'):
+            store[name] = np.ma.filled(ncfile[name][:], np.nan)[rows]
+    return store
+
+
+@instrumented('write_netcdf')
+def write_windows_to_netcdf(window_result, gsfc, I_, netcdf_filename):
+    # Write the output of computeMassChangeWindows to one file with a window dimension
+    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    windows = window_result['windows']
+
+    with Dataset(netcdf_filename, "w", format="NETCDF4") as ncfile:
+        ncfile.createDimension('window', len(windows))
+        ncfile.createDimension('data_points', int(np.sum(I_)))
+
+        lats = ncfile.createVariable('latitude', 'f4', ('data_points',))
+        lons = ncfile.createVariable('longitude', 'f4', ('data_points',))
+        start_dates = ncfile.createVariable('start_date', str, ('window',))
+        end_dates = ncfile.createVariable('end_date', str, ('window',))
+
+        observed_mass = ncfile.createVariable('mass_change_obs', 'f4', ('window', 'data_points'))
+        modeled_mass = ncfile.createVariable('mass_change_mod', 'f4', ('window', 'data_points'))
+        residual_mass = ncfile.createVariable('mass_change_delta', 'f4', ('window', 'data_points'))
+
+        lats[:] = gsfc.lat_centers[I_]
+        lons[:] = gsfc.lon_centers[I_]
+        start_dates[:] = np.array([start_date for start_date, _ in windows], dtype=object)
+        end_dates[:] = np.array([end_date for _, end_date in windows], dtype=object)
+
+        observed_mass[:] = window_result['mass_change_obs']
+        modeled_mass[:] = window_result['mass_change_mod']
+        residual_mass[:] = window_result['mass_change_delta']
+
+        ncfile.description = 'Gravimetry Comparison Data for multiple time windows'
+        ncfile.history = f'Created on {today}. {len(windows)} windows.'
+
+    print(f'Data successfully written to {netcdf_filename}')
+
+
+@instrumented('write_netcdf')
+def write_series_to_netcdf(series_result, gsfc, I_, netcdf_filename):
+    # Write the output of computeMassChangeSeries to one file with an epoch dimension
+    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    times = series_result['times']
+
+    with Dataset(netcdf_filename, "w", format="NETCDF4") as ncfile:
+        ncfile.createDimension('data_points', int(np.sum(I_)))
+        ncfile.createDimension('epoch', len(times))
+
+        lats = ncfile.createVariable('latitude', 'f4', ('data_points',))
+        lons = ncfile.createVariable('longitude', 'f4', ('data_points',))
+        epochs = ncfile.createVariable('epoch', 'i4', ('epoch',))
+        days = ncfile.createVariable('days_middle', 'f8', ('epoch',))
+        days.units = 'days since 2002-01-01T00:00:00'
+
+        observed_mass = ncfile.createVariable('mass_change_obs', 'f4', ('data_points', 'epoch'))
+        modeled_mass = ncfile.createVariable('mass_change_mod', 'f4', ('data_points', 'epoch'))
+        residual_mass = ncfile.createVariable('mass_change_delta', 'f4', ('data_points', 'epoch'))
+
+        lats[:] = gsfc.lat_centers[I_]
+        lons[:] = gsfc.lon_centers[I_]
+        epochs[:] = series_result['epochs']
+        days[:] = gsfc.days_middle[series_result['epochs']]
+
+        observed_mass[:] = series_result['mass_change_obs']
+        modeled_mass[:] = series_result['mass_change_mod']
+        residual_mass[:] = series_result['mass_change_delta']
+
+        ncfile.description = 'Gravimetry Comparison Data at every GSFC epoch, relative to the first epoch'
+        ncfile.history = f'Created on {today}. {len(times)} epochs from {np.datetime_as_string(times[0], unit="D")} to {np.datetime_as_string(times[-1], unit="D")}.'
+
+    print(f'Data successfully written to {netcdf_filename}')
@@ -0,0 +1,381 @@
+### Headless gravimetry comparison of a model ensemble
+# Loads the GSFC observations once, then runs the model comparisons
+# (transformToGeodetic + write_to_netcdf) for many model files in a process pool.
+# Comparison figures are rendered in a second process pool with the Agg backend.
+#
+# Example:
+#   python gravimetry_ensemble.py --obs gsfc.h5 --loc AIS --start 2006-01-01 --end 2014-12-31 \
+#       --models '/home/jovyan/shared-public/CmCt/models/ISMIP6/lithk_AIS_*_*_hist_std.nc' --output-path out/ \
+#       --plot --shapefile ANT_Basins_IMBIE2_v1.6.shp
+#
+# Plots of existing comparisons:
+#   python gravimetry_ensemble.py --obs gsfc.h5 --loc AIS --plot-only --shapefile ANT_Basins_IMBIE2_v1.6.shp \
+#       --models 'out/*_mascon_comp.nc'
+#
+# With --index models.sqlite, the models are chosen from a metadata index of the collection (see
+# model_index.py): files without lithk or not covering the dates are skipped without being opened.
+# With --staging-dir /scratch/models, the model files are read from local copies (see staging.py).
+# With --pipeline 2, the models are compared in this process instead, with the reads of the next two
+# models and the writes overlapping the computation (see pipeline.py), e.g. for a run on one core.
+import os,sys
+import glob
+import argparse
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# The comparisons only need the numerical core; the plotting functions import cartopy and
+# matplotlib when the first figure is made
+from gravimetry_core import loadGsfcMascons, loadModelReader, computeMasconMeans, transformToGeodetic, write_to_netcdf, \
+                            write_to_ensemble_store, selectMascons, read_comparison_netcdf
+from gravimetry_utils import set_projection, prepareMasconPlot, drawMasconFigure
+import instrumentation
+import staging
+import pipeline
+from model_index import select_models
+
+
+# Observation state of the current worker process, set once by _init_worker
+_state = None
+
+
+def _init_worker(state):
+    global _state
+    _state = state
+    if state.get('instrument') is not None:
+        instrumentation.enable(**state['instrument'])
+    if state.get('staging') is not None:
+        staging.configure(**state['staging'])
+
+
+def model_name(nc_filename):
+    return os.path.splitext(os.path.basename(nc_filename))[0]
+
+
+def output_netcdf_filename(nc_filename, output_path):
+    output_filename = model_name(nc_filename) + '_mascon_comp'
+    return os.path.join(output_path, output_filename + '.nc')
+
+
+def compute_model(state, gis_ds):
+    # Mass change of an open model on the observed mascons, and its difference from the observations
+    with instrumentation.stage('calendar_check'):
+        gis_ds.check_datarange(state['start_date'], state['end_date'])
+
+    # The ice sheet name stands in for the cartopy projection, so workers do not need cartopy
+    mass_change_mod_trim, mass_change_mod = transformToGeodetic(state['gsfc'], gis_ds, state['start_date'], state['end_date'],
+                                                                state['rho_ice'], state['rho_water'], state['loc'],
+                                                                weights_cache_dir=state['weights_cache_dir'], I_=state['I_'],
+                                                                **(state['tiles'] or {}))
+    return {'mass_change_mod': mass_change_mod_trim, 'mass_change_delta': mass_change_mod_trim - state['mass_change_obs']}
+
+
+def write_model(state, nc_filename, output):
+    # Write the comparison of one model to its own NetCDF file; returns the file name
+    netcdf_filename = output_netcdf_filename(nc_filename, state['output_path'])
+    write_to_netcdf(state['mass_change_obs'], output['mass_change_delta'], output['mass_change_mod'], state['gsfc'], state['I_'],
+                    state['start_date'], state['end_date'], netcdf_filename)
+    return netcdf_filename
+
+
+def write_store_model(state, nc_filename, output):
+    # Append the comparison of one model to the ensemble store; returns the store file name
+    write_to_ensemble_store(model_name(nc_filename), state['mass_change_obs'], output['mass_change_delta'],
+                            output['mass_change_mod'], state['gsfc'], state['I_'],
+                            state['start_date'], state['end_date'], state['store_filename'])
+    return state['store_filename']
+
+
+def compare_model(state, nc_filename):
+    # Compare one model against the observation state; returns the output file name,
+    # or with an ensemble store, the model's results for the parent process to append.
+    # Only the time slices bracketing the two dates are read
+    with instrumentation.stage('open_model'):
+        gis_ds = loadModelReader(nc_filename)
+    try:
+        output = compute_model(state, gis_ds)
+    finally:
+        gis_ds.close()
+
+    if state.get('store_filename') is not None:
+        return output
+    return write_model(state, nc_filename, output)
+
+
+def _run_model(nc_filename):
+    # Worker task: never raises, so one failing model does not stop the ensemble.
+    # With instrumentation enabled, the stage timings of the model are returned as 'stages'.
+    with instrumentation.recording(model=nc_filename) as record:
+        try:
+            result = {'model': nc_filename, 'status': 'ok', 'output': compare_model(_state, nc_filename), 'error': None}
+        except Exception as error:
+            result = {'model': nc_filename, 'status': 'failed', 'output': None,
+                      'error': f'{type(error).__name__}: {error}', 'traceback': traceback.format_exc()}
+    result['stages'] = record['stages']
+    return result
+
+
+def run_pipelined(state, nc_filenames, depth=2):
+    # Compare the models one at a time in this process, with the next `depth` models opened and their
+    # bracketing slices read on a prefetch thread, and the results written on a writer thread.
+    # Yields the result of each model, in input order, as _run_model returns them.
+    dates = [state['start_date'], state['end_date']]
+    write = write_store_model if state.get('store_filename') is not None else write_model
+
+    def write_locked(nc_filename, output):
+        with pipeline.netcdf_lock:
+            return write(state, nc_filename, output)
+
+    if state.get('staging') is not None:
+        staging.configure(**state['staging'])
+    try:
+        yield from pipeline.run_pipeline(nc_filenames, lambda nc_filename: pipeline.prefetch_model(nc_filename, dates),
+                                         lambda nc_filename, gis_ds: compute_model(state, gis_ds), write_locked,
+                                         pipeline.close_model, depth, depth)
+    finally:
+        if state.get('staging') is not None:
+            staging.configure(None)
+
+
+def load_observation_state(obs_filename, start_date, end_date, loc, rho_ice=918, rho_water=1000,
+                           output_path='.', weights_cache_dir=None, gsfc_cache_dir=None, store_filename=None,
+                           instrument=None, staging_settings=None, gsfc=None, tile_settings=None):
+    # Everything the model comparisons share; plain data, so it can be sent to worker processes.
+    # gsfc: the mascons of loc if already loaded (e.g. kept by the comparison service), otherwise read from obs_filename
+    if gsfc is None:
+        gsfc = loadGsfcMascons(obs_filename, loc=loc, windows=[(start_date, end_date)], cache_dir=gsfc_cache_dir)
+    mass_change_obs, I_ = computeMasconMeans(gsfc, start_date, end_date, loc)
+    return {'gsfc': gsfc, 'mass_change_obs': mass_change_obs, 'I_': I_,
+            'start_date': start_date, 'end_date': end_date, 'loc': loc,
+            'rho_ice': rho_ice, 'rho_water': rho_water,
+            'output_path': output_path, 'weights_cache_dir': weights_cache_dir, 'store_filename': store_filename,
+            'instrument': instrument, 'staging': staging_settings, 'tiles': tile_settings}
+
+
+def run_ensemble(obs_filename, nc_filenames, start_date, end_date, loc, rho_ice=918, rho_water=1000,
+                 output_path='.', processes=None, weights_cache_dir=None, gsfc_cache_dir=None, store_filename=None,
+                 instrument=None, stage_records=None, staging_settings=None, pipeline_depth=None, tile_settings=None):
+    """
+    Run the gravimetry comparison for every model in nc_filenames on `processes` worker processes
+    (all cores by default), or with pipeline_depth, in this process with the reads of the next
+    pipeline_depth models and the writes overlapping the computation (see run_pipelined).
+    Returns one result dict per model, in input order, with
+    'status' ('ok' or 'failed'), the 'output' NetCDF file name or the 'error' message.
+    With store_filename, all results are appended to that one ensemble store (see
+    write_to_ensemble_store) by this process instead of being written one file per model.
+    instrument: instrumentation.enable() settings, e.g. {'memory': 'rss'}, to record stage timings;
+    the records (the observation loading, model None, then each model) are appended to stage_records.
+    staging_settings: staging.configure() settings, e.g. {'stage_dir': '/scratch/models'}, for the workers
+    to read the model files from local copies.
+    tile_settings: {'tile_cells': ..., 'workers': ...} to split each model grid into tiles of about
+    tile_cells cells processed on `workers` threads, e.g. for a few very large grids with processes=1.
+    """
+    if pipeline_depth is not None and instrument is not None:
+        raise ValueError('Error: Stage timings are not recorded in a pipelined run, where the stages of models overlap.')
+    os.makedirs(output_path, exist_ok=True)
+    if instrument is not None:
+        instrumentation.enable(**instrument)
+    with instrumentation.recording(model=None) as observation_record:
+        state = load_observation_state(obs_filename, start_date, end_date, loc, rho_ice, rho_water,
+                                       output_path, weights_cache_dir, gsfc_cache_dir, store_filename, instrument,
+                                       staging_settings, tile_settings=tile_settings)
+
+    results = []
+    if stage_records is not None:
+        stage_records.append(observation_record)
+    with contextlib.ExitStack() as stack:
+        if pipeline_depth is None:
+            # The state is sent to each worker once, not once per model
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(state,)))
+            model_results = pool.map(_run_model, nc_filenames)
+        else:
+            # The pipeline writes the store itself
+            model_results = run_pipelined(state, nc_filenames, pipeline_depth)
+        for result in model_results:
+            if result['status'] == 'ok' and store_filename is not None and pipeline_depth is None:
+                # Only this process writes to the store
+                try:
+                    with instrumentation.recording() as record:
+                        result['output'] = write_store_model(state, result['model'], result['output'])
+                    result['stages'] += record['stages'][1:]
+                except Exception as error:
+                    result.update({'status': 'failed', 'output': None, 'error': f'{type(error).__name__}: {error}',
+                                   'traceback': traceback.format_exc()})
+            if result['status'] == 'ok':
+                print(f"Processed: {result['model']}")
+            else:
+                print(f"Error: {result['model']} failed. {result['error']}")
+            if stage_records is not None:
+                stage_records.append({'model': result['model'], 'status': result['status'], 'stages': result.get('stages', [])})
+            results.append(result)
+    if instrument is not None:
+        instrumentation.disable()
+    return results
+
+
+### Batch plotting
+# Static figure parts (projected mascon outlines, basin geometries) of the current plot worker
+_plot_static = None
+
+
+def _init_plot_worker(state):
+    global _plot_static
+    import matplotlib
+    # Render to files only; never open a window from a worker
+    matplotlib.use('Agg')
+    _plot_static = prepareMasconPlot(state['gsfc'], state['I_'], set_projection(state['loc']), state['loc'],
+                                     state['shapefile'], state['simplify'])
+    if _plot_static is None:
+        raise ValueError(f"Error: Input loc is equal to '{state['loc']}', not 'AIS' or 'GIS")
+
+
+def plot_filename_for(comp_filename, plot_path=None):
+    plot_path = os.path.dirname(comp_filename) if plot_path is None else plot_path
+    return os.path.join(plot_path, os.path.splitext(os.path.basename(comp_filename))[0] + '.png')
+
+
+def plot_comparison(plot_static, comp_filename, plot_path=None):
+    # Plot one *_mascon_comp.nc file; returns the figure file name
+    comparison = read_comparison_netcdf(comp_filename)
+    # The figure geometry belongs to the selected mascons, in the order write_to_netcdf wrote them
+    if (len(comparison['latitude_obs']) != len(plot_static['lat_centers'])
+            or not np.allclose(comparison['latitude_obs'], plot_static['lat_centers'], atol=1e-4)
+            or not np.allclose(comparison['longitude_obs'], plot_static['lon_centers'], atol=1e-4)):
+        raise ValueError(f'Error: The mascons in {comp_filename} do not match the selected GSFC mascons.')
+
+    plot_filename = plot_filename_for(comp_filename, plot_path)
+    drawMasconFigure(plot_static, comparison['mass_change_obs'], comparison['mass_change_mod'], comparison['mass_change_delta'],
+                     comparison['start_date'], comparison['end_date'], plot_filename, show=False)
+    return plot_filename
+
+
+def _plot_model(task):
+    # Worker task: never raises, so one failing figure does not stop the ensemble
+    comp_filename, plot_path = task
+    try:
+        return {'model': comp_filename, 'status': 'ok', 'output': plot_comparison(_plot_static, comp_filename, plot_path), 'error': None}
+    except Exception as error:
+        return {'model': comp_filename, 'status': 'failed', 'output': None,
+                'error': f'{type(error).__name__}: {error}', 'traceback': traceback.format_exc()}
+
+
+def plot_ensemble(obs_filename, comp_filenames, loc, shapefile, plot_path=None, processes=None,
+                  simplify=False, gsfc_cache_dir=None):
+    """
+    Render the comparison figure of every *_mascon_comp.nc file in comp_filenames on `processes`
+    worker processes, as PNG files in plot_path (next to each comparison file by default).
+    Returns one result dict per file, in input order, like run_ensemble.
+    """
+    if plot_path is not None:
+        os.makedirs(plot_path, exist_ok=True)
+
+    # Only the mascon geometry is needed, not the solution
+    gsfc = loadGsfcMascons(obs_filename, loc=loc, windows=[], cache_dir=gsfc_cache_dir)
+    I_ = selectMascons(gsfc, loc)
+    state = {'gsfc': gsfc, 'I_': I_, 'loc': loc, 'shapefile': shapefile, 'simplify': simplify}
+
+    results = []
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_plot_worker, initargs=(state,)) as pool:
+        for result in pool.map(_plot_model, [(f, plot_path) for f in comp_filenames]):
+            if result['status'] == 'ok':
+                print(f"Plotted: {result['output']}")
+            else:
+                print(f"Error: {result['model']} failed. {result['error']}")
+            results.append(result)
+    return results
+
+
+def print_summary(results):
+    failed = [r for r in results if r['status'] != 'ok']
+    print(f'{len(results) - len(failed)} of {len(results)} tasks succeeded.')
+    for r in failed:
+        print(f"  FAILED {r['model']}: {r['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gravimetry comparison of a model ensemble against GSFC mascons.')
+    parser.add_argument('--obs', required=True, help='GSFC mascon solution (HDF5)')
+    parser.add_argument('--models', required=True, nargs='+', help='model NetCDF files or glob templates')
+    parser.add_argument('--loc', required=True, choices=['GIS', 'AIS'])
+    parser.add_argument('--start', help='start date, YYYY-MM-DD')
+    parser.add_argument('--end', help='end date, YYYY-MM-DD')
+    parser.add_argument('--rho-ice', type=float, default=918, help='kg/m^3')
+    parser.add_argument('--rho-water', type=float, default=1000, help='kg/m^3')
+    parser.add_argument('--output-path', default='.')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--weights-cache', default=None, help='directory for cached grid -> mascon weights')
+    parser.add_argument('--gsfc-cache', default=None, help='directory for the memory-mapped GSFC cache')
+    parser.add_argument('--store', default=None, help='append all results to this one ensemble NetCDF file')
+    parser.add_argument('--plot', action='store_true', help='also render a figure for each comparison')
+    parser.add_argument('--plot-only', action='store_true', help='--models are existing *_mascon_comp.nc files to plot')
+    parser.add_argument('--shapefile', default=None, help='basin outlines drawn on the figures')
+    parser.add_argument('--plot-path', default=None, help='directory for the figures (default: next to the comparisons)')
+    parser.add_argument('--simplify', action='store_true', help='simplify the basin outlines to the coastline resolution')
+    parser.add_argument('--stages', default=None, help='write per-model stage timings to this JSON or CSV file')
+    parser.add_argument('--stage-memory', choices=['rss', 'tracemalloc', 'none'], default='rss',
+                        help='memory measure of the stage timings (tracemalloc is slower)')
+    parser.add_argument('--index', default=None, help='SQLite metadata index of the models, to skip ineligible files')
+    parser.add_argument('--staging-dir', default=None, help='local scratch directory to stage the model files in')
+    parser.add_argument('--staging-gb', type=float, default=staging.DEFAULT_MAX_BYTES / 2**30, help='size limit of the staging directory, GB')
+    parser.add_argument('--staging-extract', action='store_true', help='stage only lithk and its coordinates')
+    parser.add_argument('--pipeline', type=int, default=None, metavar='DEPTH',
+                        help='compare the models in this process, reading DEPTH models ahead and writing on a separate thread')
+    parser.add_argument('--tile-cells', type=int, default=None,
+                        help='split each model grid into tiles of about this many cells, processed on threads')
+    parser.add_argument('--tile-workers', type=int, default=None, help='threads per model for --tile-cells (default: all cores)')
+    args = parser.parse_args(argv)
+
+    if (args.plot or args.plot_only) and args.shapefile is None:
+        parser.error('--plot and --plot-only need --shapefile')
+    if not args.plot_only and (args.start is None or args.end is None):
+        parser.error('--start and --end are required to run comparisons')
+    if args.plot and args.store is not None:
+        parser.error('--plot works on per-model comparison files, not on --store')
+    if args.pipeline is not None and args.stages is not None:
+        parser.error('--stages cannot be recorded with --pipeline')
+
+    if not os.path.exists(args.obs):
+        raise FileNotFoundError(f"Observation file not found: {args.obs}")
+
+    nc_filenames = sorted(f for template in args.models for f in glob.glob(template))
+    if not nc_filenames:
+        raise FileNotFoundError(f"No model files match: {' '.join(args.models)}")
+
+    if args.plot_only:
+        results = plot_ensemble(args.obs, nc_filenames, args.loc, args.shapefile, args.plot_path, args.processes,
+                                args.simplify, args.gsfc_cache)
+        print_summary(results)
+        return 0 if all(r['status'] == 'ok' for r in results) else 1
+
+    if args.index is not None:
+        nc_filenames = select_models(args.index, nc_filenames, 'lithk', args.start, args.end)
+        if not nc_filenames:
+            raise FileNotFoundError(f"No model files cover {args.start} to {args.end}")
+
+    instrument, stage_records = None, []
+    if args.stages is not None:
+        instrument = {'memory': None if args.stage_memory == 'none' else args.stage_memory}
+    staging_settings = None
+    if args.staging_dir is not None:
+        staging_settings = {'stage_dir': args.staging_dir, 'max_bytes': int(args.staging_gb * 2**30), 'extract': args.staging_extract}
+    tile_settings = None
+    if args.tile_cells is not None:
+        tile_settings = {'tile_cells': args.tile_cells, 'workers': args.tile_workers}
+    results = run_ensemble(args.obs, nc_filenames, args.start, args.end, args.loc, args.rho_ice, args.rho_water,
+                           args.output_path, args.processes, args.weights_cache, args.gsfc_cache, args.store,
+                           instrument, stage_records, staging_settings, args.pipeline, tile_settings)
+    if args.stages is not None:
+        instrumentation.write_records(stage_records, args.stages)
+    if args.plot:
+        compared = [r['output'] for r in results if r['status'] == 'ok']
+        plot_results = plot_ensemble(args.obs, compared, args.loc, args.shapefile, args.plot_path, args.processes,
+                                     args.simplify, args.gsfc_cache)
+        results = results + plot_results
+    print_summary(results)
+    return 0 if all(r['status'] == 'ok' for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
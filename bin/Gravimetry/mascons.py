@@ -1,28 +1,61 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
 import numpy as np
-import xarray as xr
-import h5py
+
+# h5py, SciPy and xarray are imported by the functions that use them, so that importing this
+# module (e.g. in a process-pool worker that only bins model fields) stays fast
+
+# Per-mascon and per-epoch fields of a GSFC solution file
+MASCON_FIELDS = {'lat_center': '/mascon/lat_center',
+                 'lat_span': '/mascon/lat_span',
+                 'lon_center': '/mascon/lon_center',
+                 'lon_span': '/mascon/lon_span',
+                 'location': '/mascon/location',
+                 'basin': '/mascon/basin',
+                 'area_km2': '/mascon/area_km2'}
+TIME_FIELDS = {'ref_days_first': '/time/ref_days_first',
+               'ref_days_middle': '/time/ref_days_middle',
+               'ref_days_last': '/time/ref_days_last'}
 
 class GSFCmascons:
-    def __init__(self, f, lon_wrap='pm180'):
-        self.lat_centers = f['/mascon/lat_center'][0][:]
-        self.lat_spans = f['/mascon/lat_span'][0][:]
-        self.lon_centers = f['/mascon/lon_center'][0][:]
-        self.lon_spans = f['/mascon/lon_span'][0][:]
-        self.locations = f['/mascon/location'][0][:]
-        self.basins = f['/mascon/basin'][0][:]
-        self.areas = f['/mascon/area_km2'][0][:]
-        self.cmwe = f['/solution/cmwe'][:]
+    def __init__(self, f, lon_wrap='pm180', locations=None, epochs=None):
+        # locations and epochs optionally restrict which mascons and which
+        # cmwe columns are read; by default the whole solution is loaded.
+        self._set_fields(read_gsfc_fields(f, locations, epochs), lon_wrap)
+
+    @classmethod
+    def from_fields(cls, fields, lon_wrap='pm180'):
+        mascons = cls.__new__(cls)
+        mascons._set_fields(fields, lon_wrap)
+        return mascons
+
+    def _set_fields(self, fields, lon_wrap):
+        self.lat_centers = fields['lat_center']
+        self.lat_spans = fields['lat_span']
+        self.lon_centers = fields['lon_center']
+        self.lon_spans = fields['lon_span']
+        self.locations = fields['location']
+        self.basins = fields['basin']
+        self.areas = fields['area_km2']
+        self.cmwe = fields['cmwe']
+        self.source = None
         
-        self.days_start = f['/time/ref_days_first'][0][:]
-        self.days_middle = f['/time/ref_days_middle'][0][:]
-        self.days_end = f['/time/ref_days_last'][0][:]
+        self.days_start = fields['ref_days_first']
+        self.days_middle = fields['ref_days_middle']
+        self.days_end = fields['ref_days_last']
         self.times_start = self._set_times_as_datetimes(self.days_start)
         self.times_middle = self._set_times_as_datetimes(self.days_middle)
         self.times_end = self._set_times_as_datetimes(self.days_end)
 
         self.N_mascons = len(self.lat_centers)
         self.N_times = len(self.days_middle)
-        self.labels = np.array([i for i in range(self.N_mascons)])
+        # Labels are GSFC mascon indices, so they stay valid when only a subset is loaded
+        self.labels = fields['labels']
+        # Epochs (time indices) held in the columns of cmwe
+        self.epochs = fields['epochs']
         
         self.reset_lon_bounds(lon_wrap)
         
@@ -35,16 +68,41 @@ class GSFCmascons:
         self.min_lons = self.lon_centers - self.lon_spans/2
         self.max_lons = self.lon_centers + self.lon_spans/2
 
+    def epoch_cmwe(self, i):
+        # cmwe for all loaded mascons at time index i
+        if len(self.epochs) == self.N_times:
+            return self.cmwe[:, i]
+        col = np.searchsorted(self.epochs, i)
+        if col == len(self.epochs) or self.epochs[col] != i:
+            raise ValueError(f"Error: Epoch {i} was not loaded from the GSFC solution.")
+        return self.cmwe[:, col]
+
     def reset_lon_bounds(self, lon_wrap):
         if lon_wrap == 'pm180':
             self.lon_centers[self.lon_centers > 180] -= 360
         elif lon_wrap == '0to360':
             self.lon_centers[self.lon_centers < 0] += 360
+        # Box edges moved, so any existing index is stale
+        self._spatial_index = None
+
+    @property
+    def spatial_index(self):
+        # Built on first use from the unclipped box edges used by points_to_mascons
+        if getattr(self, '_spatial_index', None) is None:
+            self._spatial_index = MasconIndex(self.lat_centers - self.lat_spans/2,
+                                              self.lat_centers + self.lat_spans/2,
+                                              self.lon_centers - self.lon_spans/2,
+                                              self.lon_centers + self.lon_spans/2)
+        return self._spatial_index
+
+    def points_to_memberships(self, lats, lons):
+        return self.spatial_index.memberships(lats, lons)
 
     def _set_times_as_datetimes(self, days):
-        return np.datetime64('2002-01-01T00:00:00') + np.array([int(d*24) for d in days], dtype='timedelta64[h]')
+        return days_to_datetimes(days)
     
     def as_dataset(self):
+        import xarray as xr
         ds = xr.Dataset({'cmwe': (['label', 'time'], self.cmwe),
                          'lat_centers': ('label', self.lat_centers),
                          'lat_spans': ('label', self.lat_spans),
@@ -58,61 +116,297 @@ class GSFCmascons:
                          'lats_min': ('label', self.min_lats),
                          'lons_max': ('label', self.max_lons),
                          'lons_min': ('label', self.min_lons),
-                         'times_start': ('time', self.times_start),
-                         'times_end': ('time', self.times_end),
-                         'days_start': ('time', self.days_start),
-                         'days_middle': ('time', self.days_middle),
-                         'days_end': ('time', self.days_end)
-                        }, coords={'label': self.labels, 'time': self.times_middle})
+                         'times_start': ('time', self.times_start[self.epochs]),
+                         'times_end': ('time', self.times_end[self.epochs]),
+                         'days_start': ('time', self.days_start[self.epochs]),
+                         'days_middle': ('time', self.days_middle[self.epochs]),
+                         'days_end': ('time', self.days_end[self.epochs])
+                        }, coords={'label': self.labels, 'time': self.times_middle[self.epochs]})
         return ds
 
-def load_gsfc_solution(h5_filename, lon_wrap='pm180'):
-    with h5py.File(h5_filename, mode='r') as f:
-        mascons = GSFCmascons(f, lon_wrap)
+class MasconIndex:
+    """
+    Spatial index over mascon lat/lon boxes.
+    Mascons are grouped into latitude bands; within a band the boxes are sorted
+    by western edge so a point's box is found with two binary searches.
+    Boxes are half-open, [min, max), as in the per-box masks this replaces. Edges computed from
+    rounded centres and spans can overlap their neighbours by a rounding error, so a point exactly
+    on a shared edge (e.g. a grid column at lon 0) can lie in two boxes; it is then in both.
+    """
+    def __init__(self, min_lats, max_lats, min_lons, max_lons):
+        self.N_mascons = len(min_lats)
+
+        # One band per distinct (south, north) edge pair, ordered south to north
+        bands, band_of_mascon = np.unique(np.stack([min_lats, max_lats], axis=1), axis=0, return_inverse=True)
+        band_of_mascon = band_of_mascon.ravel()
+        self.band_min_lats = bands[:, 0]
+        self.band_max_lats = bands[:, 1]
+        # Northernmost edge of the bands up to each one, to find earlier bands still reaching a point
+        self.band_reach_lats = np.maximum.accumulate(self.band_max_lats)
+
+        # Mascon labels sorted by band, then by western edge
+        order = np.lexsort((min_lons, band_of_mascon))
+        self.sorted_labels = order
+        self.sorted_min_lons = min_lons[order]
+        self.sorted_max_lons = max_lons[order]
+        self.band_offsets = np.concatenate([[0], np.cumsum(np.bincount(band_of_mascon, minlength=len(bands)))])
+        # Easternmost edge of the boxes up to each one within its band
+        self.sorted_reach_lons = np.concatenate(
+            [np.maximum.accumulate(self.sorted_max_lons[lo:hi]) for lo, hi in zip(self.band_offsets[:-1], self.band_offsets[1:])]
+            + [np.empty(0)])
+
+    def memberships(self, lats, lons):
+        """
+        Return (points, labels): every pair of a point index and the label of a mascon box
+        containing it, ordered by point. Points outside every box are left out.
+        """
+        lats = np.asarray(lats).ravel()
+        lons = np.asarray(lons).ravel()
+
+        # Candidate bands: the last band whose southern edge is at or below each latitude, then
+        # earlier bands for as long as one of them still reaches the point
+        band = np.searchsorted(self.band_min_lats, lats, side='right') - 1
+        idx = np.flatnonzero(band >= 0)
+        b = band[idx]
+        band_points, band_bands = [], []
+        while len(idx):
+            inside = lats[idx] < self.band_max_lats[b]
+            band_points.append(idx[inside])
+            band_bands.append(b[inside])
+            more = b > 0
+            more[more] = self.band_reach_lats[b[more] - 1] > lats[idx[more]]
+            idx, b = idx[more], b[more] - 1
+        if not band_points:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        idx = np.concatenate(band_points)
+        b = np.concatenate(band_bands)
+
+        # Visit points band by band; each band is one binary search over its sorted western edges,
+        # then earlier boxes of the band for as long as one of them still reaches the point
+        order = np.argsort(b, kind='stable')
+        idx, b = idx[order], b[order]
+        bands_present, starts = np.unique(b, return_index=True)
+        stops = np.append(starts[1:], len(b))
+
+        points, labels = [], []
+        for band_index, start, stop in zip(bands_present, starts, stops):
+            b_idx = idx[start:stop]
+            b_lons = lons[b_idx]
+            lo = self.band_offsets[band_index]
+            pos = lo + np.searchsorted(self.sorted_min_lons[lo:self.band_offsets[band_index + 1]], b_lons, side='right') - 1
+            while len(b_idx):
+                valid = pos >= lo
+                safe = np.where(valid, pos, lo)
+                inside = valid & (b_lons < self.sorted_max_lons[safe])
+                points.append(b_idx[inside])
+                labels.append(self.sorted_labels[safe[inside]])
+                more = pos > lo
+                more[more] = self.sorted_reach_lons[pos[more] - 1] > b_lons[more]
+                b_idx, b_lons, pos = b_idx[more], b_lons[more], pos[more] - 1
+
+        points = np.concatenate(points)
+        labels = np.concatenate(labels).astype(np.int64)
+        order = np.lexsort((labels, points))
+        return points[order], labels[order]
+
+
+def days_to_datetimes(days):
+    return np.datetime64('2002-01-01T00:00:00') + np.array([int(d*24) for d in days], dtype='timedelta64[h]')
+
+def read_gsfc_fields(f, locations=None, epochs=None):
+    # Read the solution fields, optionally only for mascons whose location code is in
+    # locations and only the cmwe columns of the time indices in epochs.
+    # Subsets are read as hyperslabs spanning the selected mascons.
+    N_mascons = f['/mascon/location'].shape[1]
+    if locations is None:
+        labels = np.arange(N_mascons)
+    else:
+        labels = np.flatnonzero(np.isin(f['/mascon/location'][0][:], locations))
+    lo, hi = (labels[0], labels[-1] + 1) if len(labels) else (0, 0)
+    rows = labels - lo
+
+    fields = {name: f[path][0, lo:hi][rows] for name, path in MASCON_FIELDS.items()}
+    fields.update({name: f[path][0][:] for name, path in TIME_FIELDS.items()})
+
+    N_times = len(fields['ref_days_middle'])
+    if epochs is None:
+        epochs = np.arange(N_times)
+        cols = slice(None)
+    else:
+        epochs = np.unique(np.asarray(epochs, dtype=np.int64))
+        cols = list(epochs)
+
+    if locations is None and len(epochs) == N_times:
+        fields['cmwe'] = f['/solution/cmwe'][:]
+    else:
+        fields['cmwe'] = f['/solution/cmwe'][lo:hi, cols][rows]
+
+    fields['labels'] = labels
+    fields['epochs'] = epochs
+    return fields
+
+def mascon_epoch_indices(times_start, times_end, start_date, end_date):
+    # Time indices of the solutions closest to the start and end of a date range
+    t_0 = np.datetime64(start_date)
+    t_1 = np.datetime64(end_date)
+    
+    i_0 = np.abs(times_start - t_0).argmin()
+    i_1 = np.abs(times_end - t_1).argmin()
+
+    return i_0, i_1
+
+def load_gsfc_solution(h5_filename, lon_wrap='pm180', locations=None, windows=None, cache_dir=None):
+    # locations: mascon location codes to load (e.g. [1] for GIS, [3, 4] for AIS); all if None
+    # windows: (start_date, end_date) pairs; only the cmwe epochs they need are read
+    # cache_dir: load from (building on first use) a memory-mapped cache of the solution instead
+    if cache_dir is not None:
+        cache_path = gsfc_cache_path(cache_dir, h5_filename, locations)
+        if not gsfc_cache_valid(cache_path, h5_filename):
+            build_gsfc_cache(h5_filename, cache_path, locations)
+        mascons = load_gsfc_cache(cache_path, lon_wrap)
+    else:
+        import h5py
+        with h5py.File(h5_filename, mode='r') as f:
+            epochs = None
+            if windows is not None:
+                times_start = days_to_datetimes(f['/time/ref_days_first'][0][:])
+                times_end = days_to_datetimes(f['/time/ref_days_last'][0][:])
+                epochs = [i for window in windows for i in mascon_epoch_indices(times_start, times_end, *window)]
+            mascons = GSFCmascons(f, lon_wrap, locations, epochs)
+
+    # The solution file, to identify the solution in result cache keys
+    mascons.source = os.path.abspath(h5_filename)
     return mascons
 
+
+### Memory-mapped cache of a GSFC solution
+# The mascon and time fields are stored as .npy files; cmwe is stored as float32 and
+# epoch-major, so reading the solution at one epoch touches one contiguous block.
+GSFC_CACHE_VERSION = 1
+
+def gsfc_cache_path(cache_dir, h5_filename, locations=None):
+    # Named by the file name and a hash of its absolute path, so solutions with the same
+    # file name in different directories get caches of their own
+    name = os.path.splitext(os.path.basename(h5_filename))[0]
+    name += '_' + hashlib.sha1(os.path.abspath(h5_filename).encode()).hexdigest()[:12]
+    if locations is not None:
+        name += '_loc' + '-'.join(str(int(l)) for l in sorted(locations))
+    return os.path.join(cache_dir, name)
+
+def _source_identity(h5_filename):
+    stat = os.stat(h5_filename)
+    return {'source': os.path.abspath(h5_filename), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def gsfc_cache_valid(cache_path, h5_filename):
+    try:
+        with open(os.path.join(cache_path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return False
+    return meta.get('version') == GSFC_CACHE_VERSION and meta.get('identity') == _source_identity(h5_filename)
+
+def build_gsfc_cache(h5_filename, cache_path, locations=None):
+    # The cache is written to a temporary directory next to cache_path and renamed into place, so
+    # concurrent builders never write into a cache another process is reading, and a stale cache
+    # moved aside stays readable by processes that have its files memory-mapped
+    import h5py
+    with h5py.File(h5_filename, mode='r') as f:
+        fields = read_gsfc_fields(f, locations)
+
+    parent = os.path.dirname(os.path.abspath(cache_path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix=os.path.basename(cache_path) + '.tmp.')
+    stale_path = None
+    try:
+        for name, values in fields.items():
+            if name == 'cmwe':
+                np.save(os.path.join(tmp_path, 'cmwe_by_epoch.npy'), np.ascontiguousarray(values.T, dtype=np.float32))
+            else:
+                np.save(os.path.join(tmp_path, name + '.npy'), values)
+        meta = {'version': GSFC_CACHE_VERSION, 'identity': _source_identity(h5_filename),
+                'locations': None if locations is None else [int(l) for l in locations]}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        if os.path.exists(cache_path) and not gsfc_cache_valid(cache_path, h5_filename):
+            stale_path = tempfile.mkdtemp(dir=parent, prefix=os.path.basename(cache_path) + '.stale.')
+            try:
+                os.replace(cache_path, stale_path)
+            except FileNotFoundError:
+                # Already moved aside by another builder
+                pass
+        try:
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # Another builder put its cache in place first
+            if not gsfc_cache_valid(cache_path, h5_filename):
+                raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if stale_path is not None:
+            shutil.rmtree(stale_path, ignore_errors=True)
+
+def load_gsfc_cache(cache_path, lon_wrap='pm180'):
+    fields = {name: np.load(os.path.join(cache_path, name + '.npy'))
+              for name in list(MASCON_FIELDS) + list(TIME_FIELDS) + ['labels', 'epochs']}
+    fields['cmwe'] = np.load(os.path.join(cache_path, 'cmwe_by_epoch.npy'), mmap_mode='r').T
+    return GSFCmascons.from_fields(fields, lon_wrap)
+
+def points_to_mascon_sums(mascons, lats, lons, values):
+    # Per-mascon sums and counts of the values of the points, without NaN values and points outside
+    # every mascon (a point in two boxes counts in both). Sums and counts of separate sets of
+    # points add up to those of their union.
+    points, labels = mascons.points_to_memberships(lats, lons)
+    values = np.asarray(values).ravel()[points]
+
+    I_ = ~np.isnan(values)
+    sums = np.bincount(labels[I_], weights=values[I_], minlength=mascons.N_mascons)
+    counts = np.bincount(labels[I_], minlength=mascons.N_mascons)
+    return sums, counts
+
+def sums_to_mascons(sums, counts):
+    # Mascon means from points_to_mascon_sums, NaN for mascons without points
+    mscn_mean = np.nan * np.ones(len(sums))
+    np.divide(sums, counts, out=mscn_mean, where=counts > 0)
+
+    return mscn_mean
+
 def points_to_mascons(mascons, lats, lons, values):
-    d2r = np.pi/180
-    
-    min_lats = mascons.lat_centers - mascons.lat_spans/2
-    max_lats = mascons.lat_centers + mascons.lat_spans/2
-    min_lons = mascons.lon_centers - mascons.lon_spans/2
-    max_lons = mascons.lon_centers + mascons.lon_spans/2
-    
-    mscn_mean = np.nan * np.ones(mascons.N_mascons)
-    for i in range(mascons.N_mascons):
-        
-        if np.min(lats) > max_lats[i]:
-            continue
-        if np.max(lats) < min_lats[i]:
-            continue
-        if np.min(lons) > max_lons[i]:
-            continue
-        if np.max(lons) < min_lons[i]:
-            continue
-        
-        I_ = (lats >= min_lats[i]) & (lats < max_lats[i]) & (lons >= min_lons[i]) & (lons < max_lons[i])
-        m = values[I_]
-        m_lats = lats[I_]
-        
-        m_lats = m_lats[~np.isnan(m)]
-        m = m[~np.isnan(m)]
-        
-        if len(m) == 0:
-            continue
-        if np.sum(~np.isnan(m)) == 0:
-            continue
+    # Find the mascons of each point, then average per mascon.
+    # Points outside every mascon, and NaN values, are left out of the means.
+    return sums_to_mascons(*points_to_mascon_sums(mascons, lats, lons, values))
+
+def memberships_to_mascon_weights(n_mascons, n_points, points, labels):
+    # Sparse (mascon x point) membership matrix of the (points, labels) of points_to_memberships
+    from scipy import sparse
+    return sparse.csr_matrix((np.ones(len(points)), (labels, points)), shape=(n_mascons, n_points))
+
+def points_to_mascon_weights(mascons, lats, lons):
+    # Sparse (mascon x point) membership matrix: 1 where a point falls in a mascon.
+    # Lets points_to_mascons be repeated for new values on the same points as a mat-vec.
+    return memberships_to_mascon_weights(mascons.N_mascons, np.size(lats), *mascons.points_to_memberships(lats, lons))
+
+def weights_to_mascons(weights, values):
+    # Same means as points_to_mascons, using weights from points_to_mascon_weights.
+    # values is one value per point, or a (point x k) array averaged column by column.
+    values = np.asarray(values)
+    if values.ndim == 1:
+        return weights_to_mascons(weights, values[:, None])[:, 0]
+
+    nans = np.isnan(values)
+    if nans.any():
+        sums = weights @ np.where(nans, 0, values)
+        counts = weights @ (~nans).astype(np.float64)
+    else:
+        sums = weights @ values
+        counts = np.repeat(np.diff(weights.indptr).astype(np.float64)[:, None], values.shape[1], axis=1)
+
+    mscn_mean = np.nan * np.ones(sums.shape)
+    np.divide(sums, counts, out=mscn_mean, where=counts > 0)
 
-        cos_weight = np.cos(m_lats*d2r)
-        mscn_mean[i] = np.nanmean(m) # * cos_weight) / (np.sum(cos_weight) * len(m))
-    
     return mscn_mean
 
 def calc_mascon_delta_cmwe(mascons, start_date, end_date):
-    t_0 = np.datetime64(start_date)
-    t_1 = np.datetime64(end_date)
-    
-    i_0 = np.abs(mascons.times_start - t_0).argmin()
-    i_1 = np.abs(mascons.times_end - t_1).argmin()
+    i_0, i_1 = mascon_epoch_indices(mascons.times_start, mascons.times_end, start_date, end_date)
     
-    return mascons.cmwe[:,i_1] - mascons.cmwe[:,i_0]
+    return mascons.epoch_cmwe(i_1) - mascons.epoch_cmwe(i_0)
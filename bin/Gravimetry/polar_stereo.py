@@ -0,0 +1,114 @@
+import numpy as np
+
+# Closed-form inverse of the WGS84 polar stereographic projections used for model grids.
+# Only needs NumPy, so compute workers can put model grids into lat/lon without cartopy.
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1/298.257223563
+
+# Model projections, as defined by set_projection in gravimetry_utils
+PROJECTIONS = {
+    'GIS': {'central_latitude': 90.0, 'central_longitude': -45.0, 'true_scale_latitude': 70.0,
+            'false_easting': 0.0, 'false_northing': 0.0},
+    'AIS': {'central_latitude': -90.0, 'central_longitude': 0.0, 'true_scale_latitude': -71.0,
+            'false_easting': 0.0, 'false_northing': 0.0},
+}
+
+
+def projection_params(projection):
+    """
+    Return the polar stereographic parameters for a projection.
+    projection is either a key of PROJECTIONS ('GIS' or 'AIS') or a cartopy Stereographic CRS.
+    """
+    if isinstance(projection, str):
+        try:
+            return PROJECTIONS[projection]
+        except KeyError:
+            raise ValueError(f"Error: Input loc is equal to '{projection}', not 'AIS' or 'GIS'")
+
+    params = getattr(projection, 'proj4_params', None)
+    if params is None or params.get('proj') != 'stere' or abs(params.get('lat_0', 0.0)) != 90.0:
+        raise ValueError('Error: Only polar stereographic projections are supported.')
+    if params.get('ellps', 'WGS84') != 'WGS84' or any(k in params for k in ('a', 'b', 'rf')):
+        raise ValueError('Error: Only the WGS84 ellipsoid is supported.')
+
+    return {'central_latitude': float(params['lat_0']),
+            'central_longitude': float(params.get('lon_0', 0.0)),
+            'true_scale_latitude': float(params.get('lat_ts', params['lat_0'])),
+            'false_easting': float(params.get('x_0', 0.0)),
+            'false_northing': float(params.get('y_0', 0.0))}
+
+
+def _conformal_factor(e, phi):
+    # t(phi) from Snyder (1987), eq. 15-9
+    e_sin = e * np.sin(phi)
+    return np.tan(np.pi/4 - phi/2) / ((1 - e_sin) / (1 + e_sin))**(e/2)
+
+
+def inverse(x, y, projection, dtype=np.float64, chunk_size=2**20):
+    """
+    Inverse polar stereographic projection of the grid spanned by the 1-D x and y vectors.
+
+    Returns flattened lats and lons (degrees) in x-major order, i.e. the order of
+    np.meshgrid(y, x) flattened, matching the transposed and flattened model fields.
+    Longitudes are wrapped to [-180, 180] as proj does. The grid is processed in blocks of about
+    chunk_size cells, so temporary memory stays bounded on large grids; the outputs
+    are written directly in dtype (e.g. np.float32).
+    """
+    params = projection_params(projection)
+    a = WGS84_A
+    e = np.sqrt(WGS84_F * (2 - WGS84_F))
+
+    # Work in the north polar aspect; the south polar case mirrors x, y and latitude
+    south = params['central_latitude'] < 0
+    sign = -1.0 if south else 1.0
+    lon_0 = np.deg2rad(params['central_longitude'])
+    phi_c = np.deg2rad(sign * params['true_scale_latitude'])
+
+    # rho = scale * t (Snyder eqs. 21-33 to 21-35)
+    if np.isclose(phi_c, np.pi/2):
+        scale = 2 * a / np.sqrt((1 + e)**(1 + e) * (1 - e)**(1 - e))
+    else:
+        m_c = np.cos(phi_c) / np.sqrt(1 - (e * np.sin(phi_c))**2)
+        scale = a * m_c / _conformal_factor(e, phi_c)
+
+    # Separable parts of the grid
+    xs = sign * (np.asarray(x, dtype=np.float64).ravel() - params['false_easting'])
+    ys = sign * (np.asarray(y, dtype=np.float64).ravel() - params['false_northing'])
+    y2 = ys**2
+
+    # Series coefficients for latitude from conformal latitude (Snyder eq. 3-5)
+    e2 = e**2
+    c2 = e2/2 + 5*e2**2/24 + e2**3/12 + 13*e2**4/360
+    c4 = 7*e2**2/48 + 29*e2**3/240 + 811*e2**4/11520
+    c6 = 7*e2**3/120 + 81*e2**4/1120
+    c8 = 4279*e2**4/161280
+
+    nx, ny = len(xs), len(ys)
+    lats = np.empty(nx * ny, dtype=dtype)
+    lons = np.empty(nx * ny, dtype=dtype)
+
+    rows = max(1, chunk_size // max(ny, 1))
+    for i0 in range(0, nx, rows):
+        xb = xs[i0:i0+rows, None]
+
+        t = np.sqrt(xb**2 + y2) / scale
+        chi = np.pi/2 - 2 * np.arctan(t)
+        phi = (chi + c2 * np.sin(2*chi) + c4 * np.sin(4*chi)
+                   + c6 * np.sin(6*chi) + c8 * np.sin(8*chi))
+        # One fixed-point step on the exact relation takes the series error well below a millimetre
+        e_sin = e * np.sin(phi)
+        phi = np.pi/2 - 2 * np.arctan(t * ((1 - e_sin) / (1 + e_sin))**(e/2))
+
+        lam = sign * np.arctan2(xb, -ys) + lon_0
+
+        block = slice(i0 * ny, min(i0 + rows, nx) * ny)
+        lam = np.rad2deg(lam)
+        lam[lam > 180] -= 360
+        lam[lam < -180] += 360
+
+        lats[block] = (sign * np.rad2deg(phi)).ravel()
+        lons[block] = lam.ravel()
+
+    return lats, lons
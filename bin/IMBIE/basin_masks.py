@@ -0,0 +1,251 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+import tiling
+
+# Basin membership of the cells of a model grid, for summing model fields by basin.
+# Every grid cell centre is tested against every basin polygon with the "intersects" predicate,
+# so the sums match a geopandas sjoin of the cell centres with the shapefile: a cell on the
+# boundary of two polygons counts in both, and cells outside all polygons count in none.
+# Membership depends only on the grid and the shapefile, so it is computed once and cached.
+# shapely, geopandas and SciPy are imported where they are used, so loading cached masks is fast.
+
+# Attribute columns the IMBIE comparison groups by
+BASIN_COLUMNS = ['SUBREGION1', 'Subregion', 'Regions']
+
+BASIN_MASK_CACHE_VERSION = 1
+
+# Cells per side of the blocks tested against a polygon as a whole
+BLOCK_SIZE = 64
+
+
+class BasinMasks:
+    def __init__(self, labels, overflow_cells, overflow_rows, groups):
+        # labels: polygon row of each cell (x-major order), -1 outside all polygons
+        # overflow_cells, overflow_rows: further (cell, row) memberships of cells in several polygons
+        # groups: {column: (names, row_groups)}; row_groups is the index into names of each polygon row, -1 if missing
+        self.labels = labels
+        self.overflow_cells = overflow_cells
+        self.overflow_rows = overflow_rows
+        self.groups = groups
+        self._group_matrices = {}
+
+    def sums(self, values, column, tiles=None, workers=None):
+        # Sum of values (flattened in x-major order) by the basin attribute column,
+        # as the Series groupby(column)['lithk_delta'].sum() gives after the sjoin.
+        # tiles: (cell_start, cell_stop) ranges (tiling.cell_tiles) summed separately on `workers`
+        # threads; their totals and counts add up to those of the whole grid.
+        if column not in self.groups:
+            raise ValueError(f"Error: The column '{column}' does not exist in the basin shapefile.")
+        names, row_groups = self.groups[column]
+        values = np.asarray(values, dtype=np.float64)
+
+        if tiles is None:
+            totals, counts = self._tile_sums(values, row_groups, len(names), 0, len(values))
+        else:
+            totals = np.zeros(len(names))
+            counts = np.zeros(len(names), dtype=np.int64)
+            partial_sums = lambda start, stop: self._tile_sums(values, row_groups, len(names), start, stop)
+            for tile_totals, tile_counts in tiling.map_tiles(partial_sums, tiles, workers):
+                totals += tile_totals
+                counts += tile_counts
+
+        # Only groups with at least one cell, in sorted order
+        present = counts > 0
+        return pd.Series(totals[present], index=pd.Index(names[present], name=column), name='lithk_delta')
+
+    def _tile_sums(self, values, row_groups, n_groups, start, stop):
+        # Totals and counts by group of the cells start..stop-1
+        labels = self.labels[start:stop]
+        inside = labels >= 0
+        cell_groups = row_groups[labels[inside]]
+        cell_values = values[start:stop][inside]
+        if start == 0 and stop == len(self.labels):
+            overflow_cells, overflow_rows = self.overflow_cells, self.overflow_rows
+        else:
+            in_tile = (self.overflow_cells >= start) & (self.overflow_cells < stop)
+            overflow_cells, overflow_rows = self.overflow_cells[in_tile], self.overflow_rows[in_tile]
+        overflow_groups = row_groups[overflow_rows]
+        overflow_values = values[overflow_cells]
+
+        # Polygons without a value in the column are left out, as groupby drops missing keys
+        group_index = np.concatenate([cell_groups, overflow_groups])
+        group_values = np.concatenate([cell_values, overflow_values])
+        keep = group_index >= 0
+        totals = np.bincount(group_index[keep], weights=group_values[keep], minlength=n_groups)
+        counts = np.bincount(group_index[keep], minlength=n_groups)
+        return totals, counts
+
+    def group_matrix(self, column):
+        # (names, cells, matrix) for summing many fields at once by column: cells are the grid cells
+        # (x-major indices) in any basin, and matrix is the sparse (group x cell) count of memberships,
+        # so matrix @ values[cells] gives the same sums as sums() for each column of values.
+        # Only groups with at least one cell are included, in sorted order.
+        if column not in self.groups:
+            raise ValueError(f"Error: The column '{column}' does not exist in the basin shapefile.")
+        if column not in self._group_matrices:
+            from scipy import sparse
+            names, row_groups = self.groups[column]
+            cells = np.flatnonzero(self.labels >= 0)
+            group_index = np.concatenate([row_groups[self.labels[cells]], row_groups[self.overflow_rows]])
+            cell_index = np.concatenate([np.arange(len(cells)), np.searchsorted(cells, self.overflow_cells)])
+            keep = group_index >= 0
+            # Duplicate (group, cell) entries add up, as duplicate sjoin rows do
+            matrix = sparse.csr_matrix((np.ones(keep.sum()), (group_index[keep], cell_index[keep])),
+                                       shape=(len(names), len(cells)))
+            present = np.diff(matrix.indptr) > 0
+            self._group_matrices[column] = (names[present], cells, matrix[present])
+        return self._group_matrices[column]
+
+
+def _cell_memberships(geometry, x_coords, y_coords, x_offset=0):
+    # Sorted flattened x-major indices of the grid cells whose centre intersects geometry
+    # (x_coords: the columns x_offset.. of the grid, for one tile of it)
+    import shapely
+    ny = len(y_coords)
+    if geometry is None or geometry.is_empty:
+        return np.empty(0, dtype=np.int64)
+    min_x, min_y, max_x, max_y = geometry.bounds
+    ix = np.flatnonzero((x_coords >= min_x) & (x_coords <= max_x))
+    iy = np.flatnonzero((y_coords >= min_y) & (y_coords <= max_y))
+    if len(ix) == 0 or len(iy) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    shapely.prepare(geometry)
+    cells = []
+    # Blocks wholly inside the polygon are taken whole, blocks clear of it are skipped,
+    # and only the cells of blocks on its boundary are tested one by one
+    for bx in range(0, len(ix), BLOCK_SIZE):
+        block_x = ix[bx:bx + BLOCK_SIZE]
+        xs = x_coords[block_x]
+        for by in range(0, len(iy), BLOCK_SIZE):
+            block_y = iy[by:by + BLOCK_SIZE]
+            ys = y_coords[block_y]
+            # (a block one cell wide has no area, so its cells are always tested)
+            block = shapely.box(xs.min(), ys.min(), xs.max(), ys.max()) if len(block_x) > 1 and len(block_y) > 1 else None
+            if block is not None and shapely.contains(geometry, block):
+                hits = np.ones((len(block_x), len(block_y)), dtype=bool)
+            elif block is not None and shapely.disjoint(geometry, block):
+                continue
+            else:
+                hits = shapely.intersects_xy(geometry, np.repeat(xs, len(block_y)), np.tile(ys, len(block_x)))
+                hits = hits.reshape(len(block_x), len(block_y))
+            jx, jy = np.nonzero(hits)
+            cells.append((block_x[jx].astype(np.int64) + x_offset) * ny + block_y[jy])
+    return np.sort(np.concatenate(cells)) if cells else np.empty(0, dtype=np.int64)
+
+
+def _group_codes(column_values):
+    # Sorted distinct names of a column and each row's index into them (-1 where missing)
+    present = column_values.notna().to_numpy()
+    names = np.array(sorted(set(column_values[present].astype(str))), dtype=str)
+    row_groups = np.full(len(column_values), -1, dtype=np.int64)
+    row_groups[present] = np.searchsorted(names, column_values[present].astype(str).to_numpy())
+    return names, row_groups
+
+
+def build_basin_masks(x_coords, y_coords, shape_filename, tile_cells=None, workers=None):
+    # tile_cells: test the polygons against strips of about this many cells, on `workers` threads;
+    # the memberships of the strips are concatenated in order, so the masks are the same
+    import geopandas as gpd
+    basins_gdf = gpd.read_file(shape_filename)
+
+    x_coords = np.asarray(x_coords, dtype=np.float64)
+    y_coords = np.asarray(y_coords, dtype=np.float64)
+    if tile_cells is None:
+        memberships = [_cell_memberships(geometry, x_coords, y_coords) for geometry in basins_gdf.geometry]
+    else:
+        import shapely
+        geometries = list(basins_gdf.geometry)
+        # Prepared here, before the threads share them
+        shapely.prepare([geometry for geometry in geometries if geometry is not None])
+        strips = tiling.strip_tiles(len(x_coords), len(y_coords), tile_cells)
+        tiles = [(row, x_start, x_stop) for row in range(len(geometries)) for x_start, x_stop in strips]
+        tile_memberships = tiling.map_tiles(
+            lambda row, x_start, x_stop: _cell_memberships(geometries[row], x_coords[x_start:x_stop], y_coords, x_start),
+            tiles, workers)
+        memberships = [np.concatenate(tile_memberships[row * len(strips):(row + 1) * len(strips)])
+                       for row in range(len(geometries))]
+
+    cells = np.concatenate(memberships) if memberships else np.empty(0, dtype=np.int64)
+    rows = np.concatenate([np.full(len(m), i, dtype=np.int64) for i, m in enumerate(memberships)]) if memberships else np.empty(0, dtype=np.int64)
+
+    # First polygon of each cell in the label array, any further ones in the overflow list
+    labels = np.full(len(x_coords) * len(y_coords), -1, dtype=np.int32 if len(basins_gdf) > 32767 else np.int16)
+    _, first = np.unique(cells, return_index=True)
+    labels[cells[first]] = rows[first]
+    extra = np.ones(len(cells), dtype=bool)
+    extra[first] = False
+
+    groups = {column: _group_codes(basins_gdf[column]) for column in BASIN_COLUMNS if column in basins_gdf.columns}
+    return BasinMasks(labels, cells[extra], rows[extra], groups)
+
+
+### Cache
+# Masks are stored as .npz files named by a hash of the grid coordinates and the shapefile's
+# identity (path, size and modification time of its files), so an edited shapefile or a
+# different grid never reuses stale masks.
+
+def _shapefile_identity(shape_filename):
+    stem = os.path.splitext(os.path.abspath(shape_filename))[0]
+    identity = []
+    for ext in ('.shp', '.shx', '.dbf'):
+        if os.path.exists(stem + ext):
+            stat = os.stat(stem + ext)
+            identity.append([stem + ext, stat.st_size, stat.st_mtime_ns])
+    return identity
+
+
+def basin_mask_key(x_coords, y_coords, shape_filename):
+    h = hashlib.sha1()
+    h.update(str(BASIN_MASK_CACHE_VERSION).encode())
+    for coords in (x_coords, y_coords):
+        h.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+    h.update(json.dumps(_shapefile_identity(shape_filename)).encode())
+    return h.hexdigest()
+
+
+def save_basin_masks(masks, filename):
+    arrays = {'labels': masks.labels, 'overflow_cells': masks.overflow_cells, 'overflow_rows': masks.overflow_rows}
+    for column, (names, row_groups) in masks.groups.items():
+        arrays[f'names_{column}'] = names
+        arrays[f'row_groups_{column}'] = row_groups
+    # Write under a temporary name first so concurrent runs never read a partial file
+    tmp_filename = filename[:-len('.npz')] + f'.{os.getpid()}.tmp.npz'
+    np.savez(tmp_filename, **arrays)
+    os.replace(tmp_filename, filename)
+
+
+def load_basin_mask_file(filename):
+    with np.load(filename) as data:
+        groups = {key[len('names_'):]: (data[key], data['row_groups_' + key[len('names_'):]])
+                  for key in data.files if key.startswith('names_')}
+        return BasinMasks(data['labels'], data['overflow_cells'], data['overflow_rows'], groups)
+
+
+# Masks used in this process, so an ensemble on one grid builds or reads them once
+_loaded_masks = {}
+
+def load_basin_masks(x_coords, y_coords, shape_filename, cache_dir=None, tile_cells=None, workers=None):
+    # Basin masks for the grid, from memory, from cache_dir, or built (and saved to cache_dir)
+    # (tile_cells, workers: see build_basin_masks)
+    key = basin_mask_key(x_coords, y_coords, shape_filename)
+    if key in _loaded_masks:
+        return _loaded_masks[key]
+
+    filename = None if cache_dir is None else os.path.join(cache_dir, f'basin_masks_{key}.npz')
+    if filename is not None and os.path.exists(filename):
+        masks = load_basin_mask_file(filename)
+    else:
+        masks = build_basin_masks(x_coords, y_coords, shape_filename, tile_cells, workers)
+        if filename is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            save_basin_masks(masks, filename)
+
+    if len(_loaded_masks) >= 4:
+        _loaded_masks.pop(next(iter(_loaded_masks)))
+    _loaded_masks[key] = masks
+    return masks
@@ -0,0 +1,347 @@
+### Headless IMBIE comparison of a model ensemble
+# Reads the IMBIE observations once and prepares the basin masks once per model grid, then
+# computes the basin and regional mass change of many model files in a process pool.
+# All results go to one tidy table (model x basin/region x quantity), as CSV and optionally Parquet.
+#
+# Example:
+#   python imbie_ensemble.py --icesheet AIS --start 2007-01-01 --end 2014-01-01 \
+#       --obs imbie_antarctica_2021_Gt.csv --obs-east imbie_east_antarctica_2021_Gt.csv \
+#       --obs-west imbie_west_antarctica_2021_Gt.csv --obs-peninsula imbie_antarctic_peninsula_2021_Gt.csv \
+#       --shapefile ANT_Basins_IMBIE2_v1.6.shp --output imbie_AIS.csv --parquet imbie_AIS.parquet \
+#       --models '/home/jovyan/shared-public/CmCt/models/ISMIP6/lithk_AIS_*_*_hist_std.nc'
+#
+# With --index models.sqlite, the models are chosen from a metadata index of the collection (see
+# model_index.py), and the basin masks are prepared from the indexed grids without opening the files.
+# With --staging-dir /scratch/models, the model files are read from local copies (see staging.py).
+# With --pipeline 2, the models are compared in this process instead, with the reads of the next two
+# models and the CSV writes overlapping the computation (see pipeline.py), e.g. for a run on one core.
+import os,sys
+import glob
+import shutil
+import argparse
+import tempfile
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from imbie_utils import process_model_data, IMBIE_observations, compare_with_IMBIE, write_mass_change_comparison
+from basin_masks import load_basin_masks
+from model_reader import ModelReader
+import instrumentation
+import staging
+import pipeline
+from model_index import ModelIndex, select_models
+
+
+# Model grid projections
+PROJECTIONS = {'GIS': 'EPSG:3413', 'AIS': 'EPSG:3031'}
+
+# Mass balance type of each IMBIE column, as named in the comparison output
+MASS_BALANCE_TYPES = {'Cumulative mass balance (Gt)': 'total',
+                      'Cumulative dynamics mass balance anomaly (Gt)': 'dynamic'}
+
+# Columns of the ensemble table
+TABLE_COLUMNS = ['model', 'icesheet', 'level', 'area', 'quantity', 'value_gt', 'start_date', 'end_date', 'mass_balance_type']
+
+
+# Observation state of the current worker process, set once by _init_worker
+_state = None
+
+
+def _init_worker(state):
+    global _state
+    _state = state
+    if state.get('instrument') is not None:
+        instrumentation.enable(**state['instrument'])
+    if state.get('staging') is not None:
+        staging.configure(**state['staging'])
+
+
+def model_name(nc_filename):
+    return os.path.splitext(os.path.basename(nc_filename))[0]
+
+
+def compute_model(state, nc_filename, model=None):
+    # Basin and regional mass change of one model and its comparison with IMBIE.
+    # model: nc_filename already opened as a ModelReader
+    basin_result = process_model_data(nc_filename, state['start_date'], state['end_date'], state['rho_ice'],
+                                      state['projection'], state['shape_filename'], state['icesheet'],
+                                      mask_cache_dir=state['mask_cache_dir'], model=model, **(state['tiles'] or {}))
+    results = compare_with_IMBIE(state['observations'], state['icesheet'], basin_result)
+    return basin_result, results
+
+
+def write_model(state, nc_filename, output):
+    if state['csv_output_path'] is not None:
+        # The per-model CSV of the notebooks
+        basin_result, results = output
+        csv_filename = os.path.join(state['csv_output_path'], f'{model_name(nc_filename)}.csv')
+        write_mass_change_comparison(state['icesheet'], basin_result, results, state['mass_balance_type'],
+                                     state['start_date'], state['end_date'], csv_filename)
+    return output
+
+
+def compare_model(state, nc_filename):
+    return write_model(state, nc_filename, compute_model(state, nc_filename))
+
+
+def _run_model(nc_filename):
+    # Worker task: never raises, so one failing model does not stop the ensemble.
+    # With instrumentation enabled, the stage timings of the model are returned as 'stages'.
+    with instrumentation.recording(model=nc_filename) as record:
+        try:
+            result = {'model': nc_filename, 'status': 'ok', 'output': compare_model(_state, nc_filename), 'error': None}
+        except Exception as error:
+            result = {'model': nc_filename, 'status': 'failed', 'output': None,
+                      'error': f'{type(error).__name__}: {error}', 'traceback': traceback.format_exc()}
+    result['stages'] = record['stages']
+    return result
+
+
+def run_pipelined(state, nc_filenames, depth=2):
+    # Compare the models one at a time in this process, with the next `depth` models opened and their
+    # bracketing slices read on a prefetch thread, and the per-model CSVs written on a writer thread.
+    # Yields the result of each model, in input order, as _run_model returns them.
+    dates = [state['start_date'], state['end_date']]
+    return pipeline.run_pipeline(nc_filenames, lambda nc_filename: pipeline.prefetch_model(nc_filename, dates),
+                                 lambda nc_filename, model: compute_model(state, nc_filename, model),
+                                 lambda nc_filename, output: write_model(state, nc_filename, output),
+                                 pipeline.close_model, depth, depth)
+
+
+def table_rows(name, state, basin_result, results):
+    # Tidy rows of one model: model mass change of every basin and region, and the
+    # IMBIE mass change and residual (IMBIE - model) wherever IMBIE has a value
+    rows = []
+
+    def add(level, area, quantity, value):
+        rows.append([name, state['icesheet'], level, area, quantity, float(value),
+                     state['start_date'], state['end_date'], state['mass_balance_type']])
+
+    for basin, value in basin_result['basin_mass_change_sums'].items():
+        add('basin', basin, 'model_mass_change', value)
+
+    region_mass_change_sums = basin_result.get('region_mass_change_sums')
+    if region_mass_change_sums is not None:
+        for region, value in region_mass_change_sums.items():
+            add('region', region, 'model_mass_change', value)
+            key = region.lower()
+            if f'IMBIE_total_mass_change_sum_{key}' in results:
+                add('region', region, 'imbie_mass_change', results[f'IMBIE_total_mass_change_sum_{key}'])
+                add('region', region, 'residual', results[f'delta_masschange_{key}'])
+
+    add('total', 'Total', 'model_mass_change', basin_result['model_total_mass_balance'])
+    add('total', 'Total', 'imbie_mass_change', results['IMBIE_total_mass_change_sum'])
+    add('total', 'Total', 'residual', results['delta_masschange'])
+    return rows
+
+
+def prepare_basin_masks(nc_filenames, shape_filename, mask_cache_dir, index_filename=None, tile_settings=None):
+    # Build the basin masks of every distinct model grid once, into mask_cache_dir,
+    # before the workers start; the workers then only read them.
+    # With a model index, the grids are taken from the index instead of the files.
+    # tile_settings: {'tile_cells': ..., 'workers': ...} to build the masks of each grid in tiles on threads
+    if index_filename is not None:
+        with ModelIndex(index_filename) as index:
+            grids = [grid for grid in index.grid_groups(nc_filenames) if grid is not None]
+            for grid in grids:
+                load_basin_masks(*index.grid_coords(grid), shape_filename, cache_dir=mask_cache_dir, **(tile_settings or {}))
+        return len(grids)
+
+    prepared = set()
+    for nc_filename in nc_filenames:
+        try:
+            with ModelReader(nc_filename, 'lithk') as model:
+                x, y = model.x, model.y
+        except Exception:
+            # Reported by the worker that processes the file
+            continue
+        key = (x.tobytes(), y.tobytes())
+        if key not in prepared:
+            load_basin_masks(x, y, shape_filename, cache_dir=mask_cache_dir, **(tile_settings or {}))
+            prepared.add(key)
+    return len(prepared)
+
+
+def load_observation_state(obs_filename, start_date, end_date, icesheet, shape_filename, rho_ice=918,
+                           mass_balance_column='Cumulative mass balance (Gt)', obs_east_filename=None,
+                           obs_west_filename=None, obs_peninsula_filename=None, projection=None,
+                           mask_cache_dir=None, csv_output_path=None, instrument=None, staging_settings=None,
+                           tile_settings=None):
+    # Everything the model comparisons share; plain data, so it can be sent to worker processes
+    observations = IMBIE_observations(obs_filename, start_date, end_date, icesheet, mass_balance_column,
+                                      obs_east_filename, obs_west_filename, obs_peninsula_filename)
+    return {'observations': observations, 'start_date': start_date, 'end_date': end_date,
+            'icesheet': icesheet, 'shape_filename': shape_filename, 'rho_ice': rho_ice,
+            'projection': projection or PROJECTIONS[icesheet],
+            'mass_balance_type': MASS_BALANCE_TYPES.get(mass_balance_column, mass_balance_column),
+            'mask_cache_dir': mask_cache_dir, 'csv_output_path': csv_output_path, 'instrument': instrument,
+            'staging': staging_settings, 'tiles': tile_settings}
+
+
+def run_ensemble(obs_filename, nc_filenames, start_date, end_date, icesheet, shape_filename, rho_ice=918,
+                 mass_balance_column='Cumulative mass balance (Gt)', obs_east_filename=None, obs_west_filename=None,
+                 obs_peninsula_filename=None, projection=None, processes=None, mask_cache_dir=None, csv_output_path=None,
+                 instrument=None, stage_records=None, index_filename=None, staging_settings=None, pipeline_depth=None,
+                 tile_settings=None):
+    """
+    Run the IMBIE comparison for every model in nc_filenames on `processes` worker processes
+    (all cores by default), or with pipeline_depth, in this process with the reads of the next
+    pipeline_depth models and the writes overlapping the computation (see run_pipelined).
+    Returns the tidy result table (a DataFrame with TABLE_COLUMNS) and one status dict per model,
+    in input order, like the gravimetry ensemble runner.
+    Basin masks are kept in mask_cache_dir, or in a temporary directory for this run.
+    instrument: instrumentation.enable() settings, e.g. {'memory': 'rss'}, to record stage timings;
+    the records (the observations and basin masks, model None, then each model) are appended to stage_records.
+    index_filename: an up to date model index (see model_index.py) of nc_filenames, for the model grids.
+    staging_settings: staging.configure() settings, e.g. {'stage_dir': '/scratch/models'}, to read the
+    model files from local copies.
+    tile_settings: {'tile_cells': ..., 'workers': ...} to split each model grid into tiles of about
+    tile_cells cells processed on `workers` threads, e.g. for a few very large grids with processes=1.
+    """
+    if pipeline_depth is not None and instrument is not None:
+        raise ValueError('Error: Stage timings are not recorded in a pipelined run, where the stages of models overlap.')
+    if csv_output_path is not None:
+        os.makedirs(csv_output_path, exist_ok=True)
+
+    temporary_mask_dir = None
+    if mask_cache_dir is None:
+        mask_cache_dir = temporary_mask_dir = tempfile.mkdtemp(prefix='basin_masks_')
+
+    if instrument is not None:
+        instrumentation.enable(**instrument)
+    if staging_settings is not None:
+        staging.configure(**staging_settings)
+    try:
+        with instrumentation.recording(model=None) as observation_record:
+            state = load_observation_state(obs_filename, start_date, end_date, icesheet, shape_filename, rho_ice,
+                                           mass_balance_column, obs_east_filename, obs_west_filename,
+                                           obs_peninsula_filename, projection, mask_cache_dir, csv_output_path, instrument,
+                                           staging_settings, tile_settings)
+            with instrumentation.stage('basin_masks'):
+                prepare_basin_masks(nc_filenames, shape_filename, mask_cache_dir, index_filename, tile_settings)
+        if stage_records is not None:
+            stage_records.append(observation_record)
+
+        rows, statuses = [], []
+        with contextlib.ExitStack() as stack:
+            if pipeline_depth is None:
+                # The state is sent to each worker once, not once per model
+                pool = stack.enter_context(ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(state,)))
+                model_results = pool.map(_run_model, nc_filenames)
+            else:
+                model_results = run_pipelined(state, nc_filenames, pipeline_depth)
+            for result in model_results:
+                if result['status'] == 'ok':
+                    rows += table_rows(model_name(result['model']), state, *result['output'])
+                    print(f"Processed: {result['model']}")
+                else:
+                    print(f"Error: {result['model']} failed. {result['error']}")
+                if stage_records is not None:
+                    stage_records.append({'model': result['model'], 'status': result['status'], 'stages': result.get('stages', [])})
+                result['output'] = None
+                statuses.append(result)
+    finally:
+        if temporary_mask_dir is not None:
+            shutil.rmtree(temporary_mask_dir, ignore_errors=True)
+        if instrument is not None:
+            instrumentation.disable()
+        if staging_settings is not None:
+            staging.configure(None)
+
+    return pd.DataFrame(rows, columns=TABLE_COLUMNS), statuses
+
+
+def write_table(table, csv_filename=None, parquet_filename=None):
+    if csv_filename is not None:
+        print(f"Writing data to CSV file: {csv_filename}")
+        table.to_csv(csv_filename, index=False)
+    if parquet_filename is not None:
+        try:
+            table.to_parquet(parquet_filename, index=False)
+            print(f"Writing data to Parquet file: {parquet_filename}")
+        except ImportError as error:
+            print(f'Error: Parquet output needs pyarrow or fastparquet; {parquet_filename} not written.')
+            print(error)
+
+
+def print_summary(statuses):
+    failed = [r for r in statuses if r['status'] != 'ok']
+    print(f'{len(statuses) - len(failed)} of {len(statuses)} models compared successfully.')
+    for r in failed:
+        print(f"  FAILED {r['model']}: {r['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='IMBIE comparison of a model ensemble.')
+    parser.add_argument('--obs', required=True, help='IMBIE mass balance CSV of the ice sheet')
+    parser.add_argument('--obs-east', default=None, help='IMBIE CSV of East Antarctica')
+    parser.add_argument('--obs-west', default=None, help='IMBIE CSV of West Antarctica')
+    parser.add_argument('--obs-peninsula', default=None, help='IMBIE CSV of the Antarctic Peninsula')
+    parser.add_argument('--models', required=True, nargs='+', help='model NetCDF files or glob templates')
+    parser.add_argument('--icesheet', required=True, choices=['GIS', 'AIS'])
+    parser.add_argument('--start', required=True, help='start date, YYYY-MM-DD')
+    parser.add_argument('--end', required=True, help='end date, YYYY-MM-01')
+    parser.add_argument('--shapefile', required=True, help='IMBIE basin shapefile')
+    parser.add_argument('--projection', default=None, help='CRS of the model grids (default: EPSG:3413 / EPSG:3031)')
+    parser.add_argument('--rho-ice', type=float, default=918, help='kg/m^3')
+    parser.add_argument('--mass-balance-column', default='Cumulative mass balance (Gt)')
+    parser.add_argument('--output', required=True, help='CSV file for the ensemble table')
+    parser.add_argument('--parquet', default=None, help='also write the table to this Parquet file')
+    parser.add_argument('--model-csv-path', default=None, help='also write the per-model comparison CSVs here')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--mask-cache', default=None, help='directory for cached basin masks')
+    parser.add_argument('--stages', default=None, help='write per-model stage timings to this JSON or CSV file')
+    parser.add_argument('--stage-memory', choices=['rss', 'tracemalloc', 'none'], default='rss',
+                        help='memory measure of the stage timings (tracemalloc is slower)')
+    parser.add_argument('--pipeline', type=int, default=None, metavar='DEPTH',
+                        help='compare the models in this process, reading DEPTH models ahead and writing on a separate thread')
+    parser.add_argument('--index', default=None, help='SQLite metadata index of the models, to skip ineligible files')
+    parser.add_argument('--staging-dir', default=None, help='local scratch directory to stage the model files in')
+    parser.add_argument('--staging-gb', type=float, default=staging.DEFAULT_MAX_BYTES / 2**30, help='size limit of the staging directory, GB')
+    parser.add_argument('--staging-extract', action='store_true', help='stage only lithk and its coordinates')
+    parser.add_argument('--tile-cells', type=int, default=None,
+                        help='split each model grid into tiles of about this many cells, processed on threads')
+    parser.add_argument('--tile-workers', type=int, default=None, help='threads per model for --tile-cells (default: all cores)')
+    args = parser.parse_args(argv)
+
+    if args.pipeline is not None and args.stages is not None:
+        parser.error('--stages cannot be recorded with --pipeline')
+
+    for filename in (args.obs, args.shapefile):
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f"Observation file not found: {filename}")
+
+    nc_filenames = sorted(f for template in args.models for f in glob.glob(template))
+    if not nc_filenames:
+        raise FileNotFoundError(f"No model files match: {' '.join(args.models)}")
+    if args.index is not None:
+        nc_filenames = select_models(args.index, nc_filenames, 'lithk', args.start, args.end)
+        if not nc_filenames:
+            raise FileNotFoundError(f"No model files cover {args.start} to {args.end}")
+
+    instrument, stage_records = None, []
+    if args.stages is not None:
+        instrument = {'memory': None if args.stage_memory == 'none' else args.stage_memory}
+    staging_settings = None
+    if args.staging_dir is not None:
+        staging_settings = {'stage_dir': args.staging_dir, 'max_bytes': int(args.staging_gb * 2**30), 'extract': args.staging_extract}
+    tile_settings = None
+    if args.tile_cells is not None:
+        tile_settings = {'tile_cells': args.tile_cells, 'workers': args.tile_workers}
+    table, statuses = run_ensemble(args.obs, nc_filenames, args.start, args.end, args.icesheet, args.shapefile,
+                                   args.rho_ice, args.mass_balance_column, args.obs_east, args.obs_west,
+                                   args.obs_peninsula, args.projection, args.processes, args.mask_cache,
+                                   args.model_csv_path, instrument, stage_records, args.index,
+                                   staging_settings, args.pipeline, tile_settings)
+    write_table(table, args.output, args.parquet)
+    if args.stages is not None:
+        instrumentation.write_records(stage_records, args.stages)
+    print_summary(statuses)
+    return 0 if all(r['status'] == 'ok' for r in statuses) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
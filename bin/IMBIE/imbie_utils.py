@@ -1,14 +1,19 @@
-import os
+import os,sys
+import contextlib
 import numpy as np
-import xarray as xr
 import pandas as pd
-from shapely.geometry import Point
-import geopandas as gpd
 
 import cftime 
 import datetime
 from datetime import timedelta 
 
+# Helpers shared with the gravimetry comparison
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Common'))
+from model_reader import ModelReader
+from result_cache import ResultCache
+from instrumentation import stage, instrumented
+from basin_masks import load_basin_masks
+import tiling
 
 
 ### #Adjust the start and end date according to the time variable of model data
@@ -70,22 +75,44 @@ def check_datarange(time_var,start_date, end_date):
 
 
 
+# Files of a shapefile that the basin sums depend on
+def shapefile_parts(shape_filename):
+    stem = os.path.splitext(shape_filename)[0]
+    return [stem + ext for ext in ('.shp', '.shx', '.dbf') if os.path.exists(stem + ext)]
+
+
 ### Load the model data and calculate  model mass balance for each basin and total mass balance for whole region
-def process_model_data(nc_filename,start_date, end_date,rho_ice,projection,shape_filename,icesheet):
-    #Model data
-    gis_ds = xr.open_dataset(nc_filename)
-    lithk = gis_ds['lithk']
-    time_var = gis_ds['time']
-    
-    # Check the selcted dates are within the range of model data
-    check_datarange(time_var,start_date, end_date)
-        
-    # Interpolate lithk values at the start and end dates
-    lithk_start = lithk.interp(time=start_date).data.transpose().flatten()
-    lithk_end = lithk.interp(time=end_date).data.transpose().flatten()
-    
-    # Calculate the difference
-    lithk_delta = lithk_end - lithk_start
+@instrumented('process_model_data')
+def process_model_data(nc_filename,start_date, end_date,rho_ice,projection,shape_filename,icesheet,mask_cache_dir=None,result_cache=None,model=None,
+                       tile_cells=None,workers=None):
+    # projection is the CRS of the model grid; the basin shapefile is expected in the same CRS.
+    # mask_cache_dir: directory to cache the basin membership of the model grid cells in,
+    # so later models on the same grid and shapefile skip the point-in-polygon tests.
+    # result_cache: a result_cache.ResultCache; the result is reused for the same model file,
+    # shapefile, dates, density and ice sheet.
+    # model: nc_filename already opened as a ModelReader (e.g. with its slices prefetched); it is left open.
+    # tile_cells: split the grid into tiles of about this many cells, tested against the basins and
+    # summed on `workers` threads (default: one per core), so a single large grid uses all cores.
+    if result_cache is not None:
+        params = {'start_date': str(start_date), 'end_date': str(end_date), 'rho_ice': float(rho_ice),
+                  'projection': str(projection), 'icesheet': icesheet}
+        return result_cache.call('process_model_data', [nc_filename] + shapefile_parts(shape_filename), params,
+                                 process_model_data, nc_filename, start_date, end_date, rho_ice, projection,
+                                 shape_filename, icesheet, mask_cache_dir=mask_cache_dir, model=model,
+                                 tile_cells=tile_cells, workers=workers)
+
+    #Model data: only the time slices bracketing the start and end dates are read
+    with ModelReader(nc_filename, 'lithk') if model is None else contextlib.nullcontext(model) as model:
+        # Check the selcted dates are within the range of model data
+        with stage('calendar_check'):
+            model.check_datarange(start_date, end_date)
+
+        # Interpolate lithk values at the start and end dates and calculate the difference
+        with stage('interp'):
+            lithk_delta = model.lithk_delta(start_date, end_date).transpose().flatten()
+
+        x_coords = model.x
+        y_coords = model.y
     
     # Replace NaN values with 0
     lithk_delta[np.isnan(lithk_delta)] = 0
@@ -94,48 +121,31 @@ def process_model_data(nc_filename,start_date, end_date,rho_ice,projection,shape
     # Change Ice thickness unit from (m) to mass (kg) to gigatonnes(Gt)
     # ice thickness*area* density of ice* 1e-12
     #calculate area = x_resolution*y_resolution
-    x_coords = gis_ds['x'].values
-    y_coords = gis_ds['y'].values
     x_resolution = abs(x_coords[1] - x_coords[0])
     y_resolution = abs(y_coords[1] - y_coords[0])
     
     lithk_delta = (lithk_delta * x_resolution*y_resolution)*rho_ice * 1e-12
     
     
-    # Create a list of Point geometries from coordinate grids
-    points = [Point(x, y) for x in x_coords for y in y_coords]
-    
-    # Flatten lithk_delta to match the points list 
-    lithk_delta_flat = lithk_delta.flatten()
-    
-    # Create DataFrame
-    lithk_df = pd.DataFrame({
-        'geometry': points,
-        'lithk_delta': lithk_delta_flat
-    })
-    
-    # Convert DataFrame to GeoDataFrame
-    lithk_gdf = gpd.GeoDataFrame(lithk_df, geometry='geometry', crs=projection)
-    
-    # Load basin shapefile 
-    basins_gdf = gpd.read_file(shape_filename)
-    
-    # Perform spatial join
-    joined_gdf = gpd.sjoin(lithk_gdf, basins_gdf, how="inner", predicate='intersects')
+    # Basins of the grid cells (x-major, like lithk_delta); a cell on a basin boundary counts in each basin
+    with stage('basin_masks'):
+        masks = load_basin_masks(x_coords, y_coords, shape_filename, cache_dir=mask_cache_dir, tile_cells=tile_cells, workers=workers)
+    tiles = None if tile_cells is None else tiling.cell_tiles(len(x_coords), len(y_coords), tile_cells)
     
     # Sum lithk_delta values by basin
-    if icesheet == "GIS":
-         # Sum lithk_delta values by subregion column
-        basin_mass_change_sums = joined_gdf.groupby('SUBREGION1')['lithk_delta'].sum()
-        # Sum lithk_delta values by the 'Regions' column
-        region_mass_change_sums = None  # No regions for Greenland
-    elif icesheet == "AIS":
-        # Sum lithk_delta values by subregion column
-        basin_mass_change_sums = joined_gdf.groupby('Subregion')['lithk_delta'].sum()
-        # Sum lithk_delta values by the 'Regions' column
-        region_mass_change_sums = joined_gdf.groupby('Regions')['lithk_delta'].sum()
-    else:
-        raise ValueError("Invalid iceshee value. Must be 'GIS' or 'AIS'.")
+    with stage('basin_sums'):
+        if icesheet == "GIS":
+             # Sum lithk_delta values by subregion column
+            basin_mass_change_sums = masks.sums(lithk_delta, 'SUBREGION1', tiles, workers)
+            # Sum lithk_delta values by the 'Regions' column
+            region_mass_change_sums = None  # No regions for Greenland
+        elif icesheet == "AIS":
+            # Sum lithk_delta values by subregion column
+            basin_mass_change_sums = masks.sums(lithk_delta, 'Subregion', tiles, workers)
+            # Sum lithk_delta values by the 'Regions' column
+            region_mass_change_sums = masks.sums(lithk_delta, 'Regions', tiles, workers)
+        else:
+            raise ValueError("Invalid iceshee value. Must be 'GIS' or 'AIS'.")
     
     # Sum all of the basin mass change
     model_total_mass_balance= basin_mass_change_sums.sum()
@@ -152,6 +162,120 @@ def process_model_data(nc_filename,start_date, end_date,rho_ice,projection,shape
 
 
 
+### Model mass change time series by basin and region
+# Mass change of every basin at a series of epochs, relative to the first epoch, from one pass over
+# the model instead of one process_model_data run per date. lithk is read chunk_size epochs at a
+# time (only the time slices bracketing them), and the changes of a whole chunk are summed by basin
+# and by region with one sparse (group x cell) product each, so memory depends on chunk_size and
+# not on the length of the series.
+#
+# time_grid 'model': the model's own time slices.
+# time_grid 'imbie': the first day of each IMBIE month of obs_filename within the model time range,
+#                    with the model interpolated in time as in process_model_data.
+def model_series_epochs(model, time_grid='model', obs_filename=None, start_date=None, end_date=None):
+    # Dates ('YYYY-MM-DD') of the epochs, and the bracketing slices and weight of each
+    if time_grid == 'model':
+        keep = np.ones(len(model.times), dtype=bool)
+        if start_date is not None:
+            keep &= model.times >= model.to_model_time([start_date])[0]
+        if end_date is not None:
+            keep &= model.times <= model.to_model_time([end_date])[0]
+        i_0 = np.flatnonzero(keep)
+        dates = [d.strftime('%Y-%m-%d') for d in cftime.num2date(model.times[i_0], model.time_units, calendar=model.calendar)]
+        return dates, i_0, i_0, np.zeros(len(i_0))
+
+    if time_grid == 'imbie':
+        if obs_filename is None:
+            raise ValueError("Error: time_grid 'imbie' needs the IMBIE file (obs_filename).")
+        keys = load_mass_balance_table(obs_filename)['keys']
+        keys = keys[keys % 100 <= 12]
+        dates = np.array([f'{key // 100:04d}-{key % 100:02d}-01' for key in keys])
+        keep = model.in_range(dates) if len(dates) else np.zeros(0, dtype=bool)
+        if start_date is not None:
+            keep &= dates >= start_date
+        if end_date is not None:
+            keep &= dates <= end_date
+        dates = [str(date) for date in dates[keep]]
+        if not dates:
+            return dates, np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+        return (dates, *model.bracket(dates))
+
+    raise ValueError(f"Error: time_grid must be 'model' or 'imbie', not '{time_grid}'.")
+
+
+@instrumented('process_model_series')
+def process_model_series(nc_filename, rho_ice, shape_filename, icesheet, time_grid='model', obs_filename=None,
+                         start_date=None, end_date=None, chunk_size=12, mask_cache_dir=None):
+    # Returns (basin x date) and, for AIS, (region x date) DataFrames of mass change (Gt) since the
+    # first date, and the total over all basins as a Series; each column equals the process_model_data
+    # sums from the first date to that date.
+    if icesheet == "GIS":
+        columns = {'basin': 'SUBREGION1'}
+    elif icesheet == "AIS":
+        columns = {'basin': 'Subregion', 'region': 'Regions'}
+    else:
+        raise ValueError("Invalid iceshee value. Must be 'GIS' or 'AIS'.")
+
+    with ModelReader(nc_filename, 'lithk') as model:
+        dates, i_0, i_1, w = model_series_epochs(model, time_grid, obs_filename, start_date, end_date)
+        if len(dates) < 2:
+            raise ValueError('Error: Fewer than two epochs of the time grid fall inside the model time range.')
+
+        x_coords = model.x
+        y_coords = model.y
+        masks = load_basin_masks(x_coords, y_coords, shape_filename, cache_dir=mask_cache_dir)
+        groups = {level: masks.group_matrix(column) for level, column in columns.items()}
+
+        # Grid cells in any basin, as (y, x) indices of the model fields; cells are x-major
+        cells = np.flatnonzero(masks.labels >= 0)
+        iy, ix = cells % len(y_coords), cells // len(y_coords)
+
+        def epoch_field(slices, j_0, j_1, w_k):
+            field_0 = slices[j_0][iy, ix].astype(np.float64)
+            return field_0 + w_k * (slices[j_1][iy, ix] - field_0) if w_k else field_0
+
+        lithk_0 = None
+        sums = {level: np.empty((len(names), len(dates))) for level, (names, _, _) in groups.items()}
+        for c in range(0, len(dates), chunk_size):
+            chunk = slice(c, c + chunk_size)
+            # Read the bracketing slices of the chunk once each, as contiguous runs
+            needed = np.unique(np.concatenate([i_0[chunk], i_1[chunk]]))
+            runs = np.split(needed, np.flatnonzero(np.diff(needed) > 1) + 1)
+            slices = {}
+            for run in runs:
+                for i, field in zip(run, model.read_slices(run[0], run[-1] + 1)):
+                    slices[i] = field
+
+            if lithk_0 is None:
+                lithk_0 = epoch_field(slices, i_0[0], i_1[0], w[0])
+
+            # (cell x date) changes since the first date, missing values set to zero as in process_model_data
+            lithk_delta = np.empty((len(cells), len(i_0[chunk])))
+            for k, (j_0, j_1, w_k) in enumerate(zip(i_0[chunk], i_1[chunk], w[chunk])):
+                lithk_delta[:, k] = epoch_field(slices, j_0, j_1, w_k) - lithk_0
+            del slices
+            lithk_delta[np.isnan(lithk_delta)] = 0
+
+            for level, (names, _, matrix) in groups.items():
+                sums[level][:, chunk] = matrix @ lithk_delta
+
+    # Ice thickness (m) to mass (Gt): thickness * cell area * density of ice * 1e-12
+    x_resolution = abs(x_coords[1] - x_coords[0])
+    y_resolution = abs(y_coords[1] - y_coords[0])
+    scale = x_resolution * y_resolution * rho_ice * 1e-12
+
+    date_index = pd.Index(dates, name='date')
+    mass_change = {level: pd.DataFrame(sums[level] * scale, index=pd.Index(names, name=columns[level]), columns=date_index)
+                   for level, (names, _, _) in groups.items()}
+
+    return {
+        'dates': dates,
+        'model_total_mass_balance': mass_change['basin'].sum(axis=0).rename('model_total_mass_balance'),
+        'basin_mass_change': mass_change['basin'],
+        'region_mass_change': mass_change.get('region')
+    }
+
+
 ### IMBIE data date format conversion
 # Define a function to convert fractional years to a precise datetime format
 def fractional_year_to_date(year):
@@ -185,51 +309,91 @@ def assign_month_order(group):
 
 
 
+### Vectorized version of fractional_year_to_date for a whole 'Year' column
+def fractional_years_to_dates(years):
+    years = np.asarray(years, dtype=np.float64)
+    year_int = np.trunc(years).astype(np.int64)
+    fraction = years - year_int
+
+    # Leap years of the proleptic Gregorian calendar, as pd.Timestamp.is_leap_year
+    leap = ((year_int % 4 == 0) & (year_int % 100 != 0)) | (year_int % 400 == 0)
+    total_days_in_year = np.where(leap, 366, 365)
+
+    # timedelta(days=...) rounds to the nearest microsecond
+    fractional_us = np.round(fraction * total_days_in_year * 86400e6).astype(np.int64)
+    start_of_year = (year_int - 1970).astype('datetime64[Y]').astype('datetime64[us]')
+    return start_of_year + fractional_us.astype('timedelta64[us]')
+
+
+### IMBIE mass balance time series, indexed by date
+# The IMBIE 'Year' values are fractional years, one row per month. Each row is keyed by the
+# month it stands for, year*100 + Month_Order, with Month_Order counted from the month of the
+# first row of each year (as assign_month_order does). Tables are cached per file and reloaded
+# when the file changes.
+_mass_balance_tables = {}
+
+def load_mass_balance_table(obs_filename):
+    path = os.path.abspath(obs_filename)
+    stat = os.stat(path)
+    cached = _mass_balance_tables.get(path)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+
+    # Load the CSV file
+    mass_balance_data = pd.read_csv(path)
+
+    # Sort by date, to have increasing order of both year and fraction
+    dates = fractional_years_to_dates(mass_balance_data['Year'].astype(float).to_numpy())
+    order = np.argsort(dates, kind='stable')
+    dates = dates[order]
+    mass_balance_data = mass_balance_data.iloc[order].reset_index(drop=True)
+
+    # Month order within each year, starting from the month of the year's first entry
+    years = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+    months = (dates.astype('datetime64[M]') - dates.astype('datetime64[Y]')).astype(np.int64) + 1
+    first = np.flatnonzero(np.r_[True, years[1:] != years[:-1]])
+    group_start = first[np.cumsum(np.r_[True, years[1:] != years[:-1]]) - 1]
+    month_order = months[group_start] + np.arange(len(dates)) - group_start
+
+    mass_balance_data.index = pd.DatetimeIndex(dates, name='Date')
+    mass_balance_data['Month_Order'] = month_order
+    table = {'data': mass_balance_data, 'keys': years * 100 + month_order}
+
+    _mass_balance_tables[path] = ((stat.st_mtime_ns, stat.st_size), table)
+    return table
+
+
+def _date_key(date):
+    # Key of a 'YYYY-MM-DD' date, comparable with the table keys: year*100 + month, plus the day as a fraction
+    date_dt = datetime.datetime.strptime(date, '%Y-%m-%d')
+    return date_dt.year * 100 + date_dt.month + (date_dt.day - 1) / 100
+
+
 ### Extract IMBIE mass balance data
 def sum_MassBalance(obs_filename,start_date,end_date,mass_balance_column):
-    
-    # Load the CSV file
-    mass_balance_data = pd.read_csv(obs_filename)
-    
-    # Column names
-    date_column = 'Year'
-    
-    # Ensure the 'Year' column is treated as float to capture the fractional year part
-    mass_balance_data['Year'] = mass_balance_data['Year'].astype(float)
-    
-    # Apply the conversion function to the 'Year' column
-    mass_balance_data['Date'] = mass_balance_data['Year'].apply(fractional_year_to_date)
-  
-    # Sort the data by 'Date' column to ensure it’s in increasing order of both year and fraction
-    mass_balance_data = mass_balance_data.sort_values(by='Date')
-      
-    # Apply the function to each group of data (grouped by the year)
-    mass_balance_data = mass_balance_data.groupby(mass_balance_data['Date'].dt.year).apply(assign_month_order)
-    
-    # Convert 'Year' column to year-month-01 format where month is 'Month_Order'
-    mass_balance_data['Year'] = mass_balance_data.apply(lambda row: f"{row['Date'].year}-{str(row['Month_Order']).zfill(2)}-01", axis=1)
-    
-    # Reset the index to flatten the multi-index structure
-    mass_balance_data = mass_balance_data.reset_index(drop=True)
+    # Change of mass_balance_column from the last entry before start_date to the entry of the
+    # month of end_date, which has to be the first day of a month
+    table = load_mass_balance_table(obs_filename)
+    mass_balance_data = table['data']
+    keys = table['keys']
 
-    
     # Check if the column exists in the DataFrame
     if mass_balance_column not in mass_balance_data.columns:
         raise ValueError(f"Error: The column '{mass_balance_column}' does not exist in the CSV file.")
+    values = mass_balance_data[mass_balance_column].to_numpy()
 
-    
-    # Filter the data for the end date
-    end_data = mass_balance_data[mass_balance_data['Year'] == end_date]    
-    if end_data.empty:
+    # The entry for the end date
+    end_key = _date_key(end_date)
+    i_end = np.searchsorted(keys, end_key, side='right') - 1
+    if i_end < 0 or keys[i_end] != end_key:
         raise ValueError(f"Error: No data available for the end date {end_date}.")
-    mass_balance_end_value = end_data[mass_balance_column].iloc[-1]  # Last value before or at the end date
+    mass_balance_end_value = values[i_end]
 
-    
-    # Filter the data for one date before the start date
-    data_before_start_date = mass_balance_data[mass_balance_data[date_column] < start_date]
-    if data_before_start_date.empty:
+    # The last entry before the start date
+    i_start = np.searchsorted(keys, _date_key(start_date), side='left') - 1
+    if i_start < 0:
         raise ValueError(f"Error: No data available before the start date {start_date}.")
-    mass_balance_start_value = data_before_start_date[mass_balance_column].iloc[-1]  # Last value before start date
+    mass_balance_start_value = values[i_start]  # Last value before start date
     
     # Subtract the two values to get the total mass balance change
     IMBIE_total_mass_change_sum = mass_balance_end_value - mass_balance_start_value
@@ -238,15 +402,96 @@ def sum_MassBalance(obs_filename,start_date,end_date,mass_balance_column):
 
 
 
-### Calculate mass balance difference of IMBIE and model data
-def process_IMBIE(obs_filename, start_date, end_date, icesheet, basin_result,mass_balance_column,obs_east_filename=None, obs_west_filename=None, obs_peninsula_filename=None):
+### IMBIE mass change at a series of dates
+def IMBIE_series(obs_filename, dates, mass_balance_column):
+    # Change of mass_balance_column at each date ('YYYY-MM-DD'), with the entries picked as in
+    # sum_MassBalance: from the last entry before the first date to the entry of the month of each
+    # date, so the value at a date is sum_MassBalance(dates[0], date). NaN where IMBIE has no entry for the month.
+    table = load_mass_balance_table(obs_filename)
+    mass_balance_data = table['data']
+    keys = table['keys']
+    if mass_balance_column not in mass_balance_data.columns:
+        raise ValueError(f"Error: The column '{mass_balance_column}' does not exist in the CSV file.")
+    values = mass_balance_data[mass_balance_column].to_numpy(dtype=np.float64)
+
+    # The last entry before the first date
+    i_start = np.searchsorted(keys, _date_key(dates[0]), side='left') - 1
+    if i_start < 0:
+        raise ValueError(f"Error: No data available before the start date {dates[0]}.")
+
+    # The entry of the month of each date
+    date_keys = np.array([int(_date_key(date)) for date in dates])
+    i = np.searchsorted(keys, date_keys, side='right') - 1
+    found = (i >= 0) & (keys[np.maximum(i, 0)] == date_keys)
+    series = np.where(found, values[np.maximum(i, 0)], np.nan)
+    return pd.Series(series - values[i_start], index=pd.Index(dates, name='date'), name='IMBIE_mass_change')
+
+
+### Compare a model's mass change series (from process_model_series) with IMBIE at every date
+def compare_series_with_IMBIE(series_result, icesheet, obs_filename, mass_balance_column,
+                              obs_east_filename=None, obs_west_filename=None, obs_peninsula_filename=None):
+    # The residuals (IMBIE - model) at each date are those of compare_with_IMBIE for a comparison
+    # from the first date to that date
+    dates = series_result['dates']
+    results = {}
+
+    IMBIE_mass_change = IMBIE_series(obs_filename, dates, mass_balance_column)
+    results['IMBIE_mass_change'] = IMBIE_mass_change
+    results['delta_masschange'] = (IMBIE_mass_change - series_result['model_total_mass_balance']).rename('delta_masschange')
+
+    if icesheet == "AIS":
+        print_regionalresult_check = 'NO'
+        region_files = {'East': obs_east_filename, 'West': obs_west_filename, 'Peninsula': obs_peninsula_filename}
+        if all(filename and os.path.exists(filename) for filename in region_files.values()):
+            print_regionalresult_check = 'YES'
+
+            IMBIE_region = pd.DataFrame({region: IMBIE_series(filename, dates, mass_balance_column)
+                                         for region, filename in region_files.items()}).T
+            IMBIE_region.index.name = 'Regions'
+            results['IMBIE_region_mass_change'] = IMBIE_region
+            results['delta_region_masschange'] = IMBIE_region - series_result['region_mass_change'].loc[IMBIE_region.index]
+
+        results['print_regionalresult_check'] = print_regionalresult_check
+
+    return results
+
+
+### IMBIE mass change over the comparison period, for the whole ice sheet and (AIS) its regions
+@instrumented('imbie_observations')
+def IMBIE_observations(obs_filename, start_date, end_date, icesheet, mass_balance_column, obs_east_filename=None, obs_west_filename=None, obs_peninsula_filename=None):
+    observations = {}
+
+    # IMBIE total mass balance
+    observations['IMBIE_total_mass_change_sum'] = sum_MassBalance(obs_filename, start_date, end_date,mass_balance_column)
+
+    # Check if all required (regional) files are available for Antarctica
+    if icesheet == "AIS":
+        print_regionalresult_check = 'NO'
+        if (obs_east_filename and os.path.exists(obs_east_filename)) and \
+           (obs_west_filename and os.path.exists(obs_west_filename)) and \
+           (obs_peninsula_filename and os.path.exists(obs_peninsula_filename)):
+            
+            print_regionalresult_check = 'YES' 
+            
+            # Calculate total mass for each region
+            observations['IMBIE_total_mass_change_sum_east'] = sum_MassBalance(obs_east_filename, start_date, end_date,mass_balance_column)
+            observations['IMBIE_total_mass_change_sum_west'] = sum_MassBalance(obs_west_filename, start_date, end_date,mass_balance_column)
+            observations['IMBIE_total_mass_change_sum_peninsula'] = sum_MassBalance(obs_peninsula_filename, start_date, end_date,mass_balance_column)
+
+        observations['print_regionalresult_check'] = print_regionalresult_check
+
+    return observations
+
+
+### Compare a model's mass change (from process_model_data) with the IMBIE observations
+def compare_with_IMBIE(observations, icesheet, basin_result):
     results = {}
 
     # model mass balance
     model_total_mass_balance = basin_result['model_total_mass_balance']
     
     # IMBIE total mass balance
-    IMBIE_total_mass_change_sum = sum_MassBalance(obs_filename, start_date, end_date,mass_balance_column)
+    IMBIE_total_mass_change_sum = observations['IMBIE_total_mass_change_sum']
     
     # Calculate difference of IMBIE-model mass change
     delta_masschange = IMBIE_total_mass_change_sum - model_total_mass_balance
@@ -255,34 +500,16 @@ def process_IMBIE(obs_filename, start_date, end_date, icesheet, basin_result,mas
     results['IMBIE_total_mass_change_sum'] = IMBIE_total_mass_change_sum
     results['delta_masschange'] = delta_masschange
     
-    # Check if all required (regional) files are available for Antarctica
     if icesheet == "AIS":
         region_mass_change_sums = basin_result.get('region_mass_change_sums') 
-        print_regionalresult_check = 'NO'
-        if (obs_east_filename and os.path.exists(obs_east_filename)) and \
-           (obs_west_filename and os.path.exists(obs_west_filename)) and \
-           (obs_peninsula_filename and os.path.exists(obs_peninsula_filename)):
-            
-            print_regionalresult_check = 'YES' 
-            
-            # Calculate total mass for each region
-            IMBIE_total_mass_change_sum_east = sum_MassBalance(obs_east_filename, start_date,         end_date,mass_balance_column)
-            IMBIE_total_mass_change_sum_west = sum_MassBalance(obs_west_filename, start_date, end_date,mass_balance_column)
-            IMBIE_total_mass_change_sum_peninsula = sum_MassBalance(obs_peninsula_filename, start_date, end_date,mass_balance_column)
-            
-            # Calculate the difference of IMBIE-model mass change for each region
-            delta_masschange_east = IMBIE_total_mass_change_sum_east - region_mass_change_sums['East']
-            delta_masschange_west = IMBIE_total_mass_change_sum_west - region_mass_change_sums['West']
-            delta_masschange_peninsula = IMBIE_total_mass_change_sum_peninsula - region_mass_change_sums['Peninsula']
-            
-            # Store regional results in the dictionary
-            results['IMBIE_total_mass_change_sum_east'] = IMBIE_total_mass_change_sum_east
-            results['IMBIE_total_mass_change_sum_west'] = IMBIE_total_mass_change_sum_west
-            results['IMBIE_total_mass_change_sum_peninsula'] = IMBIE_total_mass_change_sum_peninsula
-            
-            results['delta_masschange_east'] = delta_masschange_east
-            results['delta_masschange_west'] = delta_masschange_west
-            results['delta_masschange_peninsula'] = delta_masschange_peninsula
+        print_regionalresult_check = observations['print_regionalresult_check']
+        if print_regionalresult_check == 'YES':
+            for region in ('east', 'west', 'peninsula'):
+                IMBIE_region_sum = observations[f'IMBIE_total_mass_change_sum_{region}']
+
+                # Calculate the difference of IMBIE-model mass change for each region
+                results[f'IMBIE_total_mass_change_sum_{region}'] = IMBIE_region_sum
+                results[f'delta_masschange_{region}'] = IMBIE_region_sum - region_mass_change_sums[region.capitalize()]
 
         # Store regional check result in the dictionary
         results['print_regionalresult_check'] = print_regionalresult_check
@@ -290,9 +517,29 @@ def process_IMBIE(obs_filename, start_date, end_date, icesheet, basin_result,mas
     return results
 
 
+### Calculate mass balance difference of IMBIE and model data
+def process_IMBIE(obs_filename, start_date, end_date, icesheet, basin_result,mass_balance_column,obs_east_filename=None, obs_west_filename=None, obs_peninsula_filename=None, result_cache=None):
+    # result_cache: a result_cache.ResultCache; the IMBIE observations are reused for the same files, dates and column
+    if result_cache is not None:
+        region_filenames = [obs_east_filename, obs_west_filename, obs_peninsula_filename]
+        params = {'start_date': str(start_date), 'end_date': str(end_date), 'icesheet': icesheet,
+                  'mass_balance_column': mass_balance_column,
+                  # which regional files were given and exist
+                  'regions': [bool(filename and os.path.exists(filename)) for filename in region_filenames]}
+        files = [obs_filename] + [filename for filename in region_filenames if filename and os.path.exists(filename)]
+        observations = result_cache.call('IMBIE_observations', files, params, IMBIE_observations,
+                                         obs_filename, start_date, end_date, icesheet, mass_balance_column,
+                                         obs_east_filename, obs_west_filename, obs_peninsula_filename)
+    else:
+        observations = IMBIE_observations(obs_filename, start_date, end_date, icesheet, mass_balance_column,
+                                          obs_east_filename, obs_west_filename, obs_peninsula_filename)
+    return compare_with_IMBIE(observations, icesheet, basin_result)
+
+
 
 
 ## Write the mass comaprision output results to csv files
+@instrumented('write_csv')
 def write_mass_change_comparison(icesheet, basin_result, results,mass_balance_type,start_date,end_date,csv_filename):
     print_regionalresult_check = results.get('print_regionalresult_check')
 